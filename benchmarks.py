@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of wsgi_party's hot paths.
+
+    Run ``python benchmarks.py --json results.json`` to measure, and
+    ``python benchmarks.py --compare results.json`` on another release to
+    compare against saved results.  See ``--help``.
+
+    :copyright: (c) 2012 by Ron DuPlain.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+from wsgi_party import (HighAndDry, LazyInvite, WSGIParty, make_environ,
+                        run_app)
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#: Registered benchmarks, in order: (name, params, setup function).
+BENCHMARKS = []
+
+#: Registered memory footprints, in order: (name, params, build function).
+FOOTPRINTS = []
+
+
+def benchmark(name, **params):
+    """Register a setup function returning the operation to time.
+
+    The setup function is called with params and returns a callable taking no
+    arguments, or raises :class:`Skip`.  A ``close`` attribute of the
+    callable, if any, is called once it has been timed.
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, params, setup))
+        return setup
+    return decorator
+
+
+def footprint(name, **params):
+    """Register a build function whose memory to measure.
+
+    The build function is called with params and returns what it built, or
+    raises :class:`Skip`.  Memory it allocated and still holds once it
+    returns is counted.
+    """
+    def decorator(build):
+        FOOTPRINTS.append((name, params, build))
+        return build
+    return decorator
+
+
+class Skip(Exception):
+    """Raised by a setup function when its benchmark cannot run here."""
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'Hello, world!\n']
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+class InviteApp(object):
+    """Dispatcher-like app connecting handlers on invitation, per mount."""
+
+    def __init__(self, services=('url',)):
+        self.services = services
+        self.joined = 0
+
+    def __call__(self, environ, start_response):
+        partyline = environ.get('partyline')
+        if partyline is not None:
+            index = self.joined
+            self.joined += 1
+            for service_name in self.services:
+                partyline.connect(service_name, make_handler(index))
+        return hello_app(environ, start_response)
+
+
+def make_handler(index, misses=False):
+    if misses:
+        def handler(payload):
+            raise HighAndDry()
+    else:
+        def handler(payload):
+            return index
+    return handler
+
+
+def invites(count):
+    return ['/app%d/__invite__/' % i for i in range(count)]
+
+
+@benchmark('ask_around', services=1, handlers=1, operators=1)
+@benchmark('ask_around', services=1, handlers=10, operators=10)
+@benchmark('ask_around', services=1, handlers=50, operators=50)
+@benchmark('ask_around', services=20, handlers=10, operators=10)
+def bench_ask_around(services, handlers, operators):
+    """Ask one of several services, each with handlers spread over apps."""
+    names = ['service%d' % i for i in range(services)]
+    party = WSGIParty(hello_app)
+    party.send_invitations(invites(operators))
+    for i in range(handlers):
+        operator = party.operators[i % operators]
+        for name in names:
+            operator.connect(name, make_handler(i))
+    asker = party.operators[0]
+    name = names[-1]
+    return lambda: asker.ask_around(name, None)
+
+
+@benchmark('ask_first', handlers=10)
+@benchmark('ask_first', handlers=50)
+def bench_ask_first(handlers):
+    """Ask for the first answer when every handler answers."""
+    party = WSGIParty(InviteApp(), invites(handlers))
+    return lambda: party.ask_first('url', None)
+
+
+@benchmark('high_and_dry', handlers=20, miss_rate=0.0)
+@benchmark('high_and_dry', handlers=20, miss_rate=0.5)
+@benchmark('high_and_dry', handlers=20, miss_rate=0.9)
+@benchmark('high_and_dry', handlers=20, miss_rate=1.0)
+def bench_high_and_dry(handlers, miss_rate):
+    """Ask handlers of which the given share raise HighAndDry."""
+    party = WSGIParty(hello_app)
+    for i in range(handlers):
+        misses = i < handlers * miss_rate
+        party.connect('url', make_handler(i, misses))
+    return lambda: party.ask_around('url', None)
+
+
+@benchmark('ask_around_many', handlers=10, payloads=100)
+def bench_ask_around_many(handlers, payloads):
+    """Ask about many payloads at once, compared to asking one by one."""
+    party = WSGIParty(InviteApp(), invites(handlers))
+    batch = list(range(payloads))
+    return lambda: party.ask_around_many('url', batch)
+
+
+@benchmark('ask_around_loop', handlers=10, payloads=100)
+def bench_ask_around_loop(handlers, payloads):
+    """Ask about many payloads, one ask per payload."""
+    party = WSGIParty(InviteApp(), invites(handlers))
+    batch = list(range(payloads))
+    def op():
+        for payload in batch:
+            party.ask_around('url', payload)
+    return op
+
+
+@benchmark('cached_ask', handlers=10, shared=False)
+@benchmark('cached_ask', handlers=10, shared=True)
+def bench_cached_ask(handlers, shared):
+    """Ask a cached service, from a process-local or shared cache."""
+    party = WSGIParty(InviteApp(), invites(handlers))
+    payload = {'endpoint': 'index', 'values': {'page': 2}}
+    def op():
+        return party.ask_around('url', payload)
+    if not shared:
+        party.cache_answers('url')
+        return op
+    directory = tempfile.TemporaryDirectory()
+    cache = party.cache_answers('url',
+                                path=os.path.join(directory.name, 'answers'))
+    def close():
+        cache.close()
+        directory.cleanup()
+    op.close = close
+    return op
+
+
+@benchmark('announce', handlers=10, coalesce=False, burst=16)
+@benchmark('announce', handlers=10, coalesce=True, burst=16)
+def bench_announce(handlers, coalesce, burst):
+    """Announce a burst of new payloads, each twice in a row, and wait until
+    they are delivered to every handler."""
+    party = WSGIParty(InviteApp(), invites(handlers),
+                      announcements={'coalesce': coalesce})
+    counter = itertools.count()
+    def op():
+        for i in range(burst):
+            party.announce('url', next(counter) // 2)
+        party.flush()
+    op.close = party.close
+    return op
+
+
+@benchmark('contention', threads=1, asks=200, connects=50)
+@benchmark('contention', threads=8, asks=200, connects=50)
+def bench_contention(threads, asks, connects):
+    """Ask from many threads while handlers keep connecting."""
+    def op():
+        party = WSGIParty(hello_app)
+        party.connect('url', make_handler(0))
+        def ask():
+            for i in range(asks):
+                party.ask_around('url', None)
+        askers = [threading.Thread(target=ask) for i in range(threads)]
+        for thread in askers:
+            thread.start()
+        for i in range(connects):
+            party.connect('url', make_handler(i + 1))
+        for thread in askers:
+            thread.join()
+    return op
+
+
+@benchmark('limited_ask', handlers=10, limited=False)
+@benchmark('limited_ask', handlers=10, limited=True)
+def bench_limited_ask(handlers, limited):
+    """Ask a service with or without an uncontended concurrency limit."""
+    party = WSGIParty(InviteApp(), invites(handlers))
+    if limited:
+        party.limit_asks('url', 8)
+    return lambda: party.ask_around('url', None)
+
+
+@benchmark('identical_asks', threads=8, asks=20, coalesce=False)
+@benchmark('identical_asks', threads=8, asks=20, coalesce=True)
+def bench_identical_asks(threads, asks, coalesce):
+    """Ask the same from many threads at once, of a handler waiting on a
+    backend which serves one call at a time."""
+    party = WSGIParty(hello_app)
+    backend = threading.Lock()
+    def slow(payload):
+        with backend:
+            time.sleep(0.0002)
+        return payload
+    party.connect('url', slow)
+    if coalesce:
+        party.coalesce_asks('url')
+    def ask():
+        for i in range(asks):
+            party.ask_around('url', {'endpoint': 'index'})
+    def op():
+        askers = [threading.Thread(target=ask) for i in range(threads)]
+        for thread in askers:
+            thread.start()
+        for thread in askers:
+            thread.join()
+    return op
+
+
+@benchmark('send_invitations', apps=50, mode='werkzeug')
+@benchmark('send_invitations', apps=50, mode='lightweight')
+@benchmark('send_invitations', apps=50, mode='concurrent')
+@benchmark('send_invitations', apps=50, mode='lazy')
+def bench_send_invitations(apps, mode):
+    """Start a party with many mounted applications."""
+    if mode == 'werkzeug':
+        try:
+            import werkzeug.test
+        except ImportError:
+            raise Skip('werkzeug is not installed')
+    kwargs = {'lightweight_invites': mode != 'werkzeug'}
+    if mode == 'concurrent':
+        kwargs['invite_workers'] = 8
+    paths = invites(apps)
+    if mode == 'lazy':
+        paths = [LazyInvite(path, ('url',)) for path in paths]
+    return lambda: WSGIParty(InviteApp(), paths, **kwargs)
+
+
+@benchmark('wsgi_call', wrapped=False)
+@benchmark('wsgi_call', wrapped=True)
+@benchmark('wsgi_call', wrapped='finalized')
+@benchmark('wsgi_call', wrapped='request_timeout')
+def bench_wsgi_call(wrapped):
+    """Call the bare application, or the same application through a party,
+    as is, finalized or with per-request deadlines."""
+    app = hello_app
+    if wrapped == 'finalized':
+        app = WSGIParty(app).finalize()
+    elif wrapped == 'request_timeout':
+        app = WSGIParty(app, request_timeout=1.0)
+    elif wrapped:
+        app = WSGIParty(app)
+    environ = make_environ('/')
+    return lambda: app(environ, start_response)
+
+
+@benchmark('url_for_e2e', framework='flask')
+def bench_flask_url_for(framework):
+    """Render the Flask example's root page, building two remote URLs."""
+    sys.path.insert(0, os.path.join(HERE, 'examples', 'flask'))
+    try:
+        import flask_party
+    except Exception as e:
+        raise Skip('Flask example unavailable: %s: %s' %
+                   (e.__class__.__name__, e))
+    finally:
+        sys.path.pop(0)
+    application = flask_party.application
+    return lambda: run_app(application, make_environ('/'))
+
+
+@benchmark('url_for_e2e', framework='pyramid')
+def bench_pyramid_url_for(framework):
+    """Render a page of the Pyramid example, asking for remote URLs."""
+    sys.path.insert(0, os.path.join(HERE, 'examples', 'pyramid'))
+    try:
+        from pyramid.config import Configurator
+        from pyramid.wsgi import wsgiapp2
+        import url_example
+    except Exception as e:
+        raise Skip('Pyramid example unavailable: %s: %s' %
+                   (e.__class__.__name__, e))
+    finally:
+        sys.path.pop(0)
+    config = Configurator()
+    config.include(url_example.appinclude)
+    config.add_route('one', '/one*subpath')
+    config.add_route('two', '/two*subpath')
+    config.add_view(wsgiapp2(url_example.app()), route_name='one')
+    config.add_view(wsgiapp2(url_example.app()), route_name='two')
+    application = WSGIParty(config.make_wsgi_app(),
+                            ('/__invite__', '/one/__invite__',
+                             '/two/__invite__'))
+    return lambda: run_app(application, make_environ('/'))
+
+
+class TenantApp(object):
+    """Application connecting bound methods, with some state of its own."""
+
+    def __init__(self, index, services):
+        self.index = index
+        self.services = services
+        self.state = [object() for i in range(100)]
+
+    def __call__(self, environ, start_response):
+        partyline = environ.get('partyline')
+        if partyline is not None:
+            for service_name in self.services:
+                partyline.connect(service_name, self.handler)
+        return hello_app(environ, start_response)
+
+    def handler(self, payload):
+        return self.index
+
+
+@footprint('registry', handlers=5000, services=10, weak=False,
+           released=False)
+@footprint('registry', handlers=5000, services=10, weak=True,
+           released=False)
+@footprint('registry', handlers=5000, services=10, weak=False,
+           released=True)
+@footprint('registry', handlers=5000, services=10, weak=True,
+           released=True)
+def footprint_registry(handlers, services, weak, released):
+    """Connect bound methods of many applications, one per service each.
+
+    With ``released``, the applications are dropped afterwards, as on a
+    reload; a strong registry keeps them alive.
+    """
+    names = ['service%d' % i for i in range(services)]
+    party = WSGIParty(hello_app, weak_handlers=weak)
+    apps = [TenantApp(i, names) for i in range(handlers // services)]
+    for app in apps:
+        operator = party.operator_class(party)
+        party.operators.append(operator)
+        app(dict(make_environ('/'), partyline=operator), start_response)
+    if released:
+        del apps[:]
+    return party, apps
+
+
+def measure_memory(build, params):
+    """Return the bytes build(**params) still holds once it returns."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        built = build(**params)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del built
+    return held
+
+
+def measure(op, repeat, min_time):
+    """Time op, return seconds per call: min, median and mean of repeats."""
+    timer = timeit.Timer(op)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    times = sorted(t / number for t in timer.repeat(repeat, number))
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'mean': sum(times) / len(times), 'number': number,
+            'repeat': repeat}
+
+
+def run(selected=None, repeat=5, min_time=0.05, out=sys.stdout):
+    """Run the registered benchmarks and footprints, return the results
+    document."""
+    results = []
+    registered = ([('seconds', b) for b in BENCHMARKS] +
+                  [('bytes', f) for f in FOOTPRINTS])
+    for kind, (name, params, setup) in registered:
+        label = '%s(%s)' % (name, ', '.join('%s=%s' % item for item in
+                                            sorted(params.items())))
+        if selected and not any(s in label for s in selected):
+            continue
+        result = {'name': name, 'params': params, 'label': label}
+        try:
+            if kind == 'bytes':
+                result['bytes'] = measure_memory(setup, params)
+            else:
+                op = setup(**params)
+        except Skip as e:
+            result['skipped'] = str(e)
+            out.write('%-60s skipped: %s\n' % (label, e))
+            results.append(result)
+            continue
+        if kind == 'bytes':
+            out.write('%-60s %12.1f KiB\n' % (label, result['bytes'] / 1024.))
+        else:
+            try:
+                result['seconds'] = measure(op, repeat, min_time)
+            finally:
+                if hasattr(op, 'close'):
+                    op.close()
+            out.write('%-60s %12.2f us\n' %
+                      (label, result['seconds']['min'] * 1e6))
+        results.append(result)
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'results': results}
+
+
+def compare(baseline, current, out=sys.stdout):
+    """Print the ratio of current to baseline minimum times, per benchmark,
+    and of bytes held, per footprint."""
+    before = dict((r['label'], r) for r in baseline['results'])
+    for result in current['results']:
+        old = before.get(result['label'])
+        if old is None:
+            continue
+        if 'seconds' in result and 'seconds' in old:
+            ratio = result['seconds']['min'] / old['seconds']['min']
+        elif result.get('bytes') and old.get('bytes'):
+            ratio = result['bytes'] / float(old['bytes'])
+        else:
+            continue
+        out.write('%-60s %6.2fx\n' % (result['label'], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('select', nargs='*',
+                        help='only run benchmarks whose label contains this')
+    parser.add_argument('--json', metavar='PATH',
+                        help='write machine-readable results to PATH')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare against results saved with --json')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='seconds each repeat should take at least')
+    args = parser.parse_args(argv)
+    document = run(args.select, args.repeat, args.min_time)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), document)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ def party_invite(request):
     partyline = request.environ.get(key)
     registry.partyline = partyline
     registry.notify(PartylineInvitation(request, partyline))
-    request.response.body = 'OK'
+    request.response.body = b'OK'
     return request.response
 
 def includeme(config):
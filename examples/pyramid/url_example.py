@@ -31,7 +31,7 @@ def view(request):
         body = ''
         for url in urls:
             body += 'Please visit <a href="{0}">{0}</a><br/>'.format(url)
-    response.body = body
+    response.text = body
     return response
 
 BODY = """
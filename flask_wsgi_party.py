@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    Flask integration for wsgi_party, with a federated URL map.
+
+    :copyright: (c) 2012 by Ron DuPlain.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import itertools
+import threading
+
+from urllib.parse import quote
+
+from flask import abort, has_request_context, request
+from werkzeug.routing import Map, Submount
+
+from wsgi_party import WSGIParty
+
+
+#: Service name on which applications publish their URL rules.
+URL_RULES = 'url_rules'
+
+_serials = itertools.count(1)
+
+
+class PublishedRules(object):
+    """URL rules of an application, as published when it joined the party.
+
+    ``source`` identifies the publishing application, and ``prefix`` is its
+    mount point, the ``SCRIPT_NAME`` of its invitation.  ``rules`` are
+    unbound copies of its werkzeug rules.  Each time an application joins, it
+    publishes with a higher ``serial``.
+    """
+
+    __slots__ = ('source', 'serial', 'prefix', 'rules')
+
+    def __init__(self, source, serial, prefix, rules):
+        self.source = source
+        self.serial = serial
+        self.prefix = prefix
+        self.rules = rules
+
+    def __call__(self, payload):
+        return self
+
+
+class FederatedURLMap(object):
+    """Read-only werkzeug map of the URL rules other applications published.
+
+    Rules are mounted at their application's prefix, so that URLs of other
+    applications are built locally, without asking the partyline.  The map
+    is rebuilt when an application joins, or joins again, the party.
+    """
+
+    def __init__(self, partyline, service_name=URL_RULES):
+        #: Operator of the application building URLs.
+        self.partyline = partyline
+
+        #: Service name applications publish their rules on.
+        self.service_name = service_name
+
+        self._table = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    @property
+    def map(self):
+        """The combined :class:`~werkzeug.routing.Map`, current as of now."""
+        party = self.partyline.partyline
+        table = party.dispatch_table(self.service_name, self.partyline)
+        if table is not self._table:
+            with self._lock:
+                if table is not self._table:
+                    self._map = self.build_map()
+                    self._table = table
+        return self._map
+
+    def build_map(self):
+        """Ask for published rules, return a new combined map.
+
+        Only the latest rules of each application are used.  If applications
+        share an endpoint, the first to have joined builds it.
+        """
+        latest = {}
+        for published in self.partyline.ask_around(self.service_name, None):
+            known = latest.get(published.source)
+            if known is None or known.serial < published.serial:
+                latest[published.source] = published
+        mounts = sorted(latest.values(), key=lambda p: p.serial)
+        return Map([Submount(p.prefix, p.rules) for p in mounts])
+
+    def build(self, endpoint, values=None, script_name='',
+              server_name='localhost', url_scheme='http', method=None,
+              force_external=False):
+        """Build a URL of another application, or raise
+        :class:`~werkzeug.routing.BuildError`.
+
+        ``script_name`` is where the party is mounted, and ``server_name``
+        and ``url_scheme`` are used for external URLs.
+        """
+        adapter = self.map.bind(server_name, script_name=script_name,
+                                url_scheme=url_scheme)
+        return adapter.build(endpoint, values, method=method,
+                             force_external=force_external)
+
+
+class FlaskParty(object):
+    """Flask extension joining an application to a :class:`WSGIParty`.
+
+    On invitation, the application publishes its URL rules, and
+    :func:`flask.url_for` builds URLs of other partyline applications from
+    the :class:`FederatedURLMap` when the application has no such endpoint.
+    """
+
+    #: Class to use for the federated URL map.
+    url_map_class = FederatedURLMap
+
+    def __init__(self, app=None, invite_path='/__invite__/'):
+        #: Path the party invites the application at.
+        self.invite_path = invite_path
+
+        #: Partyline operator, once invited.
+        self.partyline = None
+
+        #: Mount point of the application, once invited.
+        self.prefix = None
+
+        #: :attr:`url_map_class` instance, once invited.
+        self.url_map = None
+
+        #: :class:`PublishedRules` connected on the last invitation, kept
+        #: here for parties holding handlers by weak reference.
+        self.published = None
+
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Add the invitation route and URL build error handler to app."""
+        self.app = app
+        app.add_url_rule(self.invite_path, endpoint='partyline',
+                         view_func=self.join_party)
+        app.url_build_error_handlers.append(self.build_url)
+        app.extensions['wsgi_party'] = self
+
+    def join_party(self):
+        """View answering invitations; not found at the HTTP level."""
+        partyline = request.environ.get(WSGIParty.partyline_key)
+        if partyline is None:
+            abort(404)
+        self.partyline = partyline
+        self.prefix = request.script_root
+        rules = [rule.empty() for rule in self.app.url_map.iter_rules()
+                 if rule.endpoint != 'partyline']
+        self.published = PublishedRules(self, next(_serials), self.prefix,
+                                        rules)
+        partyline.connect(URL_RULES, self.published)
+        self.url_map = self.url_map_class(partyline)
+        return 'ok'
+
+    def build_url(self, error, endpoint, values):
+        """Build a URL the application does not have from the federated map.
+
+        Called by :func:`flask.url_for` on :class:`BuildError`.
+        """
+        if self.url_map is None or not has_request_context():
+            return None
+        values = dict(values)
+        anchor = values.pop('_anchor', None)
+        method = values.pop('_method', None)
+        scheme = values.pop('_scheme', None) or request.scheme
+        external = values.pop('_external', False)
+        rv = self.url_map.build(endpoint, values,
+                                self.party_root(request.script_root),
+                                request.host, scheme, method, external)
+        if anchor is not None:
+            rv += '#' + quote(anchor, safe="%!#$&'()*+,/:;=?@")
+        return rv
+
+    def party_root(self, script_root):
+        """Return the party's script name, given the application's."""
+        prefix = self.prefix or ''
+        if script_root.endswith(prefix):
+            return script_root[:len(script_root) - len(prefix)]
+        return ''
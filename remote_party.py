@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+    Partyline transport reaching handlers of peer partylines on other hosts.
+
+    :copyright: (c) 2012 by Ron DuPlain.
+    :license: BSD, see LICENSE for more details.
+"""
+
+import json
+import socket
+import socketserver
+import struct
+import threading
+from http.client import HTTPConnection, HTTPException
+from urllib.parse import urlsplit
+
+from wsgi_party import (HighAndDry, ManyAnswers, NoSuchServiceName,
+                        PartylineException, PartylineOperator, WeakHandler)
+
+
+class RemoteError(PartylineException):
+    """Raised when a peer partyline cannot be reached or fails to answer."""
+
+
+def answer_asks(operator, asks):
+    """Answer a batch of ``[service_name, payload]`` asks for a peer.
+
+    Returns one result per ask, ``{'answers': [...]}`` or ``{'error': ...}``.
+    A service name without handlers has no answers.
+    """
+    results = []
+    for service_name, payload in asks:
+        try:
+            answers = operator.ask_around(service_name, payload)
+        except NoSuchServiceName:
+            answers = []
+        except Exception as e:
+            results.append({'error': '%s: %s' % (e.__class__.__name__, e)})
+            continue
+        results.append({'answers': answers})
+    return results
+
+
+def encode_results(results):
+    """Serialize results of :func:`answer_asks` as JSON bytes.
+
+    Answers which JSON cannot represent become errors of their own ask.
+    """
+    try:
+        return json.dumps({'results': results}).encode('utf-8')
+    except (TypeError, ValueError):
+        pass
+    checked = []
+    for result in results:
+        try:
+            json.dumps(result)
+        except (TypeError, ValueError) as e:
+            result = {'error': 'TypeError: %s' % (e,)}
+        checked.append(result)
+    return json.dumps({'results': checked}).encode('utf-8')
+
+
+class _RemoteHandlers(object):
+    """Contains every remote handler, see :class:`PeerOperator`."""
+
+    def __contains__(self, handler):
+        if isinstance(handler, WeakHandler):
+            handler = handler.handler
+        return isinstance(handler, RemoteHandler)
+
+    def add(self, handler):
+        raise PartylineException('Peers do not connect handlers.')
+
+
+class PeerOperator(PartylineOperator):
+    """Operator answering asks from peers with local handlers only.
+
+    Remote handlers are skipped, so asks do not bounce between partylines.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, partyline):
+        super(PeerOperator, self).__init__(partyline)
+        self.handlers = _RemoteHandlers()
+
+
+class _Pending(object):
+    """An ask waiting for its round trip to a peer."""
+
+    __slots__ = ('ask', 'result', 'done')
+
+    def __init__(self, service_name, payload):
+        # Encode right away, so that a payload JSON cannot represent fails
+        # its own ask, not the batch it would be packed into.
+        self.ask = json.dumps([service_name, payload])
+        self.result = None
+        self.done = threading.Event()
+
+
+class Transport(object):
+    """Base class for sending asks to a peer partyline.
+
+    Connections are kept open and reused, at most ``pool_size`` at a time.
+    Asks made while every connection is busy are packed together, up to
+    ``max_batch`` per round trip.  Subclasses implement :meth:`open` and
+    :meth:`exchange`.
+    """
+
+    def __init__(self, pool_size=2, max_batch=256, timeout=5.0):
+        #: Maximum number of connections, and thus concurrent round trips.
+        self.pool_size = pool_size
+
+        #: Maximum number of asks packed into one round trip.
+        self.max_batch = max_batch
+
+        #: Socket timeout in seconds.
+        self.timeout = timeout
+
+        #: Counters of round trips and of asks sent, for tuning.
+        self.round_trips = 0
+        self.asks_sent = 0
+
+        self._lock = threading.Lock()
+        self._queue = []
+        self._busy = 0
+        self._idle = []
+
+    def open(self):
+        """Return a new connection to the peer."""
+        raise NotImplementedError
+
+    def exchange(self, connection, data):
+        """Send request bytes over connection, return response bytes."""
+        raise NotImplementedError
+
+    def close_connection(self, connection):
+        """Close a connection which failed or is no longer needed."""
+        connection.close()
+
+    def close(self):
+        """Close idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self.close_connection(connection)
+
+    def ask(self, service_name, payload):
+        """Ask the peer, return its list of answers."""
+        return self.ask_many([(service_name, payload)])[0]
+
+    def ask_many(self, asks):
+        """Ask the peer several ``(service_name, payload)`` asks at once.
+
+        Returns a list of answer lists, one per ask.  Raises
+        :class:`RemoteError` if the peer fails.
+        """
+        pending = [_Pending(service_name, payload)
+                   for service_name, payload in asks]
+        with self._lock:
+            self._queue.extend(pending)
+        self._drain()
+        answers = []
+        for each in pending:
+            each.done.wait()
+            if isinstance(each.result, Exception):
+                raise each.result
+            answers.append(each.result)
+        return answers
+
+    def _drain(self):
+        # Send queued asks while a connection is free.  A caller finding
+        # every connection busy leaves its asks queued; the busy callers
+        # check the queue again when their round trip completes.
+        while True:
+            with self._lock:
+                if not self._queue or self._busy >= self.pool_size:
+                    return
+                self._busy += 1
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+            try:
+                self._round_trip(batch)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+
+    def _round_trip(self, batch):
+        try:
+            try:
+                asks = ', '.join(each.ask for each in batch)
+                data = '{"asks": [%s]}' % asks
+                response = self._send(data.encode('utf-8'))
+                results = json.loads(response.decode('utf-8'))['results']
+                if len(results) != len(batch):
+                    raise ValueError('%d results for %d asks.' %
+                                     (len(results), len(batch)))
+            except Exception as e:
+                error = e
+                if not isinstance(e, RemoteError):
+                    error = RemoteError('Peer failed: %s' % (e,))
+                for each in batch:
+                    each.result = error
+                return
+            self.round_trips += 1
+            self.asks_sent += len(batch)
+            for each, result in zip(batch, results):
+                if 'error' in result:
+                    each.result = RemoteError(result['error'])
+                else:
+                    each.result = result['answers']
+        finally:
+            for each in batch:
+                each.done.set()
+
+    def _send(self, data):
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None:
+            try:
+                return self._exchange(connection, data)
+            except (socket.error, EOFError, HTTPException):
+                # The peer may have closed an idle connection; retry once.
+                pass
+        return self._exchange(self.open(), data)
+
+    def _exchange(self, connection, data):
+        try:
+            response = self.exchange(connection, data)
+        except Exception:
+            self.close_connection(connection)
+            raise
+        self._release(connection)
+        return response
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+
+def _send_frame(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError('Connection closed by peer.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_frame(sock, max_size):
+    size, = struct.unpack('!I', _recv_exactly(sock, 4))
+    if size > max_size:
+        raise RemoteError('Frame of %d bytes exceeds %d.' % (size, max_size))
+    return _recv_exactly(sock, size)
+
+
+#: Largest frame accepted over TCP, in bytes.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class TCPTransport(Transport):
+    """Send asks to a :class:`PartylineServer` over raw TCP.
+
+    Requests and responses are JSON documents, each prefixed with its length.
+    """
+
+    def __init__(self, host, port, **kwargs):
+        super(TCPTransport, self).__init__(**kwargs)
+        self.address = (host, port)
+
+    def open(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def exchange(self, connection, data):
+        _send_frame(connection, data)
+        return _recv_frame(connection, MAX_FRAME_SIZE)
+
+
+class HTTPTransport(Transport):
+    """Send asks to a :class:`PartylineEndpoint` mounted at the given URL.
+
+    Connections use HTTP/1.1 keep-alive where the peer's server supports it.
+    """
+
+    def __init__(self, url, **kwargs):
+        super(HTTPTransport, self).__init__(**kwargs)
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+
+    def open(self):
+        return HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def exchange(self, connection, data):
+        connection.request('POST', self.path, data,
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RemoteError('Peer responded %d %s.' %
+                              (response.status, response.reason))
+        return body
+
+
+class RemoteHandler(object):
+    """Handler asking a peer partyline through a :class:`Transport`.
+
+    Connect one per service name the peer serves; all of the peer's answers
+    are merged into the local ask.  Concurrent asks share round trips, and
+    :meth:`~wsgi_party.WSGIParty.ask_around_many` sends its whole batch in
+    one.
+
+    Remote handlers cannot be weakly referenced, so a party with
+    weak_handlers=True holds them strongly: nothing else keeps them alive.
+    """
+
+    __slots__ = ('transport', 'service_name')
+
+    def __init__(self, transport, service_name):
+        self.transport = transport
+        self.service_name = service_name
+
+    def __call__(self, payload):
+        answers = self.transport.ask(self.service_name, payload)
+        if not answers:
+            raise HighAndDry()
+        return ManyAnswers(answers)
+
+    def answer_many(self, payloads):
+        """Ask the peer about all payloads in one round trip."""
+        asks = [(self.service_name, payload) for payload in payloads]
+        return [ManyAnswers(answers) if answers else HighAndDry
+                for answers in self.transport.ask_many(asks)]
+
+
+def connect_peer(partyline, transport, service_names):
+    """Connect remote handlers for a peer serving the given service names.
+
+    The partyline may be a :class:`~wsgi_party.WSGIParty` or an operator.
+    """
+    for service_name in service_names:
+        partyline.connect(service_name, RemoteHandler(transport, service_name))
+
+
+class _TCPRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                data = _recv_frame(sock, MAX_FRAME_SIZE)
+            except (EOFError, socket.error, RemoteError):
+                return
+            asks = json.loads(data.decode('utf-8'))['asks']
+            results = answer_asks(self.server.operator, asks)
+            _send_frame(sock, encode_results(results))
+
+
+class PartylineServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Serve a partyline's local handlers to peers over raw TCP.
+
+    Each connection is kept open for as many round trips as the peer sends.
+    Use port 0 to pick a free port, see ``server_address``.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, partyline, address=('127.0.0.1', 0)):
+        socketserver.TCPServer.__init__(self, address, _TCPRequestHandler)
+        self.operator = PeerOperator(partyline)
+
+    def serve_in_thread(self, poll_interval=0.5):
+        """Start serving from a daemon thread, return the thread."""
+        thread = threading.Thread(target=self.serve_forever,
+                                  args=(poll_interval,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class PartylineEndpoint(object):
+    """WSGI application serving a partyline's local handlers to peers.
+
+    Mount it in the dispatcher, e.g. at ``/__partyline__``, and point an
+    :class:`HTTPTransport` at it.
+    """
+
+    def __init__(self, partyline):
+        self.operator = PeerOperator(partyline)
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'POST':
+            start_response('405 Method Not Allowed', [('Allow', 'POST')])
+            return [b'']
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            data = environ['wsgi.input'].read(length)
+            asks = json.loads(data.decode('utf-8'))['asks']
+        except (ValueError, KeyError):
+            start_response('400 Bad Request', [('Content-Length', '0')])
+            return [b'']
+        body = encode_results(answer_asks(self.operator, asks))
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
@@ -9,10 +9,13 @@ setup(
     author_email='ron.duplain@gmail.com',
     description='A partyline middleware for WSGI with good intentions.',
     long_description=open('README.rst').read(),
-    py_modules=['wsgi_party'],
+    py_modules=['wsgi_party', 'asgi_party', 'remote_party',
+                'flask_wsgi_party'],
+    extras_require={'flask': ['Flask']},
     include_package_data=True,
     zip_safe=False,
     platforms='any',
+    python_requires='>=3.7',
     install_requires=[
         # Werkzeug is convenient to get us started. Could potentially remove.
         'Werkzeug',
@@ -25,9 +28,13 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.5',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
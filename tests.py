@@ -14,6 +14,12 @@ class TestPartylineOperator(unittest.TestCase):
         self.assertEqual(inst.handlers, set(['handler']))
         self.assertEqual(result, '123')
 
+    def test_connect_keys(self):
+        partyline = DummyPartyline()
+        inst = self._makeOne(partyline)
+        inst.connect('name', 'handler', keys=['a'])
+        self.assertEqual(partyline.connect_options, [{'keys': ['a']}])
+
     def test_ask_around(self):
         partyline = DummyPartyline(ask_response=['abc'])
         inst = self._makeOne(partyline)
@@ -21,11 +27,43 @@ class TestPartylineOperator(unittest.TestCase):
         self.assertEqual(partyline.asked, [('name', 'payload', inst)])
         self.assertEqual(result, ['abc'])
 
+    def test_iter_answers(self):
+        partyline = DummyPartyline(ask_response=['abc', 'def'])
+        inst = self._makeOne(partyline)
+        result = inst.iter_answers('name', 'payload')
+        self.assertEqual(list(result), ['abc', 'def'])
+        self.assertEqual(partyline.asked, [('name', 'payload', inst)])
+
+    def test_ask_first(self):
+        partyline = DummyPartyline(ask_response=['abc', 'def'])
+        inst = self._makeOne(partyline)
+        self.assertEqual(inst.ask_first('name', 'payload'), 'abc')
+        self.assertEqual(partyline.asked, [('name', 'payload', inst)])
+
+    def test_ask_around_many(self):
+        partyline = DummyPartyline(ask_response=['abc'])
+        inst = self._makeOne(partyline)
+        result = inst.ask_around_many('name', ['payload1', 'payload2'])
+        self.assertEqual(partyline.asked, [('name', 'payload1', inst),
+                                           ('name', 'payload2', inst)])
+        self.assertEqual(result, [['abc'], ['abc']])
+
+    def test_ask_first_default(self):
+        partyline = DummyPartyline(ask_response=[])
+        inst = self._makeOne(partyline)
+        self.assertEqual(inst.ask_first('name', 'payload', 'nope'), 'nope')
+
+    def test_announce(self):
+        partyline = DummyPartyline()
+        inst = self._makeOne(partyline)
+        self.assertTrue(inst.announce('name', 'payload'))
+        self.assertEqual(partyline.asked, [('name', 'payload', inst)])
+
 
 class TestWSGIParty(unittest.TestCase):
-    def _makeOne(self, app, invites=(), ignore_missing_services=False):
+    def _makeOne(self, app, invites=(), ignore_missing_services=False, **kw):
         from wsgi_party import WSGIParty
-        return WSGIParty(app, invites, ignore_missing_services)
+        return WSGIParty(app, invites, ignore_missing_services, **kw)
 
     def test_ctor_calls_send_invitations(self):
         app = DummyWSGIApp()
@@ -55,18 +93,194 @@ class TestWSGIParty(unittest.TestCase):
         self.assertEqual(environ2[inst.partyline_key].__class__,
                          inst.operator_class)
 
+    def test_send_invitations_lightweight(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, lightweight_invites=True)
+        inst.send_invitations(('/__invite__', '/another/__invite__'))
+        environ1, environ2 = app.environs
+        self.assertEqual(environ1['PATH_INFO'], '/__invite__')
+        self.assertEqual(environ1['REQUEST_METHOD'], 'GET')
+        self.assertEqual(environ1[inst.partyline_key], inst.operators[0])
+        self.assertEqual(environ2['PATH_INFO'], '/another/__invite__')
+        self.assertEqual(environ2[inst.partyline_key], inst.operators[1])
+
+    def test_lightweight_invites_do_not_import_werkzeug(self):
+        import os
+        import subprocess
+        import sys
+        code = ('import sys, wsgi_party\n'
+                'def app(environ, start_response):\n'
+                '    start_response("404 Not Found", [])\n'
+                '    return []\n'
+                'wsgi_party.WSGIParty(app, ["/__invite__"], '
+                'lightweight_invites=True)\n'
+                'assert "werkzeug" not in sys.modules\n')
+        subprocess.check_call([sys.executable, '-c', code],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_send_invitations_concurrently(self):
+        import threading
+        barrier = threading.Barrier(2, timeout=5)
+        class App(DummyWSGIApp):
+            def __call__(self, environ, start_response):
+                barrier.wait()
+                environ['partyline'].connect('ping', environ['PATH_INFO'])
+                return DummyWSGIApp.__call__(self, environ, start_response)
+        app = App()
+        inst = self._makeOne(app, ('/one/', '/two/'), invite_workers=2,
+                             lightweight_invites=True)
+        self.assertEqual(sorted(inst.handlers['ping']), ['/one/', '/two/'])
+        self.assertEqual([o.handlers for o in inst.operators],
+                         [set(['/one/']), set(['/two/'])])
+
+    def test_invite_timings(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, ('/one/', '/two/'))
+        self.assertEqual(list(inst.invite_timings), ['/one/', '/two/'])
+        for seconds in inst.invite_timings.values():
+            self.assertTrue(seconds >= 0)
+
+    def test_lazy_invite(self):
+        from wsgi_party import LazyInvite
+        app = DummyPartylineApp('url', lambda payload: 'url')
+        inst = self._makeOne(app, (LazyInvite('/lazy/', ('url', 'ping')),))
+        self.assertEqual(inst.operators, [])
+        self.assertEqual(sorted(inst.lazy_invites), ['ping', 'url'])
+        self.assertEqual(inst.ask_around('url', None), ['url'])
+        self.assertEqual(len(inst.operators), 1)
+        self.assertEqual(inst.lazy_invites, {})
+        self.assertEqual(list(inst.invite_timings), ['/lazy/'])
+        inst.ask_around('url', None)
+        self.assertEqual(len(inst.operators), 1)
+
+    def test_lazy_invite_retried_after_error(self):
+        from wsgi_party import LazyInvite
+        fail = [True]
+        class App(DummyWSGIApp):
+            def __call__(self, environ, start_response):
+                environ['partyline'].connect('url', lambda payload: 'url')
+                if fail[0]:
+                    raise ValueError('not ready')
+                return DummyWSGIApp.__call__(self, environ, start_response)
+        app = App()
+        inst = self._makeOne(app, (LazyInvite('/lazy/', ('url',)),))
+        self.assertRaises(ValueError, inst.ask_around, 'url', None)
+        self.assertEqual(inst.operators, [])
+        self.assertEqual(list(inst.lazy_invites), ['url'])
+        fail[0] = False
+        self.assertEqual(inst.ask_around('url', None), ['url'])
+        self.assertEqual(len(inst.operators), 1)
+        self.assertEqual(inst.lazy_invites, {})
+
+    def test_lazy_invite_not_sent_for_other_services(self):
+        from wsgi_party import LazyInvite
+        app = DummyPartylineApp('url', lambda payload: 'url')
+        inst = self._makeOne(app, ('/eager/', LazyInvite('/lazy/', ('url',))),
+                             ignore_missing_services=True)
+        inst.connect('ping', lambda payload: 'pong')
+        self.assertEqual(inst.ask_around('ping', None), ['pong'])
+        self.assertEqual(list(inst.invite_timings), ['/eager/'])
+        self.assertEqual(inst.ask_around('other', None), [])
+        self.assertEqual(list(inst.invite_timings), ['/eager/'])
+
+    def test_lazy_invite_app_asks_while_joining(self):
+        from wsgi_party import LazyInvite
+        class App(DummyWSGIApp):
+            def __call__(self, environ, start_response):
+                partyline = environ['partyline']
+                partyline.connect('url', lambda payload: 'url')
+                self.asked = partyline.ask_around('url', None)
+                return DummyWSGIApp.__call__(self, environ, start_response)
+        app = App()
+        inst = self._makeOne(app, (LazyInvite('/lazy/', ('url',)),))
+        self.assertEqual(inst.ask_around('url', None), ['url'])
+        self.assertEqual(app.asked, [])
+        self.assertEqual(len(app.environs), 1)
+
+    def test_lazy_invite_concurrent_first_asks(self):
+        import threading
+        from wsgi_party import LazyInvite
+        joining = threading.Event()
+        proceed = threading.Event()
+        class App(DummyWSGIApp):
+            def __call__(self, environ, start_response):
+                joining.set()
+                proceed.wait(5)
+                environ['partyline'].connect('url', lambda payload: 'url')
+                return DummyWSGIApp.__call__(self, environ, start_response)
+        app = App()
+        inst = self._makeOne(app, (LazyInvite('/lazy/', ('url',)),))
+        results = []
+        def ask():
+            results.append(inst.ask_around('url', None))
+        first = threading.Thread(target=ask)
+        first.start()
+        joining.wait(5)
+        second = threading.Thread(target=ask)
+        second.start()
+        proceed.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(results, [['url'], ['url']])
+        self.assertEqual(len(app.environs), 1)
+
+    def test_freeze_sends_lazy_invitations(self):
+        from wsgi_party import LazyInvite
+        app = DummyPartylineApp('url', lambda payload: 'url')
+        inst = self._makeOne(app, (LazyInvite('/lazy/', ('url',)),))
+        inst.freeze(gc_freeze=False)
+        self.assertEqual(inst.lazy_invites, {})
+        self.assertEqual(inst.ask_around('url', None), ['url'])
+
     def test_connect_to_nonexisting(self):
         app = DummyWSGIApp()
         inst = self._makeOne(app)
         inst.connect('service_name', 'handler')
-        self.assertEqual(inst.handlers['service_name'], ['handler'])
+        self.assertEqual(inst.handlers['service_name'], ('handler',))
 
     def test_connect_to_existing(self):
         app = DummyWSGIApp()
         inst = self._makeOne(app)
         inst.handlers['service_name'] = ['abc']
         inst.connect('service_name', 'handler')
-        self.assertEqual(inst.handlers['service_name'], ['abc', 'handler'])
+        self.assertEqual(inst.handlers['service_name'], ('abc', 'handler'))
+
+    def test_connect_swaps_registry(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', 'handler1')
+        handlers = inst.handlers
+        table = inst.dispatch_table('service_name')
+        inst.connect('service_name', 'handler2')
+        self.assertEqual(handlers, {'service_name': ('handler1',)})
+        self.assertEqual(table, ('handler1',))
+        self.assertEqual(inst.handlers['service_name'],
+                         ('handler1', 'handler2'))
+        self.assertEqual(inst.dispatch_table('service_name'),
+                         ('handler1', 'handler2'))
+
+    def test_connect_while_asking(self):
+        import threading
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 0)
+        errors = []
+        done = threading.Event()
+        def ask():
+            while not done.is_set():
+                answers = inst.ask_around('service_name', None)
+                if answers != list(range(len(answers))):
+                    errors.append(answers)
+        threads = [threading.Thread(target=ask) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(1, 200):
+            inst.connect('service_name', lambda payload, i=i: i)
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(inst.ask_around('service_name', None)), 200)
 
     def test_ask_around_other_operator(self):
         operator = DummyOperator()
@@ -133,6 +347,1110 @@ class TestWSGIParty(unittest.TestCase):
         self.assertEqual(L, ['payload', 'payload'])
         self.assertEqual(result, ['result'])
 
+    def test_dispatch_table_skips_operator_handlers(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        operator = DummyOperator(('handler1',))
+        inst.handlers['service_name'] = ['handler1', 'handler2']
+        self.assertEqual(inst.dispatch_table('service_name'),
+                         ('handler1', 'handler2'))
+        self.assertEqual(inst.dispatch_table('service_name', operator),
+                         ('handler2',))
+
+    def test_dispatch_table_is_reused(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        operator = DummyOperator()
+        inst.connect('service_name', 'handler')
+        table = inst.dispatch_table('service_name', operator)
+        self.assertTrue(inst.dispatch_table('service_name', operator) is table)
+
+    def test_connect_invalidates_dispatch_table(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 'result')
+        inst.connect('other', lambda payload: 'other')
+        self.assertEqual(inst.ask_around('service_name', None), ['result'])
+        self.assertEqual(inst.ask_around('other', None), ['other'])
+        inst.connect('service_name', lambda payload: 'result2')
+        self.assertEqual(inst.ask_around('service_name', None),
+                         ['result', 'result2'])
+        self.assertTrue('other' in inst.dispatch_tables)
+
+    def test_iter_answers_is_lazy(self):
+        from wsgi_party import HighAndDry
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        def handler1(payload):
+            L.append('handler1')
+            raise HighAndDry()
+        def handler2(payload):
+            L.append('handler2')
+            return 'result2'
+        def handler3(payload):
+            L.append('handler3')
+            return 'result3'
+        inst.handlers['service_name'] = [handler1, handler2, handler3]
+        answers = inst.iter_answers('service_name', 'payload')
+        self.assertEqual(L, [])
+        self.assertEqual(next(answers), 'result2')
+        self.assertEqual(L, ['handler1', 'handler2'])
+        self.assertEqual(list(answers), ['result3'])
+
+    def test_iter_answers_no_handler(self):
+        from wsgi_party import NoSuchServiceName
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        self.assertRaises(NoSuchServiceName, inst.iter_answers, 'unlucky',
+                          None)
+
+    def test_ask_first_stops_after_answer(self):
+        operator = DummyOperator()
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        def handler1(payload):
+            L.append(payload)
+            return 'result'
+        def handler2(payload):
+            L.append(payload)
+            return 'result2'
+        inst.handlers['service_name'] = [handler1, handler2]
+        result = inst.ask_first('service_name', 'payload', operator=operator)
+        self.assertEqual(L, ['payload'])
+        self.assertEqual(result, 'result')
+
+    def test_ask_first_default(self):
+        from wsgi_party import HighAndDry
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        def handler(payload):
+            raise HighAndDry()
+        inst.connect('service_name', handler)
+        self.assertEqual(inst.ask_first('service_name', None), None)
+        self.assertEqual(inst.ask_first('service_name', None, 'x'), 'x')
+
+    def test_ask_around_cached(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        def handler(payload):
+            L.append(payload)
+            return payload['name']
+        inst.connect('url', handler)
+        cache = inst.cache_answers('url')
+        self.assertEqual(inst.ask_around('url', {'name': 'home'}), ['home'])
+        self.assertEqual(inst.ask_around('url', {'name': 'home'}), ['home'])
+        self.assertEqual(inst.ask_around('url', {'name': 'away'}), ['away'])
+        self.assertEqual(len(L), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_ask_around_cached_unhashable_payload(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('url', lambda payload: bytes(payload))
+        cache = inst.cache_answers('url')
+        self.assertEqual(inst.ask_around('url', bytearray(b'home')),
+                         [b'home'])
+        self.assertEqual(inst.ask_around_many('url', [bytearray(b'home'),
+                                                      b'away']),
+                         [[b'home'], [b'away']])
+        self.assertEqual(len(cache), 1)
+
+    def test_ask_around_cached_per_operator(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        def handler(payload):
+            return 'result'
+        inst.connect('service_name', handler)
+        inst.cache_answers('service_name')
+        operator = DummyOperator((handler,))
+        self.assertEqual(inst.ask_around('service_name', None), ['result'])
+        self.assertEqual(inst.ask_around('service_name', None, operator), [])
+
+    def test_connect_invalidates_cache(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 'result')
+        cache = inst.cache_answers('service_name')
+        inst.ask_around('service_name', None)
+        inst.connect('service_name', lambda payload: 'result2')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(inst.ask_around('service_name', None),
+                         ['result', 'result2'])
+
+    def _url_handlers(self, inst, calls):
+        from wsgi_party import HighAndDry
+        def make_handler(owned):
+            def handler(payload):
+                calls.append(owned)
+                if payload != owned:
+                    raise HighAndDry()
+                return '/%s' % owned
+            return handler
+        for owned in ('a', 'b', 'c'):
+            inst.connect('url', make_handler(owned))
+
+    def test_route_by_affinity(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._url_handlers(inst, calls)
+        affinity = inst.route_by_affinity('url')
+        self.assertEqual(inst.ask_around('url', 'c'), ['/c'])
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        del calls[:]
+        self.assertEqual(inst.ask_around('url', 'c'), ['/c'])
+        self.assertEqual(inst.ask_first('url', 'c'), '/c')
+        self.assertEqual(calls, ['c', 'c'])
+        self.assertEqual((affinity.hits, affinity.misses), (2, 1))
+
+    def test_route_by_affinity_miss_scans(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._url_handlers(inst, calls)
+        affinity = inst.route_by_affinity('url')
+        self.assertEqual(inst.ask_around('url', 'x'), [])
+        self.assertEqual(inst.ask_around('url', 'x'), [])
+        self.assertEqual(len(calls), 6)
+        self.assertEqual(len(affinity), 0)
+
+    def test_route_by_affinity_forgets_stale_handler(self):
+        from wsgi_party import HighAndDry
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        owner = ['first']
+        def first(payload):
+            if owner[0] != 'first':
+                raise HighAndDry()
+            return 'first'
+        def second(payload):
+            if owner[0] != 'second':
+                raise HighAndDry()
+            return 'second'
+        inst.connect('service_name', first)
+        inst.connect('service_name', second)
+        affinity = inst.route_by_affinity('service_name')
+        self.assertEqual(inst.ask_around('service_name', None), ['first'])
+        owner[0] = 'second'
+        self.assertEqual(inst.ask_around('service_name', None), ['second'])
+        self.assertEqual(affinity.stale, 1)
+        self.assertEqual(inst.ask_around('service_name', None), ['second'])
+        self.assertEqual(affinity.hits, 2)
+
+    def test_route_by_affinity_learns_sole_answer_only(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 1)
+        inst.connect('service_name', lambda payload: 2)
+        affinity = inst.route_by_affinity('service_name')
+        self.assertEqual(inst.ask_around('service_name', None), [1, 2])
+        self.assertEqual(len(affinity), 0)
+        self.assertEqual(inst.ask_around('service_name', None, quorum=1), [1])
+        self.assertEqual(len(affinity), 1)
+
+    def test_route_by_affinity_ask_first_then_around(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 'a')
+        inst.connect('service_name', lambda payload: 'b')
+        inst.route_by_affinity('service_name')
+        self.assertEqual(inst.ask_first('service_name', None), 'a')
+        self.assertEqual(inst.ask_around('service_name', None), ['a', 'b'])
+        self.assertEqual(inst.ask_first('service_name', None), 'a')
+
+    def test_route_by_affinity_unhashable_payload(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('url', lambda payload: bytes(payload[1]))
+        affinity = inst.route_by_affinity('url')
+        payload = ('e', bytearray(b'home'))
+        self.assertEqual(inst.ask_around('url', payload), [b'home'])
+        self.assertEqual(inst.ask_first('url', payload), b'home')
+        self.assertEqual(len(affinity), 0)
+
+    def test_route_by_affinity_per_operator(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._url_handlers(inst, calls)
+        inst.route_by_affinity('url')
+        inst.ask_around('url', 'a')
+        operator = DummyOperator((inst.handlers['url'][0],))
+        self.assertEqual(inst.ask_around('url', 'a', operator), [])
+
+    def _keyed_handlers(self, inst, calls):
+        def make_handler(name):
+            def handler(payload):
+                calls.append(name)
+                return '/%s/%s' % (name, payload[0])
+            return handler
+        endpoint = lambda payload: payload[0]
+        inst.connect('url', make_handler('a'), keys=['a:index', 'a:page'],
+                     key=endpoint)
+        inst.connect('url', make_handler('b'), keys=['b:index'], key=endpoint)
+        return make_handler
+
+    def test_connect_keys(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._keyed_handlers(inst, calls)
+        self.assertEqual(inst.ask_around('url', ('b:index', {})),
+                         ['/b/b:index'])
+        self.assertEqual(inst.ask_first('url', ('a:page', {})), '/a/a:page')
+        self.assertEqual(inst.ask_around('url', ('c:index', {})), [])
+        self.assertEqual(calls, ['b', 'a'])
+
+    def test_connect_keys_with_undeclared_handler(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        make_handler = self._keyed_handlers(inst, calls)
+        inst.connect('url', make_handler('scan'))
+        self.assertEqual(inst.ask_around('url', ('a:index', {})),
+                         ['/a/a:index', '/scan/a:index'])
+        self.assertEqual(list(inst.iter_answers('url', ('c:index', {}))),
+                         ['/scan/c:index'])
+        self.assertEqual(calls, ['a', 'scan', 'scan'])
+
+    def test_connect_keys_unhashable_key(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._keyed_handlers(inst, calls)
+        payload = (bytearray(b'a:index'), {})
+        self.assertEqual(inst.ask_around('url', payload),
+                         ["/a/bytearray(b'a:index')",
+                          "/b/bytearray(b'a:index')"])
+        self.assertEqual(len(list(inst.iter_answers('url', payload))), 2)
+        self.assertEqual(len(inst.ask_around_many('url', [payload])[0]), 2)
+        self.assertEqual(inst.deliver_announcement('url', payload), 0)
+        self.assertEqual(calls, ['a', 'b'] * 4)
+
+    def test_connect_keys_skips_own_handlers(self):
+        from wsgi_party import PartylineOperator
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        operator = PartylineOperator(inst)
+        operator.connect('url', lambda payload: 'own', keys=['a'])
+        inst.connect('url', lambda payload: 'other', keys=['a'])
+        self.assertEqual(operator.ask_around('url', 'a'), ['other'])
+        self.assertEqual(inst.ask_around('url', 'a'), ['own', 'other'])
+
+    def test_connect_keys_ask_around_many(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._keyed_handlers(inst, calls)
+        result = inst.ask_around_many('url', [('a:index', {}),
+                                              ('b:index', {}),
+                                              ('c:index', {})])
+        self.assertEqual(result, [['/a/a:index'], ['/b/b:index'], []])
+        self.assertEqual(calls, ['a', 'b'])
+
+    def test_connect_conflicting_key_function(self):
+        from wsgi_party import PartylineException
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('url', lambda payload: 1, keys=['a'], key=len)
+        self.assertRaises(PartylineException, inst.connect, 'url',
+                          lambda payload: 2, keys=['b'], key=repr)
+
+    def test_connect_invalidates_affinity(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        calls = []
+        self._url_handlers(inst, calls)
+        affinity = inst.route_by_affinity('url')
+        inst.ask_around('url', 'a')
+        inst.connect('url', lambda payload: '/a2')
+        self.assertEqual(len(affinity), 0)
+        self.assertEqual(inst.ask_around('url', 'a'), ['/a', '/a2'])
+
+    def test_ask_around_quorum(self):
+        from wsgi_party import HighAndDry
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        def handler1(payload):
+            L.append('handler1')
+            raise HighAndDry()
+        def handler2(payload):
+            L.append('handler2')
+            return 'result2'
+        def handler3(payload):
+            L.append('handler3')
+            return 'result3'
+        inst.handlers['service_name'] = [handler1, handler2, handler3]
+        result = inst.ask_around('service_name', None, quorum=1)
+        self.assertEqual(result, ['result2'])
+        self.assertEqual(L, ['handler1', 'handler2'])
+
+    def test_ask_around_executor_keeps_order(self):
+        import time
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=4)
+        self.addCleanup(inst.close)
+        def slow(payload):
+            time.sleep(0.05)
+            return 'slow'
+        def fast(payload):
+            return 'fast'
+        inst.handlers['service_name'] = [slow, fast]
+        self.assertEqual(inst.ask_around('service_name', None),
+                         ['slow', 'fast'])
+
+    def test_ask_around_executor_runs_concurrently(self):
+        import threading
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=2)
+        self.addCleanup(inst.close)
+        barrier = threading.Barrier(2, timeout=5)
+        def handler(payload):
+            barrier.wait()
+            return payload
+        inst.handlers['service_name'] = [handler, lambda p: handler(p + 1)]
+        self.assertEqual(inst.ask_around('service_name', 1), [1, 2])
+
+    def test_ask_around_executor_quorum_cancels(self):
+        from wsgi_party import HighAndDry
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.executor = DummyExecutor(run=2)
+        def dry(payload):
+            raise HighAndDry()
+        def first(payload):
+            return 'first'
+        def never(payload):
+            return 'never'
+        inst.handlers['service_name'] = [dry, first, never]
+        result = inst.ask_around('service_name', None, quorum=1)
+        self.assertEqual(result, ['first'])
+        self.assertEqual([f.cancelled() for f in inst.executor.futures],
+                         [False, False, True])
+
+    def test_ask_around_executor_propagates_exceptions(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=2)
+        self.addCleanup(inst.close)
+        def broken(payload):
+            raise ValueError(payload)
+        inst.handlers['service_name'] = [broken, lambda payload: 'ok']
+        self.assertRaises(ValueError, inst.ask_around, 'service_name', None)
+
+    def test_ask_around_executor_nested(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=2)
+        self.addCleanup(inst.close)
+        def outer(payload):
+            return inst.ask_around('inner', payload)
+        inst.connect('outer', outer)
+        inst.connect('outer', lambda payload: outer(payload + 1))
+        inst.connect('inner', lambda payload: payload)
+        inst.connect('inner', lambda payload: -payload)
+        self.assertEqual(inst.ask_around('outer', 1), [[1, -1], [2, -2]])
+
+    def test_deadline_skips_remaining_handlers(self):
+        import time
+        from wsgi_party import deadline
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        def slow(payload):
+            time.sleep(0.02)
+            L.append('slow')
+            return 'slow'
+        def late(payload):
+            L.append('late')
+            return 'late'
+        inst.connect('service_name', slow)
+        inst.connect('service_name', late)
+        with deadline(0.01):
+            self.assertEqual(inst.ask_around('service_name', None), ['slow'])
+        self.assertEqual(L, ['slow'])
+        self.assertEqual(inst.ask_around('service_name', None),
+                         ['slow', 'late'])
+
+    def test_deadline_not_cached(self):
+        from wsgi_party import deadline
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 'result')
+        cache = inst.cache_answers('service_name')
+        with deadline(0):
+            self.assertEqual(inst.ask_around('service_name', None), [])
+        self.assertEqual(len(cache), 0)
+
+    def test_deadline_executor(self):
+        import threading
+        from wsgi_party import deadline
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=2)
+        self.addCleanup(inst.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        def stuck(payload):
+            release.wait(5)
+            return 'stuck'
+        inst.connect('service_name', stuck)
+        inst.connect('service_name', lambda payload: 'fast')
+        with deadline(0.05):
+            self.assertEqual(inst.ask_around('service_name', None), ['fast'])
+
+    def test_deadline_executor_nested(self):
+        from wsgi_party import current_deadline, deadline, priority, _lane
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=2)
+        self.addCleanup(inst.close)
+        inst.connect('inner', lambda payload: (current_deadline(),
+                                               _lane.get()))
+        def outer(payload):
+            return inst.ask_first('inner', payload)
+        inst.connect('outer', outer)
+        inst.connect('outer', outer)
+        with deadline(5) as when, priority('bulk'):
+            self.assertEqual(inst.ask_around('outer', None),
+                             [(when, 'bulk'), (when, 'bulk')])
+
+    def test_request_timeout(self):
+        from wsgi_party import current_deadline
+        seen = []
+        def app(environ, start_response):
+            seen.append(current_deadline())
+            return []
+        inst = self._makeOne(app, request_timeout=1.0)
+        environ = {}
+        inst(environ, None)
+        self.assertEqual(seen, [environ[inst.deadline_key]])
+        self.assertEqual(current_deadline(), None)
+        inst({inst.deadline_key: 123.0}, None)
+        self.assertEqual(seen[1], 123.0)
+
+    def test_deadline_inherited_from_environ(self):
+        from wsgi_party import current_deadline
+        seen = []
+        def app(environ, start_response):
+            seen.append(current_deadline())
+            return []
+        inst = self._makeOne(app)
+        inst({inst.deadline_key: 123.0}, None)
+        inst({}, None)
+        self.assertEqual(seen, [123.0, None])
+
+    def test_request_memo(self):
+        from wsgi_party import PartylineOperator
+        calls = []
+        def handler(payload):
+            calls.append(payload)
+            return payload['name']
+        def app(environ, start_response):
+            for i in range(3):
+                operator.ask_around('url', {'name': 'home'})
+            operator.ask_first('url', {'name': 'home'})
+            environ['answers'] = operator.ask_around('url', {'name': 'away'})
+            return ['body']
+        inst = self._makeOne(app, request_memo=True)
+        operator = PartylineOperator(inst)
+        inst.connect('url', handler)
+        environ = {}
+        response = inst(environ, None)
+        self.assertEqual(list(response), ['body'])
+        self.assertEqual(environ['answers'], ['away'])
+        self.assertEqual(calls, [{'name': 'home'}, {'name': 'home'},
+                                 {'name': 'away'}])
+        self.assertEqual(len(environ[inst.memo_key]), 3)
+        response.close()
+        self.assertEqual(environ[inst.memo_key], {})
+        inst({}, None)
+        self.assertEqual(len(calls), 6)
+
+    def test_request_memo_not_outside_request(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, request_memo=True)
+        calls = []
+        inst.connect('service_name', lambda payload: calls.append(payload))
+        inst.ask_around('service_name', 1)
+        inst.ask_around('service_name', 1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_request_memo_closes_response(self):
+        closed = []
+        class Response(list):
+            def close(self):
+                closed.append(True)
+        def app(environ, start_response):
+            return Response(['body'])
+        inst = self._makeOne(app, request_memo=True)
+        response = inst({}, None)
+        response.close()
+        self.assertEqual(closed, [True])
+
+    def test_coalesce_asks(self):
+        import threading
+        import time
+        inst = self._makeOne(DummyWSGIApp())
+        flight = inst.coalesce_asks('url')
+        started, release = threading.Event(), threading.Event()
+        calls = []
+        def handler(payload):
+            calls.append(payload)
+            started.set()
+            release.wait(1.0)
+            return payload['name']
+        inst.connect('url', handler)
+        results = []
+        def ask():
+            results.append(inst.ask_around('url', {'name': 'home'}))
+        threads = [threading.Thread(target=ask) for i in range(4)]
+        threads[0].start()
+        started.wait(1.0)
+        for thread in threads[1:]:
+            thread.start()
+        while flight.shared < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [['home']] * 4)
+        self.assertEqual(calls, [{'name': 'home'}])
+        self.assertEqual(flight.stats(), {'flights': 1, 'shared': 3,
+                                          'in_flight': 0})
+        inst.ask_around('url', {'name': 'home'})
+        self.assertEqual(len(calls), 2)
+
+    def test_coalesce_asks_error(self):
+        import threading
+        import time
+        inst = self._makeOne(DummyWSGIApp())
+        flight = inst.coalesce_asks('url')
+        release = threading.Event()
+        def handler(payload):
+            release.wait(1.0)
+            raise ValueError(payload)
+        inst.connect('url', handler)
+        errors = []
+        def ask():
+            try:
+                inst.ask_around('url', 'home')
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=ask) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        while flight.shared < 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0] is errors[1])
+
+    def test_coalesce_asks_nested(self):
+        from wsgi_party import HighAndDry
+        inst = self._makeOne(DummyWSGIApp())
+        inst.coalesce_asks('url')
+        nested = []
+        def handler(payload):
+            if nested:
+                raise HighAndDry()
+            nested.append(payload)
+            try:
+                # The same ask, from the thread it is in flight on.
+                return inst.ask_around('url', payload) or 'outer'
+            finally:
+                nested.pop()
+        inst.connect('url', handler)
+        self.assertEqual(inst.ask_around('url', 'outer'), ['outer'])
+        self.assertEqual(inst.ask_around('url', ['unhashable', {}]),
+                         ['outer'])
+
+    def test_limit_asks(self):
+        import threading
+        from wsgi_party import ServiceOverloaded
+        inst = self._makeOne(DummyWSGIApp())
+        limit = inst.limit_asks('report', 1, max_waiting=0)
+        started, release = threading.Event(), threading.Event()
+        def handler(payload):
+            started.set()
+            release.wait(1.0)
+            return payload
+        inst.connect('report', handler)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(inst.ask_around('report', 1)))
+        thread.start()
+        started.wait(1.0)
+        self.assertRaises(ServiceOverloaded, inst.ask_around, 'report', 2)
+        limit.shed = 'empty'
+        self.assertEqual(inst.ask_around('report', 3), [])
+        self.assertEqual(inst.ask_first('report', 4, 'shed'), 'shed')
+        release.set()
+        thread.join()
+        self.assertEqual(results, [[1]])
+        self.assertEqual(inst.ask_around('report', 5), [5])
+        stats = limit.stats()
+        self.assertEqual((stats['admitted'], stats['rejected'],
+                          stats['active']), (2, 3, 0))
+
+    def test_limit_asks_of_iter_answers_and_ask_around_many(self):
+        from wsgi_party import ServiceOverloaded
+        inst = self._makeOne(DummyWSGIApp())
+        limit = inst.limit_asks('report', 1, max_waiting=0)
+        inst.connect('report', lambda payload: payload)
+        answers = inst.iter_answers('report', 1)
+        self.assertEqual(next(answers), 1)
+        self.assertEqual(limit.active, 1)
+        self.assertRaises(ServiceOverloaded, list,
+                          inst.iter_answers('report', 2))
+        self.assertRaises(ServiceOverloaded, inst.ask_around_many,
+                          'report', [3, 4])
+        limit.shed = 'empty'
+        self.assertEqual(list(inst.iter_answers('report', 2)), [])
+        self.assertEqual(inst.ask_around_many('report', [3, 4]), [[], []])
+        answers.close()
+        self.assertEqual(limit.active, 0)
+        self.assertEqual(inst.ask_around_many('report', [3, 4]), [[3], [4]])
+        self.assertEqual(list(inst.iter_answers('report', 5)), [5])
+        stats = limit.stats()
+        self.assertEqual((stats['admitted'], stats['rejected'],
+                          stats['active']), (3, 4, 0))
+
+    def test_limit_asks_nested_shed_is_raised(self):
+        from wsgi_party import ServiceOverloaded
+        inst = self._makeOne(DummyWSGIApp())
+        inst.limit_asks('inner', 0, max_waiting=0)
+        inst.limit_asks('outer', 1, shed='empty')
+        inst.connect('inner', lambda payload: payload)
+        inst.connect('outer',
+                     lambda payload: inst.ask_around('inner', payload))
+        self.assertRaises(ServiceOverloaded, inst.ask_around, 'outer', 1)
+
+    def test_limit_asks_nested_in_slot(self):
+        inst = self._makeOne(DummyWSGIApp())
+        limit = inst.limit_asks('report', 1, timeout=1)
+        def total(payload):
+            if payload <= 0:
+                return 0
+            return payload + sum(inst.ask_around('report', payload - 1))
+        inst.connect('report', total)
+        self.assertEqual(inst.ask_around('report', 3), [6])
+        self.assertEqual(list(inst.iter_answers('report', 2)), [3])
+        self.assertEqual(inst.ask_around_many('report', [1, 2]), [[1], [3]])
+        self.assertEqual((limit.admitted, limit.active, limit.timed_out),
+                         (3, 0, 0))
+
+    def test_limit_asks_nested_in_slot_on_executor(self):
+        inst = self._makeOne(DummyWSGIApp(), max_workers=2)
+        self.addCleanup(inst.close)
+        limit = inst.limit_asks('report', 1, timeout=1)
+        def total(payload):
+            if payload <= 0:
+                return 0
+            return payload + sum(inst.ask_around('report', payload - 1))
+        inst.connect('report', total)
+        inst.connect('report', lambda payload: 0)
+        self.assertEqual(inst.ask_around('report', 2), [3, 0])
+        self.assertEqual((limit.admitted, limit.timed_out), (1, 0))
+
+    def test_finalize(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(DummyPartylineApp('service_name', 'handler'),
+                             ['/__invite__/'], lightweight_invites=True)
+        self.assertTrue(inst.finalize() is inst.application)
+        operator = inst.operators[0]
+        self.assertTrue(operator.partyline is inst)
+        inst = self._makeOne(app, request_timeout=1.0)
+        self.assertTrue(inst.finalize() is inst)
+        inst = self._makeOne(app, request_memo=True)
+        self.assertTrue(inst.finalize() is inst)
+
+    def test_operator_slots(self):
+        from wsgi_party import PartylineOperator
+        inst = PartylineOperator(None)
+        self.assertFalse(hasattr(inst, '__dict__'))
+
+    def test_disconnect(self):
+        from wsgi_party import NoSuchServiceName
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, breakers=True)
+        def one(payload):
+            return 1
+        def two(payload):
+            return 2
+        inst.connect('service_name', one, keys=['a'], timeout=1.0)
+        inst.connect('service_name', two)
+        self.assertEqual(inst.ask_around('service_name', 'a'), [1, 2])
+        self.assertTrue(inst.disconnect('service_name', one))
+        self.assertFalse(inst.disconnect('service_name', one))
+        self.assertEqual(inst.ask_around('service_name', 'a'), [2])
+        self.assertEqual(inst.declared_keys['service_name'], {})
+        self.assertEqual(inst.timeouts['service_name'], {})
+        self.assertEqual(list(inst.breakers), [('service_name', two)])
+        inst.disconnect('service_name', two)
+        self.assertRaises(NoSuchServiceName, inst.ask_around,
+                          'service_name', 'a')
+
+    def test_disconnect_operator(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        operator = inst.operator_class(inst)
+        inst.operators.append(operator)
+        handler = lambda payload: 'answer'
+        operator.connect('one', handler)
+        operator.connect('two', handler)
+        inst.disconnect('one', handler)
+        self.assertEqual(operator.handlers, set([handler]))
+        inst.disconnect('two', handler)
+        self.assertEqual(operator.handlers, set())
+
+    def test_weak_handlers(self):
+        import gc
+        from wsgi_party import WeakHandler
+        class App(object):
+            def handler(self, payload):
+                return 'answer'
+        app = App()
+        inst = self._makeOne(DummyWSGIApp(), weak_handlers=True)
+        operator = inst.operator_class(inst)
+        inst.operators.append(operator)
+        operator.connect('service_name', app.handler)
+        inst.connect('service_name', lambda payload: 'gone')
+        gc.collect()
+        self.assertEqual(inst.ask_around('service_name', None), ['answer'])
+        entry, = inst.handlers['service_name']
+        self.assertTrue(isinstance(entry, WeakHandler))
+        self.assertEqual(operator.handlers, set([entry]))
+        self.assertEqual(inst.dispatch_table('service_name', operator), ())
+        inst.connect('other', app.handler)
+        self.assertTrue(inst.disconnect('other', app.handler))
+        del app
+        gc.collect()
+        self.assertEqual(inst.handlers, {})
+        self.assertEqual(operator.handlers, set())
+
+    def test_weak_handlers_collected_while_connecting(self):
+        import gc
+        inst = self._makeOne(DummyWSGIApp(), weak_handlers=True)
+        handler = lambda payload: 'answer'
+        inst.connect('service_name', handler)
+        with inst._connect_lock:
+            del handler
+            gc.collect()
+        self.assertEqual(inst.ask_around('service_name', None), [])
+        inst.purge()
+        self.assertEqual(inst.handlers, {})
+
+    def test_weak_handlers_not_weakly_referenced(self):
+        class Handler(object):
+            __slots__ = ()
+            def __call__(self, payload):
+                return 'answer'
+        handler = Handler()
+        inst = self._makeOne(DummyWSGIApp(), weak_handlers=True)
+        inst.connect('service_name', handler)
+        self.assertEqual(inst.handlers['service_name'], (handler,))
+
+    def test_announce(self):
+        import threading
+        from wsgi_party import HighAndDry, PartylineOperator
+        inst = self._makeOne(DummyWSGIApp())
+        operator = PartylineOperator(inst)
+        calls = []
+        def handler(payload):
+            calls.append((payload, threading.current_thread().name))
+            return 'ignored'
+        def dry(payload):
+            raise HighAndDry()
+        def broken(payload):
+            raise ValueError(payload)
+        operator.connect('flush', lambda payload: calls.append('own'))
+        inst.connect('flush', handler)
+        inst.connect('flush', dry)
+        inst.connect('flush', broken)
+        self.assertTrue(operator.announce('flush', 'users'))
+        self.assertTrue(inst.flush(1.0))
+        self.assertEqual(calls, [('users', 'partyline-announce')])
+        stats = inst.announcer.stats()
+        self.assertEqual((stats['delivered'], stats['errors']), (1, 1))
+        inst.close()
+        inst.announce('flush', 'closed')
+        self.assertEqual(calls[-1], ('closed', 'MainThread'))
+
+    def test_announce_no_handler(self):
+        from wsgi_party import NoSuchServiceName
+        inst = self._makeOne(DummyWSGIApp())
+        self.assertRaises(NoSuchServiceName, inst.announce, 'unlucky', None)
+
+    def test_connect_timeout(self):
+        import time
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        def slow(payload):
+            time.sleep(0.01)
+            return 'slow'
+        inst.connect('service_name', slow, timeout=0.001)
+        inst.connect('service_name', lambda payload: 'fast', timeout=1)
+        self.assertEqual(inst.ask_around('service_name', None), ['fast'])
+
+    def test_connect_timeout_executor(self):
+        import threading
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=2)
+        self.addCleanup(inst.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        def stuck(payload):
+            release.wait(5)
+            return 'stuck'
+        inst.connect('service_name', stuck, timeout=0.01)
+        inst.connect('service_name', lambda payload: 'fast', timeout=1)
+        self.assertEqual(inst.ask_around('service_name', None), ['fast'])
+
+    def test_breakers(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, breakers={'failure_threshold': 2})
+        L = []
+        def broken(payload):
+            L.append(payload)
+            raise ValueError(payload)
+        inst.connect('service_name', broken)
+        inst.connect('service_name', lambda payload: 'ok')
+        for payload in range(4):
+            self.assertEqual(inst.ask_around('service_name', payload),
+                             ['ok'])
+        self.assertEqual(L, [0, 1])
+        broken_state, ok_state = inst.breaker_states()
+        self.assertEqual(broken_state['state'], 'open')
+        self.assertTrue(broken_state['handler'].endswith('.broken'))
+        self.assertEqual(broken_state['skipped'], 2)
+        self.assertEqual(ok_state['state'], 'closed')
+
+    def test_breakers_skipped_answers_not_kept(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, breakers={'failure_threshold': 1,
+                                            'reset_timeout': 0})
+        fail = [True]
+        def flaky(payload):
+            if fail[0]:
+                raise ValueError(payload)
+            return 'flaky'
+        inst.connect('service_name', flaky)
+        inst.connect('service_name', lambda payload: 'ok')
+        cache = inst.cache_answers('service_name')
+        self.assertEqual(inst.ask_around('service_name', None), ['ok'])
+        self.assertEqual(len(cache), 0)
+        fail[0] = False
+        self.assertEqual(inst.ask_around('service_name', None),
+                         ['flaky', 'ok'])
+        self.assertEqual(len(cache), 1)
+
+    def test_breakers_skipped_answers_not_learned(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, breakers={'failure_threshold': 1,
+                                            'reset_timeout': 0})
+        fail = [True]
+        def flaky(payload):
+            if fail[0]:
+                raise ValueError(payload)
+            return 'flaky'
+        inst.connect('service_name', flaky)
+        inst.connect('service_name', lambda payload: 'ok')
+        affinity = inst.route_by_affinity('service_name')
+        self.assertEqual(inst.ask_around('service_name', None), ['ok'])
+        self.assertEqual(len(affinity), 0)
+        fail[0] = False
+        self.assertEqual(inst.ask_around('service_name', None),
+                         ['flaky', 'ok'])
+
+    def test_breakers_skipped_answers_not_memoized(self):
+        from wsgi_party import PartylineOperator
+        fail = [True]
+        def flaky(payload):
+            if fail[0]:
+                fail[0] = False
+                raise ValueError(payload)
+            return 'flaky'
+        def app(environ, start_response):
+            environ['answers'] = [operator.ask_around('service_name', None)
+                                  for i in range(2)]
+            return ['body']
+        inst = self._makeOne(app, request_memo=True,
+                             breakers={'failure_threshold': 2})
+        operator = PartylineOperator(inst)
+        inst.connect('service_name', flaky)
+        inst.connect('service_name', lambda payload: 'ok')
+        environ = {}
+        inst(environ, None).close()
+        self.assertEqual(environ['answers'], [['ok'], ['flaky', 'ok']])
+
+    def test_breaker_states_without_breakers(self):
+        inst = self._makeOne(DummyWSGIApp())
+        inst.connect('service_name', lambda payload: 'ok')
+        self.assertEqual(inst.breaker_states(), [])
+
+    def test_breakers_half_open(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, breakers={'failure_threshold': 1,
+                                            'reset_timeout': 0})
+        fail = [True]
+        def flaky(payload):
+            if fail[0]:
+                raise ValueError(payload)
+            return 'ok'
+        inst.connect('service_name', flaky)
+        self.assertEqual(inst.ask_around('service_name', None), [])
+        breaker = inst.breakers[('service_name', flaky)]
+        self.assertEqual(breaker.state, 'open')
+        fail[0] = False
+        self.assertEqual(inst.ask_around('service_name', None), ['ok'])
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_send_invitations_keeps_operators(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, ('/__invite__', '/another/__invite__'))
+        self.assertEqual([e[inst.partyline_key] for e in app.environs],
+                         inst.operators)
+
+    def test_freeze(self):
+        from wsgi_party import PartylineException
+        app = DummyPartylineApp('service_name', lambda payload: 'result')
+        inst = self._makeOne(app, ('/__invite__',))
+        inst.freeze(gc_freeze=False)
+        operator = inst.operators[0]
+        self.assertEqual(inst.handlers['service_name'], (app.handler,))
+        self.assertEqual(inst.dispatch_tables['service_name'],
+                         {None: (app.handler,), operator: ()})
+        self.assertRaises(PartylineException, inst.connect, 'service_name',
+                          lambda payload: 'late')
+        self.assertEqual(inst.ask_around('service_name', None), ['result'])
+
+    def test_preload(self):
+        import gc
+        if hasattr(gc, 'unfreeze'):
+            self.addCleanup(gc.unfreeze)
+        app = DummyPartylineApp('service_name', lambda payload: 'result')
+        inst = self._makeOne(app, ('/__invite__',), preload=True)
+        self.assertTrue(inst.frozen)
+        self.assertEqual(inst.ask_around('service_name', None), ['result'])
+
+    def test_after_fork(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app, max_workers=1)
+        self.addCleanup(inst.close)
+        inst.connect('service_name', lambda payload: 'result')
+        cache = inst.cache_answers('service_name')
+        inst.ask_around('service_name', None)
+        executor = inst.executor
+        inst.after_fork()
+        self.addCleanup(executor.shutdown)
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.misses, 0)
+        self.assertFalse(inst.executor is executor)
+
+    def test_after_fork_runs_in_forked_child(self):
+        import os
+        if not hasattr(os, 'fork'):
+            return
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        inst.connect('service_name', lambda payload: 'result')
+        cache = inst.cache_answers('service_name')
+        inst.freeze(gc_freeze=False)
+        inst.ask_around('service_name', None)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write_fd, str(cache.misses).encode('ascii'))
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_fd, 16), b'0')
+        os.close(read_fd)
+        self.assertEqual(cache.misses, 1)
+
+    def test_after_fork_registered_once(self):
+        import os
+        if not hasattr(os, 'fork'):
+            return
+        calls = []
+        inst = self._makeOne(DummyWSGIApp())
+        inst.after_fork = lambda: calls.append(None)
+        inst.freeze(gc_freeze=False)
+        inst.freeze(gc_freeze=False)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write_fd, str(len(calls)).encode('ascii'))
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read_fd, 16), b'1')
+        os.close(read_fd)
+
+    def test_ask_around_many(self):
+        from wsgi_party import HighAndDry, batch_handler
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        @batch_handler
+        def evens(payloads):
+            L.append(list(payloads))
+            return [n if n % 2 == 0 else HighAndDry for n in payloads]
+        def odds(number):
+            if number % 2 == 1:
+                return -number
+            raise HighAndDry()
+        def dry(payloads):
+            raise HighAndDry()
+        inst.connect('number', evens)
+        inst.connect('number', odds)
+        inst.connect('number', batch_handler(dry))
+        result = inst.ask_around_many('number', [1, 2, 4])
+        self.assertEqual(result, [[-1], [2], [4]])
+        self.assertEqual(L, [[1, 2, 4]])
+
+    def test_ask_around_many_skips_operator_handlers(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        def handler1(payload):
+            return 'result'
+        def handler2(payload):
+            return payload
+        operator = DummyOperator((handler1,))
+        inst.handlers['service_name'] = [handler1, handler2]
+        result = inst.ask_around_many('service_name', ['a', 'b'], operator)
+        self.assertEqual(result, [['a'], ['b']])
+
+    def test_ask_around_many_cached(self):
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        L = []
+        def handler(payload):
+            L.append(payload)
+            return payload['name']
+        inst.connect('url', handler)
+        inst.cache_answers('url')
+        inst.ask_around('url', {'name': 'home'})
+        result = inst.ask_around_many('url', [{'name': 'home'},
+                                              {'name': 'away'}])
+        self.assertEqual(result, [['home'], ['away']])
+        self.assertEqual(inst.ask_around('url', {'name': 'away'}), ['away'])
+        self.assertEqual(len(L), 2)
+
+    def test_batch_handler_single_ask(self):
+        from wsgi_party import HighAndDry, batch_handler
+        app = DummyWSGIApp()
+        inst = self._makeOne(app)
+        @batch_handler
+        def evens(payloads):
+            return [n if n % 2 == 0 else HighAndDry() for n in payloads]
+        inst.connect('number', evens)
+        self.assertEqual(inst.ask_around('number', 2), [2])
+        self.assertEqual(inst.ask_around('number', 3), [])
+
     def test_ask_around_no_handler(self):
         from wsgi_party import NoSuchServiceName
         app = DummyWSGIApp()
@@ -149,25 +1467,1180 @@ class TestWSGIParty(unittest.TestCase):
             self.fail('NoSuchServiceName was not suppressed as requested.')
 
 
+class TestPartyMetrics(unittest.TestCase):
+    def _makeParty(self, invites=()):
+        from wsgi_party import HighAndDry, WSGIParty
+        def even(number):
+            if number % 2:
+                raise HighAndDry()
+            return number
+        def broken(number):
+            if number < 0:
+                raise ValueError(number)
+            raise HighAndDry()
+        app = DummyPartylineApp('number', even)
+        party = WSGIParty(app, invites, metrics=True)
+        party.connect('number', broken)
+        return party
+
+    def _handler_stats(self, party, name):
+        for stats in party.metrics.snapshot()['handlers']:
+            if stats['handler'].endswith(name):
+                return stats
+
+    def test_service_counters(self):
+        from wsgi_party import NoSuchServiceName
+        party = self._makeParty(('/even/',))
+        party.ask_around('number', 2)
+        party.ask_around('number', 3)
+        self.assertRaises(ValueError, party.ask_around, 'number', -2)
+        self.assertRaises(NoSuchServiceName, party.ask_around, 'nope', 1)
+        services = party.metrics.snapshot()['services']
+        number = services['number']
+        self.assertEqual((number['calls'], number['answers'],
+                          number['misses'], number['errors'],
+                          number['connects']), (3, 1, 1, 1, 2))
+        self.assertEqual(number['latency']['count'], 3)
+        self.assertEqual(services['nope']['no_such_service'], 1)
+
+    def test_handler_counters(self):
+        party = self._makeParty(('/even/',))
+        party.ask_around('number', 2)
+        party.ask_around('number', 3)
+        self.assertRaises(ValueError, party.ask_around, 'number', -2)
+        even = self._handler_stats(party, 'even')
+        self.assertEqual((even['calls'], even['answers'], even['misses'],
+                          even['operator']), (3, 2, 1, '/even/'))
+        self.assertEqual(even['service'], 'number')
+        broken = self._handler_stats(party, 'broken')
+        self.assertEqual((broken['calls'], broken['misses'],
+                          broken['errors'], broken['operator']),
+                         (3, 2, 1, None))
+
+    def test_batch_handler_counters(self):
+        from wsgi_party import HighAndDry, WSGIParty, batch_handler
+        party = WSGIParty(DummyWSGIApp(), metrics=True)
+        @batch_handler
+        def evens(payloads):
+            return [n if n % 2 == 0 else HighAndDry for n in payloads]
+        party.connect('number', evens)
+        self.assertEqual(party.ask_around_many('number', [1, 2, 4]),
+                         [[], [2], [4]])
+        stats, = party.metrics.snapshot()['handlers']
+        self.assertEqual((stats['calls'], stats['answers'], stats['misses']),
+                         (1, 2, 1))
+
+    def test_disabled(self):
+        from wsgi_party import WSGIParty
+        party = WSGIParty(DummyWSGIApp())
+        handler = lambda payload: payload
+        party.connect('service_name', handler)
+        self.assertEqual(party.metrics, None)
+        self.assertEqual(party.dispatch_table('service_name'), (handler,))
+
+    def test_histogram(self):
+        from wsgi_party import Histogram
+        histogram = Histogram(buckets=(0.1, 1))
+        for seconds in (0.05, 0.1, 0.5, 2):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.snapshot(),
+                         {'buckets': [0.1, 1, '+Inf'], 'counts': [2, 1, 1],
+                          'count': 4, 'sum': 2.65})
+
+    def test_stats_app(self):
+        import json
+        from wsgi_party import StatsApp, make_environ, run_app
+        party = self._makeParty()
+        party.ask_around('number', 2)
+        app = StatsApp(party.metrics)
+        L = []
+        def start_response(status, headers):
+            L.append((status, headers))
+        body = b''.join(app(make_environ('/stats'), start_response))
+        self.assertEqual(L[0][0], '200 OK')
+        data = json.loads(body.decode('utf-8'))
+        self.assertEqual(data['services']['number']['calls'], 1)
+
+    def test_after_fork_resets(self):
+        party = self._makeParty()
+        party.ask_around('number', 2)
+        party.after_fork()
+        self.assertEqual(party.metrics.snapshot(),
+                         {'services': {}, 'handlers': []})
+
+
+class TestTracing(unittest.TestCase):
+    def _makeParty(self, **kw):
+        from wsgi_party import WSGIParty
+        return WSGIParty(DummyWSGIApp(), tracing=True, **kw)
+
+    def _makeOperator(self, party, name):
+        operator = party.operator_class(party)
+        operator.name = name
+        party.operators.append(operator)
+        return operator
+
+    def test_span_tree(self):
+        party = self._makeParty()
+        a = self._makeOperator(party, '/a/')
+        b = self._makeOperator(party, '/b/')
+        def b_url(payload):
+            return b.ask_first('path', payload) + '/b'
+        def a_path(payload):
+            return '/root'
+        b.connect('url', b_url)
+        a.connect('path', a_path)
+        self.assertEqual(a.ask_around('url', 'index'), ['/root/b'])
+        trace, = party.tracer.traces
+        data = trace.to_dict()
+        self.assertEqual((data['kind'], data['service'], data['payload']),
+                         ('ask', 'url', "'index'"))
+        handler, = data['children']
+        self.assertEqual((handler['kind'], handler['operator']),
+                         ('handler', '/b/'))
+        self.assertTrue(handler['handler'].endswith('b_url'))
+        nested, = handler['children']
+        self.assertEqual(nested['service'], 'path')
+        self.assertEqual(nested['children'][0]['operator'], '/a/')
+        self.assertTrue(data['duration'] >= handler['duration'] >= 0)
+
+    def test_cycle(self):
+        from wsgi_party import AskCycle
+        party = self._makeParty()
+        a = self._makeOperator(party, '/a/')
+        b = self._makeOperator(party, '/b/')
+        L = []
+        def b_ping(payload):
+            return b.ask_around('pong', payload)
+        def a_pong(payload):
+            return a.ask_around('ping', payload)
+        b.connect('ping', b_ping)
+        a.connect('pong', a_pong)
+        def a_ping(payload):
+            L.append('called')
+        a.connect('ping', a_ping)
+        self.assertRaises(AskCycle, party.ask_around, 'ping', None)
+        self.assertEqual(L, [])
+        trace, = party.tracer.traces
+        self.assertTrue(trace.error.startswith('AskCycle'))
+
+    def test_max_depth(self):
+        from wsgi_party import AskTooDeep
+        party = self._makeParty()
+        party.tracer.max_depth = 3
+        L = []
+        def recurse(payload):
+            L.append(payload)
+            return party.ask_around('n', payload + 1)
+        party.connect('n', recurse)
+        self.assertRaises(AskTooDeep, party.ask_around, 'n', 0)
+        self.assertEqual(L, [0, 1, 2])
+
+    def test_executor_spans_nest(self):
+        party = self._makeParty(max_workers=2)
+        self.addCleanup(party.close)
+        party.connect('service_name', lambda payload: 1)
+        party.connect('service_name', lambda payload: 2)
+        self.assertEqual(party.ask_around('service_name', None), [1, 2])
+        trace, = party.tracer.traces
+        self.assertEqual(len(trace.children), 2)
+
+    def test_export(self):
+        import json
+        party = self._makeParty()
+        party.connect('service_name', lambda payload: payload)
+        party.ask_around('service_name', 'x' * 200)
+        data, = json.loads(party.tracer.to_json())
+        self.assertEqual(len(data['payload']), 80)
+        events = party.tracer.trace_events()
+        self.assertEqual([e['cat'] for e in events], ['ask', 'handler'])
+        self.assertEqual(events[0]['name'], 'ask service_name')
+        json.dumps(events)
+
+    def test_max_traces(self):
+        from wsgi_party import Tracer
+        party = self._makeParty()
+        party.tracer = Tracer(max_traces=2)
+        party.connect('service_name', lambda payload: payload)
+        for i in range(3):
+            party.ask_around('service_name', i)
+        self.assertEqual([t.payload for t in party.tracer.traces],
+                         ['1', '2'])
+
+    def test_async_spans(self):
+        import asyncio
+        from asgi_party import ASGIParty
+        party = ASGIParty(DummyASGIApp(), tracing=True)
+        async def handler(payload):
+            return payload
+        party.connect('service_name', handler)
+        party.connect('service_name', lambda payload: payload + 1)
+        result = asyncio.run(party.ask_around_async('service_name', 1))
+        self.assertEqual(result, [1, 2])
+        trace, = party.tracer.traces
+        self.assertEqual([c.kind for c in trace.children],
+                         ['handler', 'handler'])
+
+
+class TestRunApp(unittest.TestCase):
+    def _callFUT(self, app, environ):
+        from wsgi_party import run_app
+        return run_app(app, environ)
+
+    def test_consumes_and_closes_response(self):
+        from wsgi_party import make_environ
+        L = []
+        class Response(object):
+            def __iter__(self):
+                L.append('iter')
+                return iter([b'ok'])
+            def close(self):
+                L.append('close')
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return Response()
+        self.assertEqual(self._callFUT(app, make_environ('/')), '200 OK')
+        self.assertEqual(L, ['iter', 'close'])
+
+
+class TestPayloadKey(unittest.TestCase):
+    def _callFUT(self, payload):
+        from wsgi_party import payload_key
+        return payload_key(payload)
+
+    def test_hashable(self):
+        self.assertEqual(self._callFUT('name'), 'name')
+        self.assertEqual(self._callFUT(('a', 1)), ('a', 1))
+
+    def test_unhashable(self):
+        key1 = self._callFUT({'name': 'home', 'kwargs': {'a': [1, 2]}})
+        key2 = self._callFUT({'kwargs': {'a': [1, 2]}, 'name': 'home'})
+        self.assertEqual(key1, key2)
+        self.assertEqual(hash(key1), hash(key2))
+        self.assertNotEqual(key1, self._callFUT({'name': 'home'}))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from wsgi_party import CircuitBreaker
+        return CircuitBreaker(**kw)
+
+    def test_opens_after_threshold(self):
+        inst = self._makeOne(failure_threshold=2, reset_timeout=60)
+        inst.fail()
+        self.assertTrue(inst.allow())
+        inst.fail()
+        self.assertFalse(inst.allow())
+        self.assertEqual(inst.snapshot(), {'state': 'open', 'failures': 2,
+                                           'trips': 1, 'skipped': 1})
+
+    def test_success_resets_failures(self):
+        inst = self._makeOne(failure_threshold=2)
+        inst.fail()
+        inst.succeed()
+        inst.fail()
+        self.assertEqual(inst.state, 'closed')
+
+    def test_half_open_lets_one_call_through(self):
+        inst = self._makeOne(failure_threshold=1, reset_timeout=0)
+        inst.fail()
+        self.assertTrue(inst.allow())
+        self.assertEqual(inst.state, 'half-open')
+        self.assertFalse(inst.allow())
+        inst.fail()
+        self.assertEqual((inst.state, inst.trips), ('open', 2))
+
+
+class TestAnnouncer(unittest.TestCase):
+    def _makeOne(self, deliver, **kw):
+        from wsgi_party import Announcer
+        return Announcer(deliver, **kw)
+
+    def test_coalesce(self):
+        import threading
+        started, release = threading.Event(), threading.Event()
+        delivered = []
+        def deliver(service_name, payload, operator):
+            started.set()
+            release.wait(1.0)
+            delivered.append(payload)
+            return 0
+        inst = self._makeOne(deliver, coalesce=True)
+        self.assertTrue(inst.put('flush', {'table': 'users'}))
+        started.wait(1.0)
+        # The first is being delivered, not pending anymore.
+        self.assertTrue(inst.put('flush', {'table': 'users'}))
+        self.assertFalse(inst.put('flush', {'table': 'users'}))
+        self.assertTrue(inst.put('flush', ['unhashable', {}]))
+        self.assertFalse(inst.flush(0.01))
+        release.set()
+        self.assertTrue(inst.flush(1.0))
+        self.assertEqual(len(delivered), 3)
+        self.assertEqual(inst.stats()['coalesced'], 1)
+
+    def test_overflow_delivers_inline(self):
+        import threading
+        release = threading.Event()
+        threads = []
+        def deliver(service_name, payload, operator):
+            if payload == 'first':
+                release.wait(1.0)
+            threads.append((payload, threading.current_thread().name))
+            return 0
+        inst = self._makeOne(deliver, maxsize=1)
+        inst.put('flush', 'first')
+        while len(inst):
+            inst.flush(0.001)
+        inst.put('flush', 'queued')
+        inst.put('flush', 'overflow')
+        self.assertEqual(threads, [('overflow', 'MainThread')])
+        release.set()
+        self.assertTrue(inst.close(1.0))
+        self.assertEqual([p for p, t in threads],
+                         ['overflow', 'first', 'queued'])
+        self.assertEqual(inst.stats()['overflows'], 1)
+
+    def test_errors(self):
+        def deliver(service_name, payload, operator):
+            raise ValueError()
+        inst = self._makeOne(deliver)
+        inst.put('flush', None)
+        inst.close(1.0)
+        self.assertEqual(inst.stats()['errors'], 1)
+
+
+class TestConcurrencyLimit(unittest.TestCase):
+    def _makeOne(self, max_concurrent=1, **kw):
+        from wsgi_party import ConcurrencyLimit
+        return ConcurrencyLimit(max_concurrent, **kw)
+
+    def test_acquire_release(self):
+        inst = self._makeOne(max_concurrent=2)
+        self.assertTrue(inst.acquire())
+        self.assertTrue(inst.acquire())
+        self.assertFalse(inst.acquire(wait=False))
+        inst.release()
+        self.assertTrue(inst.acquire(wait=False))
+        self.assertEqual(inst.stats()['active'], 2)
+
+    def test_timeout(self):
+        from wsgi_party import clock
+        inst = self._makeOne(timeout=0.01)
+        inst.acquire()
+        self.assertFalse(inst.acquire())
+        self.assertFalse(inst.acquire(deadline=clock()))
+        self.assertEqual(inst.timed_out, 2)
+
+    def test_lanes(self):
+        import threading
+        import time
+        inst = self._makeOne()
+        inst.acquire()
+        order = []
+        def ask(lane):
+            inst.acquire(lane)
+            order.append(lane)
+            inst.release()
+        threads = []
+        for lane in ('bulk', 'bulk', 'interactive', None):
+            thread = threading.Thread(target=ask, args=(lane,))
+            thread.start()
+            threads.append(thread)
+            while inst.stats()['peak_waiting'] < len(threads):
+                time.sleep(0.001)
+        self.assertEqual(inst.stats()['waiting'],
+                         {'interactive': 2, 'bulk': 2})
+        inst.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', None, 'bulk', 'bulk'])
+
+    def test_shed_policy(self):
+        self.assertRaises(ValueError, self._makeOne, shed='drop')
+
+
+class TestAnswerCache(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from wsgi_party import AnswerCache
+        return AnswerCache(**kw)
+
+    def test_get_set(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.get('key'), None)
+        inst.set('key', ['answer'])
+        self.assertEqual(inst.get('key'), ('answer',))
+        self.assertEqual((inst.hits, inst.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        inst = self._makeOne(maxsize=2)
+        inst.set('a', [1])
+        inst.set('b', [2])
+        inst.get('a')
+        inst.set('c', [3])
+        self.assertEqual(inst.get('b'), None)
+        self.assertEqual(inst.get('a'), (1,))
+        self.assertEqual(inst.get('c'), (3,))
+        self.assertEqual(inst.evictions, 1)
+        self.assertEqual(len(inst), 2)
+
+    def test_ttl(self):
+        inst = self._makeOne(ttl=0)
+        inst.set('key', ['answer'])
+        self.assertEqual(inst.get('key'), None)
+        self.assertEqual(len(inst), 0)
+
+    def test_set_after_clear_is_refused(self):
+        inst = self._makeOne()
+        generation = inst.generation
+        inst.clear()
+        inst.set('key', ['stale'], generation)
+        self.assertEqual(inst.get('key'), None)
+
+    def test_stats(self):
+        inst = self._makeOne(maxsize=10)
+        inst.get('key')
+        self.assertEqual(inst.stats(), {'hits': 0, 'misses': 1,
+                                        'evictions': 0, 'size': 0,
+                                        'maxsize': 10})
+
+
+class TestSharedAnswerCache(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from wsgi_party import fcntl
+        if fcntl is None:
+            self.skipTest('fcntl is not available')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+        self.addCleanup(os.unlink, self.path)
+
+    def _makeOne(self, **kw):
+        from wsgi_party import SharedAnswerCache
+        inst = SharedAnswerCache(self.path, **kw)
+        self.addCleanup(inst.close)
+        return inst
+
+    def test_get_set(self):
+        inst = self._makeOne()
+        key = (None, None, (dict, frozenset([('name', 'home')])))
+        self.assertEqual(inst.get(key), None)
+        inst.set(key, ['answer'])
+        self.assertEqual(inst.get(key), ('answer',))
+        self.assertEqual((inst.hits, inst.misses), (1, 1))
+
+    def test_shared_between_instances(self):
+        one = self._makeOne()
+        two = self._makeOne()
+        one.set('key', ['answer'])
+        self.assertEqual(two.get('key'), ('answer',))
+        two.clear()
+        self.assertEqual(one.get('key'), None)
+        self.assertEqual(one.generation, two.generation)
+
+    def test_shared_with_forked_process(self):
+        import os
+        if not hasattr(os, 'fork'):
+            self.skipTest('os.fork is not available')
+        inst = self._makeOne()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                inst.reset()
+                inst.set('key', ['from child'])
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(inst.get('key'), ('from child',))
+
+    def test_eviction(self):
+        inst = self._makeOne(maxsize=1, ways=1)
+        inst.set('a', [1])
+        inst.set('b', [2])
+        self.assertEqual(inst.get('a'), None)
+        self.assertEqual(inst.get('b'), (2,))
+        self.assertEqual(inst.evictions, 1)
+        self.assertEqual(len(inst), 1)
+
+    def test_not_cached(self):
+        from wsgi_party import PartylineOperator
+        inst = self._makeOne(slot_size=64)
+        inst.set('big', ['x' * 100])
+        inst.set('unpicklable', [lambda: None])
+        inst.set(object(), ['answer'])
+        inst.set((PartylineOperator(None), None, 'key'), ['answer'])
+        self.assertEqual(len(inst), 0)
+
+    def test_ttl(self):
+        inst = self._makeOne(ttl=0)
+        inst.set('key', ['answer'])
+        self.assertEqual(inst.get('key'), None)
+
+    def test_set_after_clear_is_refused(self):
+        inst = self._makeOne()
+        generation = inst.generation
+        inst.clear()
+        inst.set('key', ['stale'], generation)
+        self.assertEqual(inst.get('key'), None)
+
+    def test_geometry_mismatch(self):
+        from wsgi_party import PartylineException, SharedAnswerCache
+        self._makeOne(maxsize=8)
+        self.assertRaises(PartylineException, SharedAnswerCache, self.path,
+                          maxsize=16)
+
+    def test_party(self):
+        from wsgi_party import PartylineOperator
+        party = self._makeParty()
+        operator = PartylineOperator(party)
+        operator.name = '/app/__invite__'
+        calls = []
+        def handler(payload):
+            calls.append(payload)
+            return payload
+        party.connect('url', handler)
+        party.cache_answers('url', path=self.path)
+        other = self._makeParty()
+        other.connect('url', handler)
+        other.cache_answers('url', path=self.path)
+        self.assertEqual(operator.ask_around('url', 'home'), ['home'])
+        self.assertEqual(other.ask_around('url', 'home',
+                                          operator=operator), ['home'])
+        self.assertEqual(calls, ['home'])
+        party.connect('url', handler)
+        self.assertEqual(other.ask_around('url', 'home',
+                                          operator=operator), ['home'])
+        self.assertEqual(calls, ['home', 'home'])
+
+    def _makeParty(self):
+        from wsgi_party import WSGIParty
+        party = WSGIParty(DummyWSGIApp())
+        self.addCleanup(lambda: party.caches['url'].close())
+        return party
+
+
+class TestASGIParty(unittest.TestCase):
+    def _makeOne(self, app, invites=(), **kw):
+        from asgi_party import ASGIParty
+        return ASGIParty(app, invites, **kw)
+
+    def _run(self, coroutine):
+        import asyncio
+        return asyncio.run(coroutine)
+
+    def test_ctor_does_not_invite(self):
+        app = DummyASGIApp()
+        inst = self._makeOne(app, ('/__invite__',))
+        self.assertEqual(app.scopes, [])
+        self.assertEqual(inst.invites, ['/__invite__'])
+
+    def test_lifespan_startup_sends_invitations(self):
+        from asgi_party import AsyncPartylineOperator
+        app = DummyASGIApp()
+        inst = self._makeOne(app, ('/__invite__', '/another/__invite__'))
+        messages = [{'type': 'lifespan.startup'}]
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            pass
+        self._run(inst({'type': 'lifespan'}, receive, send))
+        self.assertEqual([s['type'] for s in app.scopes],
+                         ['lifespan', 'http', 'http'])
+        invite1, invite2 = app.scopes[1:]
+        self.assertEqual(invite1['path'], '/__invite__')
+        self.assertEqual(invite2['path'], '/another/__invite__')
+        self.assertEqual(invite1[inst.partyline_key].__class__,
+                         AsyncPartylineOperator)
+        self.assertEqual(app.received, [{'type': 'lifespan.startup'}])
+        self.assertEqual(inst.invites, [])
+        self.assertEqual([operator.name for operator in inst.operators],
+                         ['/__invite__', '/another/__invite__'])
+        self.assertEqual(sorted(inst.invite_timings),
+                         ['/__invite__', '/another/__invite__'])
+
+    def test_preload_freezes_after_startup(self):
+        class App(DummyASGIApp):
+            async def __call__(self, scope, receive, send):
+                scope['partyline'].connect('ping', lambda payload: 'pong')
+        app = App()
+        inst = self._makeOne(app, ('/__invite__',), preload=True)
+        self.assertFalse(inst.frozen)
+        self._run(inst.send_invitations_async())
+        self.assertTrue(inst.frozen)
+        self.assertEqual(inst.ask_around('ping', None), ['pong'])
+
+    def test___call__http(self):
+        app = DummyASGIApp()
+        inst = self._makeOne(app)
+        scope = {'type': 'http', 'path': '/'}
+        self._run(inst(scope, None, None))
+        self.assertEqual(app.scopes, [scope])
+
+    def test_limit_asks_waits_on_the_loop(self):
+        import asyncio
+        from wsgi_party import priority
+        inst = self._makeOne(DummyASGIApp())
+        limit = inst.limit_asks('report', 1, max_waiting=2, shed='empty')
+        order = []
+        async def handler(payload):
+            order.append(payload)
+            await asyncio.sleep(0.01)
+            return payload
+        inst.connect('report', handler)
+        async def bulk(payload):
+            with priority('bulk'):
+                return await inst.ask_around_async('report', payload)
+        async def main():
+            first = asyncio.ensure_future(inst.ask_around_async('report', 1))
+            await asyncio.sleep(0)
+            return await asyncio.gather(
+                first, bulk(2), inst.ask_around_async('report', 3),
+                inst.ask_around_async('report', 4))
+        self.assertEqual(self._run(main()), [[1], [2], [3], []])
+        self.assertEqual(order, [1, 3, 2])
+        self.assertEqual((limit.admitted, limit.rejected), (3, 1))
+
+    def test_limit_asks_times_out_on_the_loop(self):
+        import asyncio
+        inst = self._makeOne(DummyASGIApp())
+        limit = inst.limit_asks('report', 1, timeout=0.01, shed='empty')
+        async def handler(payload):
+            await asyncio.sleep(0.1)
+            return payload
+        inst.connect('report', handler)
+        async def main():
+            return await asyncio.gather(inst.ask_around_async('report', 1),
+                                        inst.ask_around_async('report', 2))
+        self.assertEqual(self._run(main()), [[1], []])
+        self.assertEqual((limit.timed_out, limit.active), (1, 0))
+        self.assertEqual(limit.stats()['waiting'],
+                         {'interactive': 0, 'bulk': 0})
+
+    def test_limit_asks_nested_in_slot_on_the_loop(self):
+        inst = self._makeOne(DummyASGIApp(), max_workers=1)
+        self.addCleanup(inst.close)
+        limit = inst.limit_asks('report', 1, timeout=1)
+        async def total(payload):
+            if payload <= 0:
+                return 0
+            answers = await inst.ask_around_async('report', payload - 1)
+            return payload + sum(answers)
+        inst.connect('report', total)
+        self.assertEqual(self._run(inst.ask_around_async('report', 3)), [6])
+        self.assertEqual((limit.admitted, limit.timed_out), (1, 0))
+        limit = inst.limit_asks('count', 1, timeout=1)
+        def count(payload):
+            return payload and 1 + sum(inst.ask_around('count', payload - 1))
+        inst.connect('count', count)
+        self.assertEqual(self._run(inst.ask_around_async('count', 2)), [2])
+        self.assertEqual((limit.admitted, limit.timed_out), (1, 0))
+
+    def test_finalize(self):
+        inst = self._makeOne(DummyASGIApp())
+        self.assertTrue(inst.finalize() is inst)
+
+    def test_weak_coroutine_handlers(self):
+        import gc
+        from asgi_party import AsyncWeakHandler
+        class App(object):
+            async def handler(self, payload):
+                return 'answer'
+        app = App()
+        inst = self._makeOne(DummyASGIApp(), weak_handlers=True)
+        entry = inst.connect('service_name', app.handler)
+        self.assertTrue(isinstance(entry, AsyncWeakHandler))
+        answers = self._run(inst.ask_around_async('service_name', None))
+        self.assertEqual(answers, ['answer'])
+        del app
+        gc.collect()
+        self.assertEqual(inst.handlers, {})
+
+    def test_ask_around_async_mixed_handlers(self):
+        import asyncio
+        from wsgi_party import HighAndDry
+        inst = self._makeOne(DummyASGIApp())
+        async def slow(payload):
+            await asyncio.sleep(0.02)
+            return 'slow'
+        async def dry(payload):
+            raise HighAndDry()
+        def sync(payload):
+            return 'sync'
+        for handler in (slow, dry, sync):
+            inst.connect('service_name', handler)
+        result = self._run(inst.ask_around_async('service_name', None))
+        self.assertEqual(result, ['slow', 'sync'])
+
+    def test_ask_around_async_timeout(self):
+        import asyncio
+        inst = self._makeOne(DummyASGIApp())
+        async def stuck(payload):
+            await asyncio.sleep(5)
+            return 'stuck'
+        async def fast(payload):
+            return 'fast'
+        inst.connect('service_name', stuck, timeout=0.01)
+        inst.connect('service_name', fast)
+        result = self._run(inst.ask_around_async('service_name', None))
+        self.assertEqual(result, ['fast'])
+
+    def test_ask_around_async_timeout_of_plain_handler(self):
+        import threading
+        inst = self._makeOne(DummyASGIApp(), max_workers=2)
+        self.addCleanup(inst.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        def stuck(payload):
+            release.wait(5)
+            return 'stuck'
+        inst.connect('service_name', stuck, timeout=0.01)
+        inst.connect('service_name', lambda payload: 'fast')
+        result = self._run(inst.ask_around_async('service_name', None))
+        self.assertEqual(result, ['fast'])
+
+    def test_ask_around_async_executor_nested(self):
+        import asyncio
+        inst = self._makeOne(DummyASGIApp(), max_workers=2)
+        self.addCleanup(inst.close)
+        def outer(payload):
+            return inst.ask_around('inner', payload)
+        inst.connect('outer', outer)
+        inst.connect('outer', lambda payload: outer(payload + 1))
+        inst.connect('inner', lambda payload: payload)
+        inst.connect('inner', lambda payload: -payload)
+        async def ask():
+            return await asyncio.wait_for(
+                inst.ask_around_async('outer', 1), 5)
+        self.assertEqual(self._run(ask()), [[1, -1], [2, -2]])
+
+    def test_ask_around_async_executor_nested_coroutines(self):
+        inst = self._makeOne(DummyASGIApp(), max_workers=1)
+        self.addCleanup(inst.close)
+        async def inner(payload):
+            return -payload
+        inst.connect('outer', lambda payload: inst.ask_around('inner',
+                                                              payload))
+        inst.connect('inner', lambda payload: payload)
+        inst.connect('inner', inner)
+        self.assertEqual(self._run(inst.ask_around_async('outer', 1)),
+                         [[1, -1]])
+
+    def test_ask_around_async_quorum(self):
+        import asyncio
+        inst = self._makeOne(DummyASGIApp())
+        L = []
+        async def slow(payload):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                L.append('cancelled')
+                raise
+        async def fast(payload):
+            return 'fast'
+        inst.connect('service_name', slow)
+        inst.connect('service_name', fast)
+        result = self._run(inst.ask_around_async('service_name', None,
+                                                 quorum=1))
+        self.assertEqual(result, ['fast'])
+        self.assertEqual(L, ['cancelled'])
+
+    def test_metrics_of_coroutine_handlers(self):
+        inst = self._makeOne(DummyASGIApp(), metrics=True)
+        async def handler(payload):
+            return payload
+        inst.connect('service_name', handler)
+        result = self._run(inst.ask_around_async('service_name', 1))
+        self.assertEqual(result, [1])
+        stats, = inst.metrics.snapshot()['handlers']
+        self.assertEqual((stats['calls'], stats['answers']), (1, 1))
+
+    def test_operator_ask_around_skips_own_handlers(self):
+        from asgi_party import AsyncPartylineOperator
+        inst = self._makeOne(DummyASGIApp())
+        operator = AsyncPartylineOperator(inst)
+        async def mine(payload):
+            return 'mine'
+        async def theirs(payload):
+            return 'theirs'
+        operator.connect('service_name', mine)
+        inst.connect('service_name', theirs)
+        self.assertEqual(self._run(operator.ask_around('service_name', None)),
+                         ['theirs'])
+        self.assertEqual(self._run(operator.ask_first('service_name', None)),
+                         'theirs')
+
+    def test_sync_ask_around_of_coroutine_handler(self):
+        inst = self._makeOne(DummyASGIApp())
+        async def handler(payload):
+            return payload
+        inst.connect('service_name', handler)
+        inst.connect('service_name', lambda payload: payload + 1)
+        self.assertEqual(inst.ask_around('service_name', 1), [1, 2])
+        self.assertEqual(list(inst.iter_answers('service_name', 1)), [1, 2])
+
+    def test_ask_around_many_of_coroutine_handler(self):
+        from wsgi_party import HighAndDry, batch_handler
+        inst = self._makeOne(DummyASGIApp())
+        async def handler(payload):
+            if payload == 2:
+                raise HighAndDry()
+            return payload
+        inst.connect('service_name', handler)
+        inst.connect('service_name', lambda payload: -payload)
+        inst.connect('service_name', batch_handler(
+            lambda payloads: [payload * 10 for payload in payloads]))
+        self.assertEqual(inst.ask_around_many('service_name', [1, 2]),
+                         [[1, -1, 10], [-2, 20]])
+
+    def test_sync_ask_around_on_loop_raises(self):
+        from wsgi_party import PartylineException
+        inst = self._makeOne(DummyASGIApp())
+        async def handler(payload):
+            return payload
+        inst.connect('service_name', handler)
+        async def ask():
+            inst.ask_around('service_name', None)
+        self.assertRaises(PartylineException, self._run, ask())
+
+
+class TestFlaskParty(unittest.TestCase):
+    def setUp(self):
+        try:
+            import flask
+        except ImportError:
+            raise unittest.SkipTest('Flask is not installed.')
+
+    def _makeParty(self):
+        from flask import Flask, url_for
+        from werkzeug.middleware.dispatcher import DispatcherMiddleware
+        from flask_wsgi_party import FlaskParty
+        from wsgi_party import WSGIParty
+        root = Flask('root')
+        one = Flask('one')
+        FlaskParty(root)
+        FlaskParty(one)
+        @root.route('/')
+        def index():
+            return url_for('page', name='x', _anchor='top')
+        @root.route('/external')
+        def external():
+            return url_for('page', name='y', _external=True)
+        @root.route('/to/<endpoint>')
+        def to(endpoint):
+            return url_for(endpoint)
+        @one.route('/page/<name>')
+        def page(name):
+            return url_for('index')
+        dispatcher = DispatcherMiddleware(root, {'/one': one})
+        party = WSGIParty(dispatcher, ('/__invite__/', '/one/__invite__/'))
+        return party, root, one
+
+    def _get(self, app, path):
+        from werkzeug.test import Client
+        response = Client(app).get(path)
+        return response.status_code, response.get_data(as_text=True)
+
+    def test_url_for_other_app(self):
+        party, root, one = self._makeParty()
+        self.assertEqual(self._get(party, '/'), (200, '/one/page/x#top'))
+        self.assertEqual(self._get(party, '/one/page/z'), (200, '/'))
+        self.assertEqual(self._get(party, '/external'),
+                         (200, 'http://localhost/one/page/y'))
+
+    def test_url_for_builds_without_asking(self):
+        party, root, one = self._makeParty()
+        self._get(party, '/')
+        L = []
+        def ask_around(*args, **kwargs):
+            L.append(args)
+        party.ask_around = ask_around
+        self.assertEqual(self._get(party, '/'), (200, '/one/page/x#top'))
+        self.assertEqual(L, [])
+
+    def test_url_for_party_mounted(self):
+        from werkzeug.middleware.dispatcher import DispatcherMiddleware
+        party, root, one = self._makeParty()
+        site = DispatcherMiddleware(DummyWSGIApp(), {'/site': party})
+        self.assertEqual(self._get(site, '/site/'),
+                         (200, '/site/one/page/x#top'))
+        self.assertEqual(self._get(site, '/site/one/page/z'),
+                         (200, '/site/'))
+
+    def test_invite_path_not_found(self):
+        party, root, one = self._makeParty()
+        self.assertEqual(self._get(party, '/one/__invite__/')[0], 404)
+
+    def test_rejoin_refreshes_map(self):
+        from werkzeug.routing import Rule
+        party, root, one = self._makeParty()
+        one.url_map.add(Rule('/late', endpoint='late'))
+        self.assertEqual(self._get(party, '/to/late')[0], 500)
+        party.send_invitations(['/one/__invite__/'])
+        self.assertEqual(self._get(party, '/to/late'), (200, '/one/late'))
+
+
+class TestRemoteParty(unittest.TestCase):
+    def _makeParty(self):
+        from wsgi_party import HighAndDry, WSGIParty
+        party = WSGIParty(DummyWSGIApp())
+        def url(payload):
+            endpoint, values = payload
+            if endpoint != 'remote:index':
+                raise HighAndDry()
+            return '/remote/'
+        party.connect('url', url)
+        party.connect('ping', lambda payload: 'pong')
+        party.connect('ping', lambda payload: 'pong2')
+        return party
+
+    def _makeServer(self, party):
+        from remote_party import PartylineServer
+        server = PartylineServer(party)
+        server.serve_in_thread(poll_interval=0.01)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _makeTransport(self, server, **kw):
+        from remote_party import TCPTransport
+        host, port = server.server_address
+        transport = TCPTransport(host, port, **kw)
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_ask_around_merges_remote_answers(self):
+        from wsgi_party import WSGIParty
+        from remote_party import connect_peer
+        server = self._makeServer(self._makeParty())
+        transport = self._makeTransport(server)
+        local = WSGIParty(DummyWSGIApp())
+        local.connect('ping', lambda payload: 'local pong')
+        connect_peer(local, transport, ('ping', 'url'))
+        self.assertEqual(local.ask_around('ping', None),
+                         ['local pong', 'pong', 'pong2'])
+        self.assertEqual(local.ask_around('url', ('remote:index', {})),
+                         ['/remote/'])
+        self.assertEqual(local.ask_around('url', ('local:index', {})), [])
+        self.assertEqual(local.ask_first('ping', None), 'local pong')
+
+    def test_connection_is_reused(self):
+        server = self._makeServer(self._makeParty())
+        transport = self._makeTransport(server)
+        transport.ask('ping', None)
+        connection = transport._idle[0]
+        transport.ask('ping', None)
+        self.assertEqual(transport._idle, [connection])
+        self.assertEqual(transport.round_trips, 2)
+
+    def test_reconnects_after_peer_closed_connection(self):
+        server = self._makeServer(self._makeParty())
+        transport = self._makeTransport(server)
+        transport.ask('ping', None)
+        transport._idle[0].close()
+        self.assertEqual(transport.ask('ping', None), ['pong', 'pong2'])
+
+    def test_weak_handlers_hold_remote_handlers(self):
+        import gc
+        from wsgi_party import WSGIParty
+        from remote_party import connect_peer
+        server = self._makeServer(self._makeParty())
+        local = WSGIParty(DummyWSGIApp(), weak_handlers=True)
+        def pong(payload):
+            return 'local pong'
+        local.connect('ping', pong)
+        connect_peer(local, self._makeTransport(server), ('ping',))
+        gc.collect()
+        self.assertEqual(local.ask_around('ping', None),
+                         ['local pong', 'pong', 'pong2'])
+        # The peer serving the local party skips remote handlers.
+        peer = self._makeTransport(self._makeServer(local))
+        self.assertEqual(peer.ask('ping', None), ['local pong'])
+
+    def test_peers_skip_weak_remote_handlers(self):
+        from wsgi_party import WeakHandler
+        from remote_party import PeerOperator, RemoteHandler
+        class Handler(RemoteHandler):
+            pass
+        handler = Handler(None, 'ping')
+        operator = PeerOperator(None)
+        self.assertTrue(WeakHandler(handler) in operator.handlers)
+        self.assertFalse(WeakHandler(Handler.__init__) in operator.handlers)
+
+    def test_concurrent_asks_share_round_trips(self):
+        import threading
+        from wsgi_party import HighAndDry
+        party = self._makeParty()
+        gate = threading.Event()
+        def slow(payload):
+            gate.wait(5)
+            raise HighAndDry()
+        party.connect('slow', slow)
+        server = self._makeServer(party)
+        transport = self._makeTransport(server, pool_size=1)
+        results = []
+        def ask(service_name):
+            results.append(transport.ask(service_name, None))
+        first = threading.Thread(target=ask, args=('slow',))
+        first.start()
+        threads = [threading.Thread(target=ask, args=('ping',))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        while len(transport._queue) < 5:
+            threading.Event().wait(0.001)
+        gate.set()
+        for thread in [first] + threads:
+            thread.join(5)
+        self.assertEqual(transport.round_trips, 2)
+        self.assertEqual(transport.asks_sent, 6)
+        self.assertEqual(results.count(['pong', 'pong2']), 5)
+
+    def test_ask_around_many_in_one_round_trip(self):
+        from wsgi_party import WSGIParty
+        from remote_party import connect_peer
+        server = self._makeServer(self._makeParty())
+        transport = self._makeTransport(server)
+        local = WSGIParty(DummyWSGIApp())
+        connect_peer(local, transport, ('url',))
+        payloads = [('remote:index', {}), ('local:index', {})]
+        self.assertEqual(local.ask_around_many('url', payloads),
+                         [['/remote/'], []])
+        self.assertEqual(transport.round_trips, 1)
+
+    def test_no_such_service_name_has_no_answers(self):
+        server = self._makeServer(self._makeParty())
+        transport = self._makeTransport(server)
+        self.assertEqual(transport.ask('unlucky', None), [])
+
+    def test_remote_error(self):
+        from remote_party import RemoteError
+        party = self._makeParty()
+        def broken(payload):
+            raise ValueError('boom')
+        party.connect('broken', broken)
+        server = self._makeServer(party)
+        transport = self._makeTransport(server)
+        self.assertRaises(RemoteError, transport.ask, 'broken', None)
+        self.assertEqual(transport.ask('ping', None), ['pong', 'pong2'])
+
+    def test_unreachable_peer(self):
+        import socket
+        from remote_party import RemoteError, TCPTransport
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        transport = TCPTransport('127.0.0.1', port, timeout=1)
+        self.assertRaises(RemoteError, transport.ask, 'ping', None)
+
+    def test_unreachable_peer_trips_breaker(self):
+        import socket
+        from wsgi_party import WSGIParty
+        from remote_party import TCPTransport, connect_peer
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        local = WSGIParty(DummyWSGIApp(), breakers={'failure_threshold': 2})
+        local.connect('ping', lambda payload: 'pong')
+        transport = TCPTransport('127.0.0.1', port, timeout=1)
+        self.addCleanup(transport.close)
+        connect_peer(local, transport, ('ping',))
+        for i in range(4):
+            self.assertEqual(local.ask_around('ping', None), ['pong'])
+        remote, = [state for state in local.breaker_states()
+                   if state['state'] != 'closed']
+        self.assertEqual((remote['state'], remote['skipped']), ('open', 2))
+
+    def test_peers_skip_remote_handlers(self):
+        from remote_party import connect_peer
+        party = self._makeParty()
+        server = self._makeServer(party)
+        # The peer points back at itself; asks must not loop.
+        connect_peer(party, self._makeTransport(server), ('ping',))
+        transport = self._makeTransport(server)
+        self.assertEqual(transport.ask('ping', None), ['pong', 'pong2'])
+
+    def test_http_transport(self):
+        import threading
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        from remote_party import HTTPTransport, PartylineEndpoint
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        endpoint = PartylineEndpoint(self._makeParty())
+        httpd = make_server('127.0.0.1', 0, endpoint,
+                            handler_class=QuietHandler)
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        url = 'http://127.0.0.1:%d/__partyline__' % httpd.server_port
+        transport = HTTPTransport(url)
+        self.addCleanup(transport.close)
+        self.assertEqual(transport.ask_many([('ping', None),
+                                             ('url', ('remote:index', {}))]),
+                         [['pong', 'pong2'], ['/remote/']])
+        self.assertEqual(transport.ask('ping', None), ['pong', 'pong2'])
+
+
 class DummyOperator(object):
     def __init__(self, handlers=()):
         self.handlers = handlers
 
 
+class DummyExecutor(object):
+    """Run the first few submitted calls right away, leave the rest pending."""
+    def __init__(self, run=0):
+        self.run = run
+        self.futures = []
+
+    def submit(self, fn, *args):
+        from concurrent.futures import Future
+        future = Future()
+        if len(self.futures) < self.run:
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.futures.append(future)
+        return future
+
+
 class DummyPartyline(object):
     def __init__(self, connect_response=None, ask_response=None):
         self.connections = []
+        self.connect_options = []
         self.asked = []
         self.ask_response = ask_response
         self.connect_response = connect_response
 
-    def connect(self, name, handler):
+    def connect(self, name, handler, **options):
         self.connections.append((name, handler))
+        self.connect_options.append(options)
         return self.connect_response
 
-    def ask_around(self, service_name, payload, operator=None):
+    def ask_around(self, service_name, payload, operator=None, quorum=None):
         self.asked.append((service_name, payload, operator))
-        return self.ask_response
+        return self.ask_response[:quorum]
+
+    def iter_answers(self, service_name, payload, operator=None):
+        return iter(self.ask_around(service_name, payload, operator))
+
+    def ask_first(self, service_name, payload, default=None, operator=None):
+        for answer in self.iter_answers(service_name, payload, operator):
+            return answer
+        return default
+
+    def ask_around_many(self, service_name, payloads, operator=None):
+        return [self.ask_around(service_name, payload, operator)
+                for payload in payloads]
+
+    def announce(self, service_name, payload, operator=None):
+        self.asked.append((service_name, payload, operator))
+        return True
 
 
 class DummyWSGIApp(object):
@@ -179,3 +2652,26 @@ class DummyWSGIApp(object):
         self.environs.append(environ)
         start_response('200 OK', [])
         return self.response
+
+
+class DummyASGIApp(object):
+    def __init__(self):
+        self.scopes = []
+        self.received = []
+
+    async def __call__(self, scope, receive, send):
+        self.scopes.append(scope)
+        if scope['type'] == 'lifespan':
+            self.received.append(await receive())
+
+
+class DummyPartylineApp(object):
+    """Connect a handler when invited."""
+    def __init__(self, service_name, handler):
+        self.service_name = service_name
+        self.handler = handler
+
+    def __call__(self, environ, start_response):
+        environ['partyline'].connect(self.service_name, self.handler)
+        start_response('200 OK', [])
+        return []
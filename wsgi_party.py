@@ -6,19 +6,1680 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from werkzeug.test import create_environ, run_wsgi_app
+import gc
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+#: Clock for measuring elapsed time.
+clock = time.monotonic
 
 
 class PartylineException(Exception):
     """Base exception class for wsgi_party."""
 
 
-class HighAndDry(PartylineException):
-    """A handler raises this when it does not have a response; skip it."""
+class HighAndDry(PartylineException):
+    """A handler raises this when it does not have a response; skip it."""
+
+
+class NoSuchServiceName(PartylineException):
+    """Raised when no handlers are registered for a requested service name."""
+
+
+class AskTooDeep(PartylineException):
+    """Raised when traced asks nest deeper than the tracer allows."""
+
+
+class AskCycle(PartylineException):
+    """Raised when a traced ask would re-enter an answering application."""
+
+
+class ServiceOverloaded(PartylineException):
+    """Raised when the concurrency limit of a service name sheds an ask."""
+
+    def __init__(self, service_name):
+        PartylineException.__init__(self, '%r is overloaded.' %
+                                    (service_name,))
+        self.service_name = service_name
+
+
+class ManyAnswers(tuple):
+    """Return this from a handler to give several answers at once.
+
+    The answers are merged into the list :meth:`WSGIParty.ask_around` returns,
+    as if each came from its own handler, e.g. for a handler which forwards
+    asks to a peer partyline.
+    """
+
+
+class BatchHandler(object):
+    """Handler which answers a whole batch of payloads in one call.
+
+    Wraps ``answer_many``, a callable taking a list of payloads and returning
+    a list with one answer per payload; an item which is :class:`HighAndDry`
+    (the class or an instance) means no answer for that payload.
+    :meth:`WSGIParty.ask_around_many` passes it the whole batch; single asks
+    call it with a batch of one.  Use :func:`batch_handler` as a decorator.
+    """
+
+    def __init__(self, answer_many):
+        self.answer_many = answer_many
+
+    def __call__(self, payload):
+        answer, = self.answer_many([payload])
+        if answer is HighAndDry or isinstance(answer, HighAndDry):
+            raise HighAndDry()
+        return answer
+
+
+def batch_handler(answer_many):
+    """Decorate a function answering a list of payloads as a handler."""
+    return BatchHandler(answer_many)
+
+
+def payload_key(payload):
+    """Return a hashable key for a payload, freezing unhashable containers.
+
+    Dicts, lists and sets are converted recursively into tuples and
+    frozensets, so that payloads such as ``{'name': 'home'}`` can key caches.
+    """
+    if isinstance(payload, dict):
+        return (dict, frozenset((k, payload_key(v))
+                                for k, v in payload.items()))
+    if isinstance(payload, (list, tuple)):
+        return tuple(payload_key(v) for v in payload)
+    if isinstance(payload, (set, frozenset)):
+        return frozenset(payload_key(v) for v in payload)
+    return payload
+
+
+class AnswerCache(object):
+    """Size-bounded LRU cache of answers, with an optional time to live.
+
+    :class:`WSGIParty` keeps one per cached service name; see
+    :meth:`WSGIParty.cache_answers`.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, key=payload_key):
+        #: Maximum number of entries; least recently used entries go first.
+        self.maxsize = maxsize
+
+        #: Seconds an entry stays fresh, or None to keep until evicted.
+        self.ttl = ttl
+
+        #: Function turning a payload into a hashable cache key.
+        self.key = key
+
+        #: Counters of cache lookups which found and missed an entry.
+        self.hits = 0
+        self.misses = 0
+
+        #: Counter of entries dropped to respect :attr:`maxsize`.
+        self.evictions = 0
+
+        #: Incremented on :meth:`clear`, to refuse answers computed before.
+        self.generation = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return cached answers for key, or None if missing or expired."""
+        with self._lock:
+            try:
+                answers, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return answers
+
+    def set(self, key, answers, generation=None):
+        """Store answers for key, unless the cache was cleared since the
+        given generation was read."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            expires = None
+            if self.ttl is not None:
+                expires = clock() + self.ttl
+            self._entries[key] = (tuple(answers), expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop all entries, e.g. when a handler joins the service name."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def reset(self):
+        """Drop all entries and counters, e.g. in a freshly forked worker."""
+        self._lock = threading.Lock()
+        self.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict of cache counters, for tuning."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._entries),
+                'maxsize': self.maxsize}
+
+
+_scalar_types = frozenset([str, int, float, bool, bytes, type(None)])
+
+
+def _canonical(value):
+    """Encode a cache key as bytes which are the same in every process."""
+    cls = value.__class__
+    if cls in _scalar_types:
+        return ('%s:%r' % (cls.__name__, value)).encode('utf-8')
+    if cls is tuple:
+        return b'(' + b','.join([_canonical(v) for v in value]) + b')'
+    if cls is frozenset:
+        return b'{' + b','.join(sorted([_canonical(v) for v in value])) + b'}'
+    if value is dict:
+        return b'dict'
+    if isinstance(value, PartylineOperator):
+        # Operators are told apart by their invite path across processes.
+        if value.name is None:
+            raise TypeError('Operator without a name.')
+        return b'O' + _canonical(value.name)
+    raise TypeError('Cannot share a key of type %s.' % cls.__name__)
+
+
+class SharedAnswerCache(object):
+    """Answer cache shared by the processes of a host through a file.
+
+    Entries live in a file mapped in memory by every process, e.g. the
+    workers of a pre-fork server, so that an answer computed in one worker
+    is found by the others.  The file holds ``maxsize`` slots of
+    ``slot_size`` bytes, in sets of ``ways`` slots a key may go to; the
+    oldest entry of a full set is evicted.  Answers are pickled, and those
+    which do not fit in a slot, or cannot be pickled, are not cached.
+    Processes lock the sets and the header of the file with :mod:`fcntl`,
+    which is required.  :meth:`clear` moves the file to a new generation,
+    invalidating every process's entries at once.
+
+    Keys must be made of strings, numbers, bytes, None and tuples or
+    frozensets of these, as :func:`payload_key` returns for such payloads;
+    other keys, and asks of operators without an invite path, are not
+    cached.  The file must only be writable by trusted processes.
+    """
+
+    #: Layout of the file header: magic, version, number of slots, slot
+    #: size and generation.
+    header = struct.Struct('<4sIIIQ')
+
+    #: Layout of a slot header: key digest, generation, expiry and storage
+    #: times, and length of the pickled answers which follow.
+    slot_header = struct.Struct('<16sQddI')
+
+    magic = b'WPAC'
+    version = 1
+
+    def __init__(self, path, maxsize=128, ttl=None, key=payload_key,
+                 slot_size=1024, ways=4):
+        if fcntl is None:
+            raise PartylineException('Shared answer caches require fcntl.')
+        if slot_size <= self.slot_header.size:
+            raise ValueError('slot_size must exceed %d bytes.' %
+                             self.slot_header.size)
+
+        #: Path of the file holding the entries.
+        self.path = path
+
+        #: Maximum number of entries, rounded up to a multiple of ways.
+        self.maxsize = -(-maxsize // ways) * ways
+
+        #: Seconds an entry stays fresh, or None to keep until evicted.
+        self.ttl = ttl
+
+        #: Function turning a payload into a cache key.
+        self.key = key
+
+        #: Size of a slot in bytes, including its header.
+        self.slot_size = slot_size
+
+        #: Number of slots a key may be stored in.
+        self.ways = ways
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.header.size + self.maxsize * slot_size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.header.size, 0)
+        try:
+            self._initialize(size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.header.size, 0)
+        self._map = mmap.mmap(self._fd, size)
+        self.reset()
+
+    def _initialize(self, size):
+        data = os.pread(self._fd, self.header.size, 0)
+        if data:
+            magic, version, slots, slot_size, generation = \
+                self.header.unpack(data.ljust(self.header.size, b'\0'))
+            if magic != self.magic or version != self.version:
+                raise PartylineException('%s is not a shared answer cache.' %
+                                         (self.path,))
+            if (slots, slot_size) != (self.maxsize, self.slot_size):
+                raise PartylineException(
+                    '%s holds %d slots of %d bytes, not %d of %d.' %
+                    (self.path, slots, slot_size, self.maxsize,
+                     self.slot_size))
+            return
+        os.ftruncate(self._fd, size)
+        os.pwrite(self._fd, self.header.pack(self.magic, self.version,
+                                             self.maxsize, self.slot_size, 1),
+                  0)
+
+    def reset(self):
+        """Drop this process's counters, e.g. in a freshly forked worker.
+
+        Entries are kept; they are shared with the other processes.
+        """
+        #: Counters of this process's lookups, and of entries it evicted.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # fcntl locks do not keep threads of one process apart.
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Unmap and close the file."""
+        self._map.close()
+        os.close(self._fd)
+
+    def __len__(self):
+        generation = self.generation
+        now = time.time()
+        count = 0
+        for offset in range(self.header.size, len(self._map),
+                            self.slot_size):
+            if self._fresh(self._map, offset, generation, now):
+                count += 1
+        return count
+
+    @property
+    def generation(self):
+        """Generation of the file, incremented on :meth:`clear`."""
+        with self._locked(fcntl.LOCK_SH, 0, self.header.size):
+            return self.header.unpack_from(self._map, 0)[4]
+
+    def _fresh(self, data, offset, generation, now):
+        digest, gen, expires, stored, length = \
+            self.slot_header.unpack_from(data, offset)
+        return gen == generation and not (expires and expires <= now)
+
+    @contextmanager
+    def _locked(self, operation, start, length):
+        fcntl.lockf(self._fd, operation, length, start)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def _digest(self, key):
+        return hashlib.blake2b(_canonical(key), digest_size=16).digest()
+
+    def _set_of(self, digest):
+        sets = self.maxsize // self.ways
+        index = int.from_bytes(digest[:8], 'little') % sets
+        length = self.ways * self.slot_size
+        return self.header.size + index * length, length
+
+    def get(self, key):
+        """Return cached answers for key, or None if missing or expired."""
+        try:
+            digest = self._digest(key)
+        except TypeError:
+            digest = None
+        with self._lock:
+            if digest is not None:
+                start, length = self._set_of(digest)
+                generation = self.generation
+                with self._locked(fcntl.LOCK_SH, start, length):
+                    data = self._map[start:start + length]
+                now = time.time()
+                for offset in range(0, length, self.slot_size):
+                    if (data[offset:offset + 16] == digest and
+                            self._fresh(data, offset, generation, now)):
+                        size = self.slot_header.unpack_from(data, offset)[4]
+                        offset += self.slot_header.size
+                        self.hits += 1
+                        return pickle.loads(data[offset:offset + size])
+            self.misses += 1
+            return None
+
+    def set(self, key, answers, generation=None):
+        """Store answers for key, unless the cache was cleared since the
+        given generation was read."""
+        try:
+            digest = self._digest(key)
+            data = pickle.dumps(tuple(answers), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        if len(data) > self.slot_size - self.slot_header.size:
+            return
+        start, length = self._set_of(digest)
+        with self._lock:
+            with self._locked(fcntl.LOCK_EX, start, length):
+                current = self.generation
+                if generation is not None and generation != current:
+                    return
+                offset = self._choose_slot(start, length, digest, current)
+                expires = 0.0
+                now = time.time()
+                if self.ttl is not None:
+                    expires = now + self.ttl
+                self.slot_header.pack_into(self._map, offset, digest, current,
+                                           expires, now, len(data))
+                offset += self.slot_header.size
+                self._map[offset:offset + len(data)] = data
+
+    def _choose_slot(self, start, length, digest, generation):
+        """Return the offset of the slot to store digest in."""
+        now = time.time()
+        oldest = None
+        for offset in range(start, start + length, self.slot_size):
+            slot_digest, gen, expires, stored, size = \
+                self.slot_header.unpack_from(self._map, offset)
+            if slot_digest == digest or not self._fresh(self._map, offset,
+                                                        generation, now):
+                return offset
+            if oldest is None or stored < oldest[0]:
+                oldest = (stored, offset)
+        self.evictions += 1
+        return oldest[1]
+
+    def clear(self):
+        """Drop all entries of every process, e.g. when a handler joins the
+        service name."""
+        with self._lock:
+            with self._locked(fcntl.LOCK_EX, 0, self.header.size):
+                fields = list(self.header.unpack_from(self._map, 0))
+                fields[4] += 1
+                self.header.pack_into(self._map, 0, *fields)
+
+    def stats(self):
+        """Return a dict of cache counters, for tuning."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize}
+
+
+class AffinityTable(object):
+    """Size-bounded LRU table of the handler which answered a payload key.
+
+    :class:`WSGIParty` keeps one per service name routed by affinity; see
+    :meth:`WSGIParty.route_by_affinity`.
+    """
+
+    def __init__(self, maxsize=1024, key=payload_key):
+        #: Maximum number of entries; least recently used entries go first.
+        self.maxsize = maxsize
+
+        #: Function turning a payload into a hashable key.
+        self.key = key
+
+        #: Counters of asks routed to a learned handler, of asks which had
+        #: to scan all handlers, and of learned handlers which no longer
+        #: answered.
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+        #: Counter of entries dropped to respect :attr:`maxsize`.
+        self.evictions = 0
+
+        #: Incremented on :meth:`clear`, to refuse handlers learned before.
+        self.generation = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, *fallbacks):
+        """Return the handler learned for key, or for the first of fallbacks
+        learned, or None."""
+        with self._lock:
+            for key in (key,) + fallbacks:
+                handler = self._entries.get(key)
+                if handler is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return handler
+            self.misses += 1
+            return None
+
+    def learn(self, key, handler, generation=None):
+        """Remember handler for key, unless the table was cleared since the
+        given generation was read."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = handler
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def forget(self, key):
+        """Drop the handler learned for key, which no longer answers."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.stale += 1
+
+    def clear(self):
+        """Drop all entries, e.g. when a handler joins the service name."""
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def reset(self):
+        """Drop all entries and counters, e.g. in a freshly forked worker."""
+        self._lock = threading.Lock()
+        self.clear()
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def stats(self):
+        """Return a dict of routing counters, for tuning."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'stale': self.stale, 'evictions': self.evictions,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class _Flight(object):
+    """A dispatch in flight, shared by the asks waiting on it."""
+
+    __slots__ = ('thread', 'done', 'answers', 'error')
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.done = threading.Event()
+        self.answers = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Let concurrent identical asks share one dispatch.
+
+    :class:`WSGIParty` keeps one per coalesced service name; see
+    :meth:`WSGIParty.coalesce_asks`.
+    """
+
+    def __init__(self, key=payload_key):
+        #: Function turning a payload into a hashable key.
+        self.key = key
+
+        self.reset()
+
+    def reset(self):
+        """Drop flights and counters, e.g. in a freshly forked worker."""
+        #: Counters of dispatches made, and of asks which waited on the
+        #: dispatch of another.
+        self.flights = 0
+        self.shared = 0
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, call, deadline=None):
+        """Return call(), or the result of the identical call in flight.
+
+        An error of the call in flight is raised in every waiting thread.
+        Waiting stops at the :data:`clock` time deadline, returning None.
+        Calls made again by the thread in flight, e.g. from a nested ask,
+        run on their own.
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            if flight is None:
+                flight = self._calls[key] = _Flight()
+                self.flights += 1
+                leader = True
+            elif flight.thread is threading.current_thread():
+                flight, leader = None, False
+            else:
+                self.shared += 1
+                leader = False
+        if flight is None:
+            return call()
+        if not leader:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - clock(), 0)
+            if not flight.done.wait(timeout):
+                return None
+            if flight.error is not None:
+                raise flight.error
+            return flight.answers
+        try:
+            flight.answers = call()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._forget(key, flight)
+            flight.done.set()
+        return flight.answers
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._calls.get(key) is flight:
+                del self._calls[key]
+
+    def clear(self):
+        """Let new calls start anew, rather than wait on those in flight,
+        e.g. when a handler joins the service name."""
+        with self._lock:
+            self._calls = {}
+
+    def stats(self):
+        """Return a dict of counters, for tuning."""
+        return {'flights': self.flights, 'shared': self.shared,
+                'in_flight': len(self._calls)}
+
+
+def make_environ(path):
+    """Return a minimal WSGI environ for a GET request to the given path.
+
+    Cheaper than a full werkzeug environ, and needs no werkzeug import; used
+    for lightweight invitations.
+    """
+    return {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+
+def run_app(application, environ):
+    """Call a WSGI application, consume and close its response.
+
+    Returns the status line given to start_response.
+    """
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response.append(status)
+        return lambda data: None
+    app_iter = application(environ, start_response)
+    try:
+        for data in app_iter:
+            pass
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return response[-1] if response else None
+
+
+class Histogram(object):
+    """Latency histogram over fixed bucket upper bounds, in seconds."""
+
+    #: Default bucket upper bounds, in seconds; larger values go to overflow.
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        """Count one observation; callers hold the owner's lock."""
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+
+    def snapshot(self):
+        """Return a dict of bucket bounds, counts and totals."""
+        return {'buckets': list(self.buckets) + ['+Inf'],
+                'counts': list(self.counts), 'count': self.count,
+                'sum': self.total}
+
+
+class OutcomeStats(object):
+    """Counters and a latency histogram of one service or handler."""
+
+    __slots__ = ('labels', 'calls', 'answers', 'misses', 'errors',
+                 'no_such_service', 'connects', 'latency', 'lock')
+
+    def __init__(self, labels, buckets=None):
+        self.labels = labels
+        self.calls = self.answers = self.misses = self.errors = 0
+        self.no_such_service = self.connects = 0
+        self.latency = Histogram(buckets)
+        self.lock = threading.Lock()
+
+    def record(self, seconds, answers=0, misses=0, errors=0):
+        with self.lock:
+            self.calls += 1
+            self.answers += answers
+            self.misses += misses
+            self.errors += errors
+            self.latency.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.labels)
+            data.update(calls=self.calls, answers=self.answers,
+                        misses=self.misses, errors=self.errors,
+                        latency=self.latency.snapshot())
+            if 'handler' not in self.labels:
+                data.update(no_such_service=self.no_such_service,
+                            connects=self.connects)
+            return data
+
+
+class MeteredHandler(object):
+    """Wrap a handler, recording its outcomes and latency in stats.
+
+    :class:`WSGIParty` builds these into dispatch tables when metrics are
+    enabled; the registry itself keeps the handlers as connected.
+    """
+
+    __slots__ = ('handler', 'stats', 'answer_many')
+
+    def __init__(self, handler, stats):
+        self.handler = handler
+        self.stats = stats
+        if hasattr(handler, 'answer_many'):
+            self.answer_many = self._answer_many
+
+    def __call__(self, payload):
+        start = clock()
+        try:
+            answer = self.handler(payload)
+        except HighAndDry:
+            self.stats.record(clock() - start, misses=1)
+            raise
+        except Exception:
+            self.stats.record(clock() - start, errors=1)
+            raise
+        self.stats.record(clock() - start, answers=1)
+        return answer
+
+    def _answer_many(self, payloads):
+        start = clock()
+        try:
+            items = self.handler.answer_many(payloads)
+        except HighAndDry:
+            self.stats.record(clock() - start, misses=len(payloads))
+            raise
+        except Exception:
+            self.stats.record(clock() - start, errors=1)
+            raise
+        misses = len([item for item in items if item is HighAndDry or
+                      isinstance(item, HighAndDry)])
+        self.stats.record(clock() - start, answers=len(items) - misses,
+                          misses=misses)
+        return items
+
+
+def handler_name(handler):
+    """Return a readable name of a handler, for labels."""
+    handler = getattr(handler, 'handler', handler)
+    name = getattr(handler, '__qualname__', None)
+    if name is None:
+        name = getattr(handler, '__name__', None)
+    if name is None:
+        return handler.__class__.__name__
+    module = getattr(handler, '__module__', None)
+    if module:
+        return '%s.%s' % (module, name)
+    return name
+
+
+class PartyMetrics(object):
+    """Outcome counters and latency histograms, per service and handler.
+
+    Services count asks, answers, :class:`HighAndDry` misses, errors,
+    :class:`NoSuchServiceName` and connects; handlers count calls, answers,
+    misses and errors, labeled with the invite path of their operator.
+    """
+
+    def __init__(self, buckets=None):
+        #: Histogram bucket upper bounds, None for :attr:`Histogram.buckets`.
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        """Drop all counters, e.g. in a freshly forked worker."""
+        self.services = {}
+        self.handlers = {}
+        self._lock = threading.Lock()
+
+    def service(self, service_name):
+        """Return the stats of a service name, created on first use."""
+        try:
+            return self.services[service_name]
+        except KeyError:
+            with self._lock:
+                labels = {'service': service_name}
+                return self.services.setdefault(
+                    service_name, OutcomeStats(labels, self.buckets))
+
+    def handler(self, service_name, handler, operator_name=None):
+        """Return the stats of a handler of a service, created on first use."""
+        key = (service_name, handler)
+        try:
+            return self.handlers[key]
+        except KeyError:
+            with self._lock:
+                labels = {'service': service_name,
+                          'handler': handler_name(handler),
+                          'operator': operator_name}
+                return self.handlers.setdefault(
+                    key, OutcomeStats(labels, self.buckets))
+
+    def record_ask(self, service_name, seconds, answers=0, errors=0):
+        self.service(service_name).record(seconds, answers=answers,
+                                          misses=int(not answers and
+                                                     not errors),
+                                          errors=errors)
+
+    def record_no_such_service(self, service_name):
+        stats = self.service(service_name)
+        with stats.lock:
+            stats.no_such_service += 1
+
+    def record_connect(self, service_name):
+        stats = self.service(service_name)
+        with stats.lock:
+            stats.connects += 1
+
+    def snapshot(self):
+        """Return all counters as a JSON-serializable dict."""
+        return {
+            'services': dict((name, stats.snapshot()) for name, stats
+                             in list(self.services.items())),
+            'handlers': [stats.snapshot() for stats
+                         in list(self.handlers.values())],
+        }
+
+
+class StatsApp(object):
+    """WSGI application serving a snapshot of :class:`PartyMetrics` as JSON.
+
+    Mount it in the dispatcher at a private path.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        body = json.dumps(self.metrics.snapshot(), sort_keys=True)
+        body = body.encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class Span(object):
+    """One traced ask or handler call, with the spans nested in it."""
+
+    __slots__ = ('kind', 'service', 'payload', 'handler', 'operator',
+                 'start', 'duration', 'error', 'children', 'thread')
+
+    def __init__(self, kind, service, payload, handler=None, operator=None):
+        self.kind = kind
+        self.service = service
+        self.payload = payload
+        self.handler = handler
+        self.operator = operator
+        self.start = clock()
+        self.duration = None
+        self.error = None
+        self.children = []
+        self.thread = threading.current_thread().ident
+
+    @property
+    def name(self):
+        if self.kind == 'ask':
+            return 'ask %s' % (self.service,)
+        return self.handler
+
+    def to_dict(self):
+        """Return the span tree as a JSON-serializable dict."""
+        return {'name': self.name, 'kind': self.kind, 'service': self.service,
+                'payload': self.payload, 'handler': self.handler,
+                'operator': self.operator, 'start': self.start,
+                'duration': self.duration, 'error': self.error,
+                'children': [child.to_dict() for child in self.children]}
+
+
+class Tracer(object):
+    """Record a span tree for every ask, and stop runaway nesting.
+
+    Asks nested deeper than :attr:`max_depth` raise :class:`AskTooDeep`, and
+    calling a handler whose application is already answering further up the
+    chain raises :class:`AskCycle`, before the handler is called.  The
+    latest :attr:`max_traces` root spans are kept in :attr:`traces`.
+    """
+
+    def __init__(self, max_depth=8, max_traces=100, payload_length=80):
+        #: Maximum number of nested asks.
+        self.max_depth = max_depth
+
+        #: Maximum number of root spans kept.
+        self.max_traces = max_traces
+
+        #: Payloads are recorded as their repr, cut to this length.
+        self.payload_length = payload_length
+
+        self.reset()
+
+    def reset(self):
+        """Drop recorded traces, e.g. in a freshly forked worker."""
+        self.traces = deque(maxlen=self.max_traces)
+        self._stack = ContextVar('partyline_spans', default=())
+
+    def summarize(self, payload):
+        """Return a short string describing a payload."""
+        summary = repr(payload)
+        if len(summary) > self.payload_length:
+            summary = summary[:self.payload_length - 3] + '...'
+        return summary
+
+    def start_ask(self, service_name, payload):
+        """Open an ask span, return a token for :meth:`finish`."""
+        stack = self._stack.get()
+        depth = len([span for span in stack if span.kind == 'ask'])
+        if depth >= self.max_depth:
+            raise AskTooDeep('Asks nest deeper than %d: %s' %
+                             (self.max_depth, self._chain(stack)))
+        span = Span('ask', service_name, self.summarize(payload))
+        return self._push(stack, span)
+
+    def start_handler(self, service_name, handler, operator, payload):
+        """Open a handler span, return a token for :meth:`finish`.
+
+        The operator is the one which connected the handler, if any.
+        """
+        stack = self._stack.get()
+        name = getattr(operator, 'name', None)
+        if operator is not None:
+            for span in stack:
+                if span.kind == 'handler' and span.operator is not None and \
+                   span.operator == name:
+                    raise AskCycle('%s would re-enter %s: %s' %
+                                   (handler_name(handler), name,
+                                    self._chain(stack)))
+        span = Span('handler', service_name, self.summarize(payload),
+                    handler_name(handler), name)
+        return self._push(stack, span)
+
+    def finish(self, token, error=None):
+        """Close the span opened with token."""
+        span, reset = token
+        span.duration = clock() - span.start
+        if error is not None:
+            span.error = '%s: %s' % (error.__class__.__name__, error)
+        self._stack.reset(reset)
+
+    def _push(self, stack, span):
+        if stack:
+            stack[-1].children.append(span)
+        else:
+            self.traces.append(span)
+        return span, self._stack.set(stack + (span,))
+
+    def _chain(self, stack):
+        return ' -> '.join(span.name for span in stack)
+
+    def to_json(self, **kwargs):
+        """Return the recorded traces as a JSON list of span trees."""
+        return json.dumps([span.to_dict() for span in list(self.traces)],
+                          **kwargs)
+
+    def trace_events(self):
+        """Return the recorded traces in the Trace Event Format.
+
+        Load ``json.dumps(tracer.trace_events())`` in chrome://tracing,
+        Perfetto or speedscope for a flame graph.
+        """
+        events = []
+        pid = os.getpid()
+        def walk(span):
+            if span.duration is None:
+                return
+            events.append({'name': span.name, 'cat': span.kind, 'ph': 'X',
+                           'ts': span.start * 1e6,
+                           'dur': span.duration * 1e6,
+                           'pid': pid, 'tid': span.thread,
+                           'args': {'payload': span.payload,
+                                    'operator': span.operator,
+                                    'error': span.error}})
+            for child in span.children:
+                walk(child)
+        for span in list(self.traces):
+            walk(span)
+        return events
+
+
+class TracedHandler(object):
+    """Wrap a handler, recording a span per call in a :class:`Tracer`."""
+
+    __slots__ = ('handler', 'tracer', 'service_name', 'operator',
+                 'answer_many')
+
+    def __init__(self, handler, tracer, service_name, operator):
+        self.handler = handler
+        self.tracer = tracer
+        self.service_name = service_name
+        self.operator = operator
+        if hasattr(handler, 'answer_many'):
+            self.answer_many = self._answer_many
+
+    def __call__(self, payload):
+        token = self.tracer.start_handler(self.service_name, self.handler,
+                                          self.operator, payload)
+        try:
+            answer = self.handler(payload)
+        except Exception as e:
+            self.tracer.finish(token, e)
+            raise
+        self.tracer.finish(token)
+        return answer
+
+    def _answer_many(self, payloads):
+        token = self.tracer.start_handler(self.service_name, self.handler,
+                                          self.operator, payloads)
+        try:
+            items = self.handler.answer_many(payloads)
+        except Exception as e:
+            self.tracer.finish(token, e)
+            raise
+        self.tracer.finish(token)
+        return items
+
+
+#: Absolute :data:`clock` time by which asks made now must be answered.
+_deadline = ContextVar('partyline_deadline', default=None)
+
+
+def current_deadline():
+    """Return the :data:`clock` time asks must be answered by, or None."""
+    return _deadline.get()
+
+
+@contextmanager
+def deadline(seconds):
+    """Answer asks made within the block in at most ``seconds``.
+
+    Handlers not called once the deadline has passed are skipped as misses.
+    Deadlines nest, the earliest one applying.  Yields the deadline.
+    """
+    when = clock() + seconds
+    current = _deadline.get()
+    if current is not None and current < when:
+        when = current
+    token = _deadline.set(when)
+    try:
+        yield when
+    finally:
+        _deadline.reset(token)
+
+
+def _past(deadline):
+    return deadline is not None and clock() >= deadline
+
+
+class _Outcome(object):
+    """Whether answers of the ask in progress may be partial."""
+
+    __slots__ = ('partial',)
+
+    def __init__(self):
+        self.partial = False
+
+
+#: :class:`_Outcome` of the ask in progress, if its answers are to be kept.
+_outcome = ContextVar('partyline_outcome', default=None)
+
+
+def _mark_partial():
+    """Note that the ask in progress missed a handler it should have had."""
+    outcome = _outcome.get()
+    if outcome is not None:
+        outcome.partial = True
+
+
+def _ask_complete(call, *args):
+    """Return the answers of an ask and whether they may be kept.
+
+    Answers are partial, and not to be cached, memoized or learned from,
+    when the deadline passed or a guard skipped a handler or dropped its
+    answer.  Asks around a partial ask are partial too.
+    """
+    outcome = _Outcome()
+    token = _outcome.set(outcome)
+    try:
+        answers = call(*args)
+    finally:
+        _outcome.reset(token)
+    if outcome.partial or _past(_deadline.get()):
+        _mark_partial()
+        return answers, False
+    return answers, True
+
+
+#: Set on executor threads while they call handlers for a fan-out.
+_worker = threading.local()
+
+
+def _call_on_worker(handler, payload):
+    """Call a handler submitted to the executor, flagging the thread.
+
+    Asks nested in the handler are then answered serially, since waiting on
+    the executor from its own threads may deadlock once all are busy.
+    """
+    busy = getattr(_worker, 'busy', False)
+    _worker.busy = True
+    try:
+        return handler(payload)
+    finally:
+        _worker.busy = busy
+
+
+#: Memo of answers of the request being handled, see
+#: :attr:`WSGIParty.memo_key`.
+_memo = ContextVar('partyline_memo', default=None)
+
+
+class _ClosingIterator(object):
+    """Wrap a WSGI response, calling a callback once it is closed."""
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.callback()
+
+
+#: Lane of asks made now, see :func:`priority`.
+_lane = ContextVar('partyline_lane', default=None)
+
+
+@contextmanager
+def priority(lane):
+    """Make asks within the block in the given lane, e.g. ``'bulk'``.
+
+    Asks waiting on a :class:`ConcurrencyLimit` are let in by lane, see
+    :meth:`WSGIParty.limit_asks`.  Asks made outside any block are in the
+    first lane, ``'interactive'`` by default.
+    """
+    token = _lane.set(lane)
+    try:
+        yield lane
+    finally:
+        _lane.reset(token)
+
+
+#: Limits whose slot the ask in progress holds, see :func:`_slot`.
+_holding = ContextVar('partyline_holding', default=())
+
+
+@contextmanager
+def _slot(limit):
+    """Hold a slot of limit within the block, yield False if shed.
+
+    Asks nested in a handler of the limited service go on in the slot of
+    the ask around them, as waiting for another would deadlock once all
+    are taken.
+    """
+    held = _holding.get()
+    if limit in held:
+        yield True
+        return
+    if not limit.acquire(_lane.get(), _deadline.get()):
+        yield False
+        return
+    token = _holding.set(held + (limit,))
+    try:
+        yield True
+    finally:
+        _holding.reset(token)
+        limit.release()
+
+
+class ConcurrencyLimit(object):
+    """Bound the asks of a service name calling handlers at once.
+
+    Asks beyond :attr:`max_concurrent` wait, those of earlier :attr:`lanes`
+    ahead of later ones and in order of arrival within a lane.  Asks are
+    shed when :attr:`max_waiting` asks already wait, or once they waited
+    :attr:`timeout` seconds or past their deadline.  :class:`WSGIParty`
+    keeps one per limited service name; see :meth:`WSGIParty.limit_asks`.
+    """
+
+    def __init__(self, max_concurrent, max_waiting=None, timeout=None,
+                 shed='raise', lanes=('interactive', 'bulk')):
+        if shed not in ('raise', 'empty'):
+            raise ValueError("shed must be 'raise' or 'empty', not %r." %
+                             (shed,))
+
+        #: Maximum number of asks calling handlers at once.
+        self.max_concurrent = max_concurrent
+
+        #: Maximum number of waiting asks, None for no bound.
+        self.max_waiting = max_waiting
+
+        #: Seconds an ask may wait, None to wait until its deadline.
+        self.timeout = timeout
+
+        #: ``'raise'`` to raise :class:`ServiceOverloaded` from shed asks,
+        #: ``'empty'`` to answer them with no answers.
+        self.shed = shed
+
+        #: Lane names, most urgent first.  Asks in unknown lanes, or in
+        #: none, use the first.
+        self.lanes = tuple(lanes)
+
+        self.reset()
+
+    def reset(self):
+        """Drop waiting asks and counters, e.g. in a freshly forked worker."""
+        #: Number of asks calling handlers now.
+        self.active = 0
+
+        #: Counters of asks let in, shed because too many waited, and shed
+        #: after waiting too long, and the most asks seen waiting at once.
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.peak_waiting = 0
+
+        self._queues = OrderedDict((lane, deque()) for lane in self.lanes)
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def acquire(self, lane=None, deadline=None, wait=True):
+        """Let an ask in, return False to shed it.
+
+        Without ``wait``, asks are shed rather than wait.  Call
+        :meth:`release` once the ask is done.
+        """
+        queue = self._queue(lane)
+        with self._lock:
+            if self._let_in():
+                return True
+            if not wait or self._full():
+                self.rejected += 1
+                return False
+            end = self._end(deadline)
+            ticket = self._enqueue(queue)
+            try:
+                while not self._let_in(ticket):
+                    remaining = None if end is None else end - clock()
+                    if remaining is not None and remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._dequeue(queue, ticket)
+
+    def release(self):
+        """Let the next waiting ask in."""
+        with self._lock:
+            self.active -= 1
+            if self._waiting:
+                self._notify()
+
+    # Helpers below are called with the lock held.
+
+    def _queue(self, lane):
+        queue = self._queues.get(lane)
+        if queue is None:
+            queue = self._queues[self.lanes[0]]
+        return queue
+
+    def _let_in(self, ticket=None):
+        # Let in the ask waiting with ticket, or a new ask if none waits,
+        # when there is room for it.
+        if self.active >= self.max_concurrent or self._next() is not ticket:
+            return False
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def _next(self):
+        for queue in self._queues.values():
+            if queue:
+                return queue[0]
+        return None
+
+    def _full(self):
+        return (self.max_waiting is not None and
+                self._waiting >= self.max_waiting)
+
+    def _end(self, deadline):
+        if self.timeout is None:
+            return deadline
+        end = clock() + self.timeout
+        if deadline is not None and deadline < end:
+            end = deadline
+        return end
+
+    def _enqueue(self, queue):
+        ticket = object()
+        queue.append(ticket)
+        self._waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self._waiting)
+        return ticket
+
+    def _dequeue(self, queue, ticket):
+        queue.remove(ticket)
+        self._waiting -= 1
+        self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+
+    def stats(self):
+        """Return a dict of counters and queue depths, for tuning."""
+        with self._lock:
+            return {'active': self.active,
+                    'waiting': dict((lane, len(queue)) for lane, queue
+                                    in self._queues.items()),
+                    'peak_waiting': self.peak_waiting,
+                    'admitted': self.admitted, 'rejected': self.rejected,
+                    'timed_out': self.timed_out,
+                    'max_concurrent': self.max_concurrent,
+                    'max_waiting': self.max_waiting}
+
+
+class CircuitBreaker(object):
+    """Skip a handler for a while after it keeps failing or timing out.
+
+    The breaker is ``closed`` while the handler is called as usual.  After
+    :attr:`failure_threshold` failures in a row it is ``open``, and the
+    handler is skipped for :attr:`reset_timeout` seconds.  It is then
+    ``half-open``: one call is let through to try the handler, and closes the
+    breaker if it succeeds or opens it again if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        #: Number of failures in a row which opens the breaker.
+        self.failure_threshold = failure_threshold
+
+        #: Seconds the breaker stays open before trying the handler again.
+        self.reset_timeout = reset_timeout
+
+        #: One of ``'closed'``, ``'open'`` and ``'half-open'``.
+        self.state = 'closed'
+
+        #: Number of failures in a row; times the breaker opened; calls
+        #: skipped while open.
+        self.failures = 0
+        self.trips = 0
+        self.skipped = 0
+
+        #: :data:`clock` time the breaker last opened, or None.
+        self.opened_at = None
+
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if the handler may be called now."""
+        if self.state == 'closed':
+            return True
+        with self._lock:
+            if (self.state == 'open' and
+                    clock() - self.opened_at >= self.reset_timeout):
+                self.state = 'half-open'
+                return True
+            self.skipped += 1
+            return False
+
+    def succeed(self):
+        """Record a call which did not fail, closing the breaker."""
+        if self.failures or self.state != 'closed':
+            with self._lock:
+                self.failures = 0
+                self.state = 'closed'
+
+    def fail(self):
+        """Record a failed or late call, opening the breaker if need be."""
+        with self._lock:
+            self.failures += 1
+            if (self.state == 'half-open' or
+                    self.failures >= self.failure_threshold):
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self.opened_at = clock()
+
+    def reset(self):
+        """Close the breaker and zero its counters."""
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = self.trips = self.skipped = 0
+        self.opened_at = None
+
+    def snapshot(self):
+        """Return a dict of the breaker's state and counters."""
+        return {'state': self.state, 'failures': self.failures,
+                'trips': self.trips, 'skipped': self.skipped}
+
+
+class GuardedHandler(object):
+    """Wrap a handler, enforcing its time budget and circuit breaker.
+
+    Calls skipped by an open breaker, failed calls and calls taking longer
+    than ``timeout`` seconds raise :class:`HighAndDry`, so that asks go on
+    without them; late answers are dropped.  Any error but HighAndDry is a
+    failure, including partyline errors such as those of unreachable peers.
+    Answers of such asks are not cached, memoized or learned from.  Without
+    a breaker, errors are raised as usual.
+    """
+
+    __slots__ = ('handler', 'breaker', 'timeout', 'answer_many')
 
+    def __init__(self, handler, breaker, timeout):
+        self.handler = handler
+        self.breaker = breaker
+        self.timeout = timeout
+        if hasattr(handler, 'answer_many'):
+            self.answer_many = self._answer_many
 
-class NoSuchServiceName(PartylineException):
-    """Raised when no handlers are registered for a requested service name."""
+    def __call__(self, payload):
+        return self._guard(self.handler, payload)
+
+    def _answer_many(self, payloads):
+        return self._guard(self.handler.answer_many, payloads)
+
+    def _guard(self, call, arg):
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            _mark_partial()
+            raise HighAndDry()
+        start = clock()
+        try:
+            result = call(arg)
+        except HighAndDry:
+            # A handler without an answer is healthy.
+            if breaker is not None:
+                breaker.succeed()
+            raise
+        except Exception:
+            if breaker is None:
+                raise
+            breaker.fail()
+            _mark_partial()
+            raise HighAndDry()
+        if self.timeout is not None and clock() - start > self.timeout:
+            if breaker is not None:
+                breaker.fail()
+            _mark_partial()
+            raise HighAndDry()
+        if breaker is not None:
+            breaker.succeed()
+        return result
+
+
+class WeakHandler(object):
+    """Handler held by weak reference, given weak_handlers=True.
+
+    Bound methods are held by a weak reference to their object, so that the
+    registry does not keep their application alive.  Once the handler is
+    collected, calls raise :class:`HighAndDry` until the party drops it.
+    """
+
+    __slots__ = ('ref', 'func', 'answer_many')
+
+    def __init__(self, handler, callback=None):
+        #: Function of a bound method handler, called with the referent.
+        self.func = getattr(handler, '__func__', None)
+        if self.func is None:
+            self.ref = weakref.ref(handler, callback)
+        else:
+            self.ref = weakref.ref(handler.__self__, callback)
+        if hasattr(handler, 'answer_many'):
+            self.answer_many = self._answer_many
+
+    @property
+    def handler(self):
+        """The handler, or None once collected."""
+        target = self.ref()
+        if target is None or self.func is None:
+            return target
+        return self.func.__get__(target)
+
+    def __call__(self, payload):
+        target = self.ref()
+        if target is None:
+            raise HighAndDry()
+        if self.func is None:
+            return target(payload)
+        return self.func(target, payload)
+
+    def _answer_many(self, payloads):
+        handler = self.handler
+        if handler is None:
+            return [HighAndDry] * len(payloads)
+        return handler.answer_many(payloads)
+
+
+class Announcer(object):
+    """Bounded queue delivering announcements on a background thread.
+
+    :class:`WSGIParty` keeps one for :meth:`WSGIParty.announce`.  The thread
+    starts with the first announcement.  When :attr:`maxsize` announcements
+    are pending, the next one is delivered on the caller's thread instead,
+    so that none is lost.
+    """
+
+    def __init__(self, deliver, maxsize=1024, coalesce=False,
+                 key=payload_key):
+        #: Callable taking service name, payload and operator, delivering an
+        #: announcement and returning the number of handlers which failed.
+        self.deliver = deliver
+
+        #: Maximum number of pending announcements.
+        self.maxsize = maxsize
+
+        #: If True, drop an announcement identical to a pending one.
+        self.coalesce = coalesce
+
+        #: Function turning a payload into a hashable key, for coalescing.
+        self.key = key
+
+        self.reset()
+
+    def reset(self):
+        """Drop pending announcements and counters, e.g. after a fork."""
+        #: Counters of announcements delivered, coalesced into a pending
+        #: one and delivered on the caller's thread for lack of room, and
+        #: of handlers which failed.
+        self.delivered = 0
+        self.coalesced = 0
+        self.overflows = 0
+        self.errors = 0
+        self.closed = False
+        self._queue = deque()
+        self._pending = set()
+        self._busy = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, service_name, payload, operator=None):
+        """Queue an announcement, return False if coalesced.
+
+        Once closed, announcements are delivered on the caller's thread.
+        """
+        key = None
+        if self.coalesce:
+            try:
+                key = (service_name, operator, self.key(payload))
+                hash(key)
+            except TypeError:
+                key = None
+        with self._cond:
+            if key is not None and key in self._pending:
+                self.coalesced += 1
+                return False
+            inline = self.closed or len(self._queue) >= self.maxsize
+            if inline:
+                if not self.closed:
+                    self.overflows += 1
+            else:
+                self._queue.append((service_name, payload, operator, key))
+                if key is not None:
+                    self._pending.add(key)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run,
+                                                    name='partyline-announce')
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._cond.notify()
+        if inline:
+            self._deliver(service_name, payload, operator)
+        return True
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._queue and not self.closed:
+                    cond.wait()
+                if not self._queue:
+                    return
+                service_name, payload, operator, key = self._queue.popleft()
+                self._pending.discard(key)
+                self._busy += 1
+            try:
+                self._deliver(service_name, payload, operator)
+            finally:
+                with cond:
+                    self._busy -= 1
+                    cond.notify_all()
+
+    def _deliver(self, service_name, payload, operator):
+        try:
+            errors = self.deliver(service_name, payload, operator)
+        except Exception:
+            errors = 1
+        with self._cond:
+            self.delivered += 1
+            self.errors += errors
+
+    def flush(self, timeout=None):
+        """Wait until pending announcements are delivered.
+
+        Returns False if some are still pending after timeout seconds.
+        """
+        end = None if timeout is None else clock() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                remaining = None if end is None else end - clock()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Deliver pending announcements, then stop the thread.
+
+        Returns False if some are still pending after timeout seconds.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        return self.flush(timeout)
+
+    def stats(self):
+        """Return the counters and the number of pending announcements."""
+        return {'delivered': self.delivered, 'coalesced': self.coalesced,
+                'overflows': self.overflows, 'errors': self.errors,
+                'pending': len(self._queue), 'maxsize': self.maxsize}
+
+
+class LazyInvite(object):
+    """An invite path which is only called when one of its services is asked.
+
+    Give these among the invites of :class:`WSGIParty`, declaring the service
+    names the invited application provides.  The invitation is sent on the
+    first ask for any of them, so processes which never ask those services
+    never pay for the application joining.
+    """
+
+    def __init__(self, path, service_names):
+        #: Invite path, as for plain invites.
+        self.path = path
+
+        #: Service names the invited application connects handlers for.
+        self.service_names = tuple(service_names)
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.path,
+                               self.service_names)
 
 
 class PartylineOperator(object):
@@ -30,6 +1691,8 @@ class PartylineOperator(object):
     handling a request from itself.
     """
 
+    __slots__ = ('partyline', 'handlers', 'name')
+
     def __init__(self, partyline):
         #: Instance of :class:`WSGIParty`, required argument.
         self.partyline = partyline
@@ -37,18 +1700,65 @@ class PartylineOperator(object):
         #: Set of handlers added through :meth:`connect`.
         self.handlers = set()
 
-    def connect(self, service_name, handler):
-        """Connect a handler :meth:`ask_around` calls for service_name."""
-        self.handlers.add(handler)
-        return self.partyline.connect(service_name, handler)
+        #: Invite path of the application using this operator, for labels.
+        self.name = None
+
+    def connect(self, service_name, handler, **options):
+        """Connect a handler :meth:`ask_around` calls for service_name.
 
-    def ask_around(self, service_name, payload):
+        Options such as declared ``keys`` are passed on to
+        :meth:`WSGIParty.connect`.
+        """
+        entry = handler
+        if getattr(self.partyline, 'weak_handlers', False):
+            # Track the weak entry, so that the handler is not kept alive.
+            entry = self.partyline.weak_handler(service_name, handler)
+        self.handlers.add(entry)
+        return self.partyline.connect(service_name, entry, **options)
+
+    def ask_around(self, service_name, payload, quorum=None):
         """Ask all handlers of a given service name, return list of answers.
 
         Handlers connected through this instance are skipped, so that
-        applications do not call themselves.
+        applications do not call themselves.  See :meth:`WSGIParty.ask_around`
+        for ``quorum``.
+        """
+        return self.partyline.ask_around(service_name, payload, operator=self,
+                                         quorum=quorum)
+
+    def announce(self, service_name, payload):
+        """Tell all handlers of a given service name, without waiting.
+
+        Handlers connected through this instance are skipped.  See
+        :meth:`WSGIParty.announce`.
+        """
+        return self.partyline.announce(service_name, payload, operator=self)
+
+    def iter_answers(self, service_name, payload):
+        """Ask handlers of a given service name one at a time, lazily.
+
+        Like :meth:`ask_around`, but handlers are called only as answers are
+        consumed from the returned iterator.
+        """
+        return self.partyline.iter_answers(service_name, payload,
+                                           operator=self)
+
+    def ask_first(self, service_name, payload, default=None):
+        """Return the first answer for a given service name, else default.
+
+        No more handlers are called once one of them has answered.
+        """
+        return self.partyline.ask_first(service_name, payload, default,
+                                        operator=self)
+
+    def ask_around_many(self, service_name, payloads):
+        """Ask handlers of a given service name about several payloads.
+
+        Returns a list of answer lists, one per payload.  See
+        :meth:`WSGIParty.ask_around_many`.
         """
-        return self.partyline.ask_around(service_name, payload, operator=self)
+        return self.partyline.ask_around_many(service_name, payloads,
+                                              operator=self)
 
 
 class WSGIParty(object):
@@ -57,56 +1767,1238 @@ class WSGIParty(object):
     #: Key in environ with reference to the partyline operator.
     partyline_key = 'partyline'
 
+    #: Key in environ with the :data:`clock` time asks must be answered by.
+    deadline_key = 'partyline.deadline'
+
+    #: Key in environ with the request's memo of answers, a dict, given
+    #: request_memo=True.  Asks made while the application is called look up
+    #: identical earlier asks of the same request there, and the memo is
+    #: emptied once the response is closed.
+    memo_key = 'partyline.memo'
+
     #: Class to use as the partyline operator, for connecting handlers.
     operator_class = PartylineOperator
 
-    def __init__(self, application, invites=(), ignore_missing_services=False):
+    #: Class to use for answer caches, see :meth:`cache_answers`.
+    cache_class = AnswerCache
+
+    #: Class to use for answer caches shared through a file.
+    shared_cache_class = SharedAnswerCache
+
+    #: Class to use for affinity tables, see :meth:`route_by_affinity`.
+    affinity_class = AffinityTable
+
+    #: Class to use for coalescing identical asks, see :meth:`coalesce_asks`.
+    flight_class = SingleFlight
+
+    #: Class to use for concurrency limits, see :meth:`limit_asks`.
+    limit_class = ConcurrencyLimit
+
+    #: Class to use for calling handlers concurrently, given max_workers.
+    executor_class = ThreadPoolExecutor
+
+    #: Class to use for metrics, given metrics=True.
+    metrics_class = PartyMetrics
+
+    #: Class to use for tracing, given tracing=True.
+    tracer_class = Tracer
+
+    #: Class to use for circuit breakers, given breakers.
+    breaker_class = CircuitBreaker
+
+    #: Class wrapping handlers with a time budget or circuit breaker.
+    guard_class = GuardedHandler
+
+    #: Class holding handlers by weak reference, given weak_handlers=True.
+    weak_handler_class = WeakHandler
+
+    #: Class delivering announcements, see :meth:`announce`.
+    announcer_class = Announcer
+
+    def __init__(self, application, invites=(), ignore_missing_services=False,
+                 max_workers=None, preload=False, lightweight_invites=False,
+                 invite_workers=None, metrics=False, tracing=False,
+                 request_timeout=None, breakers=False, request_memo=False,
+                 weak_handlers=False, announcements=None):
         #: WSGIParty's wrapped WSGI application.
         self.application = application
 
-        #: A dict of service name => handler mappings.
+        #: A dict of service name => tuple of handlers.  :meth:`connect`
+        #: replaces the dict rather than changing it, so that asks read a
+        #: consistent registry without locking.
         self.handlers = {}
 
+        #: Operators handed out by :meth:`send_invitations`.
+        self.operators = []
+
+        #: True once :meth:`freeze` was called; :meth:`connect` then raises.
+        self.frozen = False
+
+        #: Precomputed dispatch tables, service name => operator => tuple of
+        #: handlers visible to that operator.  Rebuilt lazily after
+        #: :meth:`connect` changes the handlers of a service name.
+        self.dispatch_tables = {}
+
+        #: Answer caches, service name => :attr:`cache_class` instance.
+        self.caches = {}
+
+        #: Affinity tables, service name => :attr:`affinity_class` instance.
+        self.affinities = {}
+
+        #: Coalesced service names, service name => :attr:`flight_class`
+        #: instance.
+        self.flights = {}
+
+        #: Concurrency limits, service name => :attr:`limit_class` instance.
+        self.limits = {}
+
+        #: Keys declared on :meth:`connect`, service name => handler =>
+        #: frozenset of keys, and the function turning a payload into a key,
+        #: service name => function.
+        self.declared_keys = {}
+        self.key_functions = {}
+
+        #: Indexes built along with :attr:`dispatch_tables` from declared
+        #: keys, service name => operator => (key => tuple of handlers,
+        #: tuple of handlers for undeclared keys).
+        self.key_indexes = {}
+
+        #: Executor calling handlers concurrently on :meth:`ask_around`, or
+        #: None to call them one at a time.  Created from
+        #: :attr:`executor_class` when max_workers is given.
+        self.executor = None
+        self.max_workers = max_workers
+        if max_workers is not None:
+            self.executor = self.executor_class(max_workers)
+
         #: If True, suppress :class:`NoSuchServiceName` errors. Default: False.
         self.ignore_missing_services = ignore_missing_services
 
+        #: If True, invite with :func:`make_environ` instead of werkzeug.
+        self.lightweight_invites = lightweight_invites
+
+        #: Number of invitations to send concurrently, None for one at a time.
+        self.invite_workers = invite_workers
+
+        #: Seconds each invitation took, invite path => seconds.
+        self.invite_timings = OrderedDict()
+
+        #: Pending :class:`LazyInvite` instances, service name => list.
+        self.lazy_invites = {}
+
+        #: :attr:`metrics_class` instance recording asks, or None to skip the
+        #: bookkeeping.  Set with metrics=True.
+        self.metrics = self.metrics_class() if metrics else None
+
+        #: :attr:`tracer_class` instance recording a span tree per ask and
+        #: limiting nested asks, or None.  Set with tracing=True.
+        self.tracer = self.tracer_class() if tracing else None
+
+        #: Seconds each request has to answer its asks, or None.  A deadline
+        #: already found in the environ at :attr:`deadline_key` is kept.
+        self.request_timeout = request_timeout
+
+        #: Circuit breakers, (service name, handler) => :attr:`breaker_class`
+        #: instance, or None to call failing handlers as usual.  Set with
+        #: breakers=True, or a dict of options for :attr:`breaker_class`.
+        self.breakers = None
+        self.breaker_options = {}
+        if breakers:
+            self.breakers = {}
+            if isinstance(breakers, dict):
+                self.breaker_options = breakers
+
+        #: Time budgets given on :meth:`connect`, service name => handler =>
+        #: seconds.
+        self.timeouts = {}
+
+        #: If True, memoize answers per request, see :attr:`memo_key`.
+        self.request_memo = request_memo
+
+        #: If True, hold handlers by weak reference, see :meth:`weak_handler`,
+        #: so that connecting does not keep applications alive.
+        self.weak_handlers = weak_handlers
+
+        #: :attr:`announcer_class` instance delivering :meth:`announce`,
+        #: created with the dict of options given as announcements, e.g.
+        #: ``{'maxsize': 100, 'coalesce': True}``.
+        self.announcer = self.announcer_class(self.deliver_announcement,
+                                              **(announcements or {}))
+
+        # Service names with collected handlers, for purge.
+        self._collected = deque()
+        self._collectors = {}
+
+        self._connect_lock = threading.Lock()
+        self._lazy_lock = threading.RLock()
+        self._inviting = set()
+
+        # Whether after_fork is registered to run in forked children.
+        self._fork_hooked = False
+
         self.send_invitations(invites)
+        if preload:
+            self.freeze()
 
     def __call__(self, environ, start_response):
-        """Call WSGIParty's wrapped application."""
-        return self.application(environ, start_response)
+        """Call WSGIParty's wrapped application.
+
+        With a deadline in the environ or a :attr:`request_timeout`, asks
+        made while the application runs get a deadline, see :func:`deadline`.
+        With :attr:`request_memo`, they share a memo, see :attr:`memo_key`.
+        """
+        when = environ.get(self.deadline_key)
+        if when is None:
+            if self.request_timeout is None and not self.request_memo:
+                return self.application(environ, start_response)
+            if self.request_timeout is not None:
+                when = environ[self.deadline_key] = (clock() +
+                                                     self.request_timeout)
+        deadline_token = memo_token = memo = None
+        if when is not None:
+            deadline_token = _deadline.set(when)
+        if self.request_memo:
+            memo = environ.setdefault(self.memo_key, {})
+            memo_token = _memo.set(memo)
+        try:
+            app_iter = self.application(environ, start_response)
+        finally:
+            if memo_token is not None:
+                _memo.reset(memo_token)
+            if deadline_token is not None:
+                _deadline.reset(deadline_token)
+        if memo is None:
+            return app_iter
+        return _ClosingIterator(app_iter, memo.clear)
+
+    def finalize(self):
+        """Return the WSGI application for the server to call per request.
+
+        Unless the party has work to do on each request -- a
+        :attr:`request_timeout` or :attr:`request_memo` -- this is the
+        wrapped application itself, which spares every request a call
+        through the party.  The partyline stays reachable through the
+        operators handed out on invitation.  Deadlines put in the environ
+        at :attr:`deadline_key` are then ignored; use :func:`deadline`.
+        """
+        if self.request_timeout is None and not self.request_memo:
+            return self.application
+        return self
+
+    def close(self, timeout=None):
+        """Release resources held by the party, e.g. the executor.
+
+        Pending announcements are delivered first, waiting up to timeout
+        seconds.
+        """
+        self.announcer.close(timeout)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
 
     def send_invitations(self, invites):
-        """Call each invite route to establish a partyline. Called on init."""
+        """Call each invite route to establish a partyline. Called on init.
+
+        With :attr:`invite_workers`, invitations are sent concurrently, which
+        requires mount points to join independently of each other.  The time
+        each invitation took is recorded in :attr:`invite_timings`.
+        :class:`LazyInvite` instances are kept in :attr:`lazy_invites` until
+        one of their services is asked.
+        """
+        invitations = []
         for invite in invites:
-            environ = create_environ(path=invite)
-            environ[self.partyline_key] = self.operator_class(self)
+            if isinstance(invite, LazyInvite):
+                with self._lazy_lock:
+                    for service_name in invite.service_names:
+                        self.lazy_invites.setdefault(service_name,
+                                                     []).append(invite)
+                continue
+            operator = self.operator_class(self)
+            self.operators.append(operator)
+            invitations.append((invite, operator))
+        if self.invite_workers is None or len(invitations) < 2:
+            for invite, operator in invitations:
+                self.invite(invite, operator)
+            return
+        executor = ThreadPoolExecutor(self.invite_workers)
+        try:
+            # Consume results to raise the first error, if any.
+            list(executor.map(lambda args: self.invite(*args), invitations))
+        finally:
+            executor.shutdown()
+
+    def invite(self, path, operator):
+        """Send one invitation, handing the operator to the invited app."""
+        operator.name = path
+        start = clock()
+        if self.lightweight_invites:
+            environ = make_environ(path)
+            environ[self.partyline_key] = operator
+            run_app(self.application, environ)
+        else:
+            from werkzeug.test import create_environ, run_wsgi_app
+            environ = create_environ(path=path)
+            environ[self.partyline_key] = operator
             run_wsgi_app(self.application, environ)
+        self.invite_timings[path] = clock() - start
 
-    def connect(self, service_name, handler):
-        """Register a handler for a given service name."""
-        self.handlers.setdefault(service_name, []).append(handler)
+    def send_lazy_invitations(self, service_name=None):
+        """Send pending lazy invitations for service_name, or all of them.
 
-    def ask_around(self, service_name, payload, operator=None):
-        """Ask all handlers of a given service name, return list of answers.
+        Asking a service name calls this on first use.  Concurrent callers are
+        serialized, and each invitation is sent once.  An invitation which
+        raises stays pending, its handlers disconnected, and is sent again by
+        the next ask.
+        """
+        with self._lazy_lock:
+            if service_name is None:
+                pending = [i for invites in self.lazy_invites.values()
+                           for i in invites]
+            else:
+                pending = list(self.lazy_invites.get(service_name, ()))
+            for invite in pending:
+                if invite in self._inviting:
+                    # The app being invited asks while joining; go ahead.
+                    continue
+                self._inviting.add(invite)
+                operator = self.operator_class(self)
+                self.operators.append(operator)
+                try:
+                    self.invite(invite.path, operator)
+                except Exception:
+                    # Keep it pending, so that the next ask tries again.
+                    self._uninvite(operator)
+                    raise
+                finally:
+                    self._inviting.discard(invite)
+                # Drop it only now, so that concurrent askers wait on the
+                # lock instead of seeing a partially joined service.
+                for name in invite.service_names:
+                    invites = self.lazy_invites.get(name, [])
+                    if invite in invites:
+                        invites.remove(invite)
+                    if not invites:
+                        self.lazy_invites.pop(name, None)
 
-        Handlers connected through the optionally given operator are skipped,
-        so that partyline applications do not call themselves.
+    def _uninvite(self, operator):
+        """Drop an operator whose invitation failed, and its handlers."""
+        self.operators.remove(operator)
+        for service_name, handlers in list(self.handlers.items()):
+            for handler in handlers:
+                if handler in operator.handlers:
+                    self.disconnect(service_name, handler)
+
+    def freeze(self, gc_freeze=True):
+        """Finish building the partyline before a pre-fork server forks.
+
+        Dispatch tables are built for every invited operator, and
+        :meth:`connect` raises from now on, so that worker processes share
+        the registry's memory pages with the parent.  With ``gc_freeze``, all
+        objects allocated so far are moved out of the garbage collector's
+        reach, keeping the collector from touching and thus copying those
+        pages.  :meth:`after_fork` is registered to run in forked children.
+        Pending lazy invitations are sent first.
         """
-        answers = []
+        self.send_lazy_invitations()
+        for service_name in self.handlers:
+            self.invalidate(service_name)
+            for operator in [None] + self.operators:
+                self.dispatch_table(service_name, operator)
+        self.frozen = True
+        if os.name == 'posix' and not self._fork_hooked:
+            # Windows has no fork.  Hooks cannot be unregistered, so register
+            # once however often the party is frozen.
+            os.register_at_fork(after_in_child=self.after_fork)
+            self._fork_hooked = True
+        if gc_freeze:
+            gc.collect()
+            gc.freeze()
+
+    def after_fork(self):
+        """Reset per-worker state in a freshly forked worker process.
+
+        Caches, metrics and counters are emptied and the executor, whose
+        threads do not survive a fork, is created anew.  :meth:`freeze`
+        registers this to run automatically; otherwise call it from the
+        server's post-fork hook.
+        """
+        for cache in self.caches.values():
+            cache.reset()
+        self.announcer.reset()
+        for affinity in self.affinities.values():
+            affinity.reset()
+        for flight in self.flights.values():
+            flight.reset()
+        for limit in self.limits.values():
+            limit.reset()
+        if self.metrics is not None:
+            self.metrics.reset()
+        if self.tracer is not None:
+            self.tracer.reset()
+        for breaker in (self.breakers or {}).values():
+            breaker.reset()
+        if self.max_workers is not None:
+            self.executor = self.executor_class(self.max_workers)
+
+    def connect(self, service_name, handler, keys=None, key=None,
+                timeout=None):
+        """Register a handler for a given service name.
+
+        A handler which can only answer some payloads may declare ``keys``,
+        the keys of the payloads it answers, e.g. the endpoints an
+        application owns for ``'url'``.  Asks then call only handlers which
+        declared the payload's key, along with handlers declaring no keys.
+        ``key`` turns a payload into its key, e.g. the endpoint of a
+        ``(endpoint, values)`` payload, and is shared by all handlers of the
+        service name; default: :func:`payload_key`.
+
+        Answers taking longer than ``timeout`` seconds are dropped, as if the
+        handler raised :class:`HighAndDry`, and count as failures for its
+        circuit breaker.
+
+        Returns the handler as registered, a :attr:`weak_handler_class`
+        instance given weak_handlers=True.
+        """
+        if self.frozen:
+            raise PartylineException('Cannot connect to %r, the partyline is '
+                                     'frozen.' % (service_name,))
+        # Keep handler referenced until registered, so that it is purged
+        # if collected right away.
+        entry = self.weak_handler(service_name, handler)
+        with self._connect_lock:
+            if key is not None:
+                known = self.key_functions.setdefault(service_name, key)
+                if known is not key:
+                    raise PartylineException('Handlers of %r already use '
+                                             'key %r.' % (service_name, known))
+            if keys is not None:
+                self.key_functions.setdefault(service_name, payload_key)
+                declared = dict(self.declared_keys.get(service_name, ()))
+                declared[entry] = frozenset(keys)
+                self.declared_keys[service_name] = declared
+            if timeout is not None:
+                timeouts = dict(self.timeouts.get(service_name, ()))
+                timeouts[entry] = timeout
+                self.timeouts[service_name] = timeouts
+            # Swap in a new registry rather than changing the one asks may
+            # be reading.
+            handlers = dict(self.handlers)
+            handlers[service_name] = \
+                tuple(handlers.get(service_name, ())) + (entry,)
+            self.handlers = handlers
+            self.invalidate(service_name)
+            self._purge()
+        if self.metrics is not None:
+            self.metrics.record_connect(service_name)
+        return entry
+
+    def weak_handler(self, service_name, handler):
+        """Return the entry registering handler given weak_handlers=True.
+
+        This is a :attr:`weak_handler_class` instance, which the party drops
+        once the handler is collected.  Handlers which cannot be weakly
+        referenced, and all handlers without weak_handlers, are returned as
+        they are.  Connect handlers the application keeps a reference to,
+        e.g. its bound methods, not lambdas made on invitation.
+        """
+        if (not self.weak_handlers or
+                isinstance(handler, self.weak_handler_class)):
+            return handler
+        try:
+            return self.weak_handler_class(handler,
+                                           self._collector(service_name))
+        except TypeError:
+            return handler
+
+    def _collector(self, service_name):
+        # One weakref callback per service name, shared by its handlers.
+        try:
+            return self._collectors[service_name]
+        except KeyError:
+            return self._collectors.setdefault(
+                service_name, partial(self._handler_collected, service_name))
+
+    def _handler_collected(self, service_name, ref):
+        # Called by the garbage collector, possibly with the lock held.
+        self._collected.append(service_name)
+        if self._connect_lock.acquire(False):
+            try:
+                self._purge()
+            finally:
+                self._connect_lock.release()
+
+    def purge(self):
+        """Disconnect weakly held handlers which were collected.
+
+        This happens on its own as handlers are collected, unless the
+        collector runs while the registry is being changed; then the next
+        :meth:`connect` or :meth:`disconnect` purges.  Once frozen, collected
+        handlers stay registered and answer nothing.
+        """
+        with self._connect_lock:
+            self._purge()
+
+    def _purge(self):
+        collected = self._collected
+        if self.frozen:
+            collected.clear()
+            return
+        while collected:
+            service_name = collected.popleft()
+            self._disconnect(service_name, [
+                h for h in self.handlers.get(service_name, ())
+                if isinstance(h, WeakHandler) and h.handler is None])
+
+    def disconnect(self, service_name, handler):
+        """Unregister a handler of a given service name.
+
+        Its declared keys, time budget and circuit breaker are dropped along
+        with it.  Returns False if handler was not connected.
+        """
+        if self.frozen:
+            raise PartylineException('Cannot disconnect from %r, the '
+                                     'partyline is frozen.' % (service_name,))
+        with self._connect_lock:
+            removed = self._disconnect(service_name, [
+                h for h in self.handlers.get(service_name, ())
+                if h is handler or
+                isinstance(h, WeakHandler) and h.handler == handler])
+            self._purge()
+        return bool(removed)
+
+    def _disconnect(self, service_name, removed):
+        """Drop handlers and their state, with the connect lock held."""
+        if not removed:
+            return removed
+        remaining = tuple(h for h in self.handlers[service_name]
+                          if h not in removed)
+        handlers = dict(self.handlers)
+        if remaining:
+            handlers[service_name] = remaining
+        else:
+            del handlers[service_name]
+        self.handlers = handlers
+        for options in (self.declared_keys, self.timeouts):
+            known = options.get(service_name)
+            if known and any(h in known for h in removed):
+                known = dict(known)
+                for h in removed:
+                    known.pop(h, None)
+                options[service_name] = known
+        for h in removed:
+            if self.breakers is not None:
+                self.breakers.pop((service_name, h), None)
+            if self.metrics is not None:
+                self.metrics.handlers.pop((service_name, h), None)
+            if any(h in others for others in handlers.values()):
+                # Still connected for other service names.
+                continue
+            for operator in self.operators:
+                if h in operator.handlers:
+                    operator.handlers.discard(h)
+        self.invalidate(service_name)
+        return removed
+
+    def invalidate(self, service_name):
+        """Drop state derived from the handlers of the given service name.
+
+        :meth:`connect` calls this; call it after changing :attr:`handlers`
+        directly once asks have started.
+        """
+        # Copy on write, in this order; see dispatch_table.
+        indexes = dict(self.key_indexes)
+        indexes.pop(service_name, None)
+        self.key_indexes = indexes
+        tables = dict(self.dispatch_tables)
+        tables.pop(service_name, None)
+        self.dispatch_tables = tables
+        cache = self.caches.get(service_name)
+        if cache is not None:
+            cache.clear()
+        affinity = self.affinities.get(service_name)
+        if affinity is not None:
+            affinity.clear()
+        flight = self.flights.get(service_name)
+        if flight is not None:
+            flight.clear()
+
+    def coalesce_asks(self, service_name, key=payload_key):
+        """Let concurrent identical asks of a service name share one call of
+        its handlers.
+
+        While an ask is calling the handlers, asks from other threads with
+        the same operator, quorum and payload key wait for its answers, or
+        its error, instead of calling them again, e.g. when every request
+        builds the same links after a deploy.  Payloads ``key`` cannot make
+        hashable are asked as usual.  Waiting asks stop at their deadline,
+        without answers.  Returns the :attr:`flight_class` instance, which
+        counts dispatches and shared asks.
+        """
+        flight = self.flight_class(key=key)
+        self.flights[service_name] = flight
+        return flight
+
+    def limit_asks(self, service_name, max_concurrent, max_waiting=None,
+                   timeout=None, shed='raise', lanes=('interactive', 'bulk')):
+        """Bound the asks of a given service name calling handlers at once.
+
+        At most ``max_concurrent`` asks call the handlers at a time, so that
+        a burst of asks to an expensive service does not tie up every
+        worker thread.  Others wait, at most ``max_waiting`` of them, for at
+        most ``timeout`` seconds or until their deadline.  Waiting asks are
+        let in by lane, see :func:`priority`, so that interactive asks go
+        ahead of bulk ones.  Asks which are not let in are shed: with
+        ``shed='raise'`` they raise :class:`ServiceOverloaded`, with
+        ``shed='empty'`` they get no answers.  Answers from caches and
+        coalesced asks are not limited, nor are asks nested in the handlers
+        of a limited ask, which go on in its slot.  Returns the
+        :attr:`limit_class` instance, which counts waiting, let in and shed
+        asks.
+        """
+        limit = self.limit_class(max_concurrent, max_waiting=max_waiting,
+                                 timeout=timeout, shed=shed, lanes=lanes)
+        self.limits[service_name] = limit
+        return limit
+
+    def route_by_affinity(self, service_name, maxsize=1024, key=payload_key):
+        """Route asks of a given service name to the handler which answered.
+
+        For services where at most one handler answers a given payload, such
+        as ``'url'``, the handler answering a payload is remembered per asking
+        operator and payload key, and later asks for that key call only that
+        handler.  A handler found by an ask whose quorum cut the scan short is
+        remembered for that quorum only.  Asks for unknown keys, or whose
+        remembered handler raises :class:`HighAndDry`, call every handler one
+        at a time.  The table holds at most ``maxsize`` keys and is cleared
+        whenever a handler connects to the service name.  Returns the table,
+        which counts its hits and misses.
+        """
+        affinity = self.affinity_class(maxsize=maxsize, key=key)
+        self.affinities[service_name] = affinity
+        return affinity
+
+    def cache_answers(self, service_name, maxsize=128, ttl=None,
+                      key=payload_key, path=None, **options):
+        """Memoize answers of :meth:`ask_around` for a given service name.
+
+        Answers are cached per asking operator and payload, where ``key``
+        turns a payload into a hashable cache key.  The cache holds at most
+        ``maxsize`` entries, each for at most ``ttl`` seconds if given, and is
+        cleared whenever a handler connects to the service name.  Only cache
+        services whose handlers answer the same payload the same way.
+        Returns the cache, which counts its hits and misses.
+
+        Given a ``path``, the cache is a :attr:`shared_cache_class` instance
+        storing answers in that file, shared with every process of the host
+        using it; other options, e.g. ``slot_size``, are passed on.
+        """
+        if path is None:
+            cache = self.cache_class(maxsize=maxsize, ttl=ttl, key=key)
+        else:
+            cache = self.shared_cache_class(path, maxsize=maxsize, ttl=ttl,
+                                            key=key, **options)
+        self.caches[service_name] = cache
+        return cache
+
+    def dispatch_table(self, service_name, operator=None):
+        """Return a tuple of the handlers an operator sees for service_name.
+
+        Handlers connected through the operator are left out, so that
+        partyline applications do not call themselves.  The table is built on
+        first use and kept until the service name is invalidated.  Building it
+        sends pending lazy invitations for the service name.
+        """
+        tables = self.dispatch_tables
+        try:
+            return tables[service_name][operator]
+        except KeyError:
+            pass
+        if service_name in self.lazy_invites:
+            self.send_lazy_invitations(service_name)
+            tables = self.dispatch_tables
+        # Read in the reverse order of invalidate: a table built from an
+        # older registry is stored in an older, discarded dict.
+        indexes = self.key_indexes
         try:
             service_handlers = self.handlers[service_name]
         except KeyError:
+            if self.metrics is not None:
+                self.metrics.record_no_such_service(service_name)
             if not self.ignore_missing_services:
                 raise NoSuchServiceName('No handler is registered for %r.' %
                                         repr(service_name))
-            service_handlers = []
-        for handler in service_handlers:
-            if operator is not None and handler in operator.handlers:
-                # Skip handlers on the same operator, ask *others* for answer.
+            return ()
+        if operator is None:
+            visible = service_handlers
+        else:
+            # Skip handlers on the same operator, ask *others* for answer.
+            own = operator.handlers
+            visible = [h for h in service_handlers if h not in own]
+        table = tuple(self.wrap_handler(service_name, h) for h in visible)
+        declared = self.declared_keys.get(service_name)
+        if declared:
+            indexes.setdefault(service_name, {})[operator] = \
+                self._key_index(declared, visible, table)
+        tables.setdefault(service_name, {})[operator] = table
+        return table
+
+    def _key_index(self, declared, handlers, table):
+        """Return key => handlers to call, and handlers for other keys."""
+        entries = [(declared.get(h), wrapped)
+                   for h, wrapped in zip(handlers, table)]
+        index = {}
+        for keys, wrapped in entries:
+            for key in keys or ():
+                index[key] = None
+        for key in index:
+            index[key] = tuple(wrapped for keys, wrapped in entries
+                               if keys is None or key in keys)
+        scan = tuple(wrapped for keys, wrapped in entries if keys is None)
+        return index, scan
+
+    def route(self, service_name, payload, operator=None):
+        """Return the handlers to call for a payload of service_name.
+
+        This is the operator's :meth:`dispatch_table`, narrowed down to the
+        handlers which declared the payload's key, see :meth:`connect`.
+        Payloads with an unhashable key get the whole table.
+        """
+        table = self.dispatch_table(service_name, operator)
+        try:
+            index, scan = self.key_indexes[service_name][operator]
+        except KeyError:
+            return table
+        try:
+            return index.get(self.key_functions[service_name](payload), scan)
+        except TypeError:
+            return table
+
+    def wrap_handler(self, service_name, handler):
+        """Return the callable dispatch tables use to call handler.
+
+        With metrics enabled, this is a :class:`MeteredHandler`, with
+        tracing a :class:`TracedHandler` around it, and with a time budget or
+        circuit breaker a :class:`GuardedHandler` around that; otherwise the
+        handler itself.
+        """
+        wrapped = handler
+        if self.metrics is not None:
+            stats = self.metrics.handler(service_name, handler,
+                                         self.operator_name(handler))
+            wrapped = MeteredHandler(wrapped, stats)
+        if self.tracer is not None:
+            wrapped = TracedHandler(wrapped, self.tracer, service_name,
+                                    self.handler_operator(handler))
+        breaker, timeout = self.guard_options(service_name, handler)
+        if breaker is not None or timeout is not None:
+            wrapped = self.guard_class(wrapped, breaker, timeout)
+        return wrapped
+
+    def guard_options(self, service_name, handler):
+        """Return the circuit breaker and time budget of a handler.
+
+        Either is None if not enabled.  Breakers are created on first use and
+        kept while the handler stays connected.
+        """
+        timeout = self.timeouts.get(service_name, {}).get(handler)
+        if self.breakers is None:
+            return None, timeout
+        key = (service_name, handler)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers.setdefault(
+                key, self.breaker_class(**self.breaker_options))
+        return breaker, timeout
+
+    def breaker_states(self):
+        """Return a list of dicts describing each circuit breaker.
+
+        The list is empty unless the party was built with ``breakers``.
+        """
+        states = []
+        if self.breakers is None:
+            return states
+        for (service_name, handler), breaker in list(self.breakers.items()):
+            state = breaker.snapshot()
+            state.update(service=service_name, handler=handler_name(handler),
+                         operator=self.operator_name(handler))
+            states.append(state)
+        return states
+
+    def handler_operator(self, handler):
+        """Return the invited operator which connected handler, if any."""
+        for operator in self.operators:
+            if handler in operator.handlers:
+                return operator
+        return None
+
+    def operator_name(self, handler):
+        """Return the name of the invited operator which connected handler."""
+        return getattr(self.handler_operator(handler), 'name', None)
+
+    def ask_around(self, service_name, payload, operator=None, quorum=None):
+        """Ask all handlers of a given service name, return list of answers.
+
+        Handlers connected through the optionally given operator are skipped,
+        so that partyline applications do not call themselves.
+
+        Given a ``quorum`` of N, stop asking once N handlers have answered;
+        ``quorum=1`` asks for the first answer which is not
+        :class:`HighAndDry`.  With an :attr:`executor`, handlers are called
+        concurrently and work still pending at quorum is cancelled.  Either
+        way, answers are listed in handler registration order.
+        """
+        metrics, tracer = self.metrics, self.tracer
+        if metrics is None and tracer is None:
+            return self._ask_around(service_name, payload, operator, quorum)
+        if tracer is not None:
+            token = tracer.start_ask(service_name, payload)
+        start = clock()
+        try:
+            answers = self._ask_around(service_name, payload, operator, quorum)
+        except Exception as e:
+            if tracer is not None:
+                tracer.finish(token, e)
+            if metrics is not None and not isinstance(e, NoSuchServiceName):
+                metrics.record_ask(service_name, clock() - start, errors=1)
+            raise
+        if tracer is not None:
+            tracer.finish(token)
+        if metrics is not None:
+            metrics.record_ask(service_name, clock() - start, len(answers))
+        return answers
+
+    def _ask_around(self, service_name, payload, operator, quorum):
+        try:
+            memo = _memo.get()
+            if memo is None:
+                return self._ask_cached(service_name, payload, operator,
+                                        quorum)
+            key = (service_name, operator, quorum, payload_key(payload))
+            try:
+                answers = memo.get(key)
+            except TypeError:
+                # Unhashable payload; ask without the memo.
+                return self._ask_cached(service_name, payload, operator,
+                                        quorum)
+            if answers is None:
+                answers, complete = _ask_complete(
+                    self._ask_cached, service_name, payload, operator, quorum)
+                if complete:
+                    memo[key] = tuple(answers)
+            return list(answers)
+        except ServiceOverloaded as e:
+            return self._shed(service_name, e)
+
+    def _shed(self, service_name, error):
+        """Return no answers for a shed ask, if so configured, or raise."""
+        limit = self.limits.get(service_name)
+        if (error.service_name != service_name or limit is None or
+                limit.shed != 'empty'):
+            raise error
+        return []
+
+    def _ask_cached(self, service_name, payload, operator, quorum):
+        cache = self.caches.get(service_name)
+        if cache is None:
+            return self._ask_shared(service_name, payload, operator, quorum)
+        try:
+            key = (operator, quorum, cache.key(payload))
+            answers = cache.get(key)
+        except TypeError:
+            # Unhashable payload; ask without the cache.
+            return self._ask_shared(service_name, payload, operator, quorum)
+        if answers is None:
+            generation = cache.generation
+            answers, complete = _ask_complete(
+                self._ask_shared, service_name, payload, operator, quorum)
+            if complete:
+                cache.set(key, answers, generation)
+        return list(answers)
+
+    def _ask_shared(self, service_name, payload, operator, quorum):
+        flight = self.flights.get(service_name)
+        if flight is None:
+            return self._ask_limited(service_name, payload, operator, quorum)
+        try:
+            key = (operator, quorum, flight.key(payload))
+            hash(key)
+        except TypeError:
+            return self._ask_limited(service_name, payload, operator, quorum)
+        # Share whether the answers are partial along with them.
+        shared = flight.do(key, partial(_ask_complete, self._ask_limited,
+                                        service_name, payload, operator,
+                                        quorum),
+                           _deadline.get())
+        if shared is None:
+            return []
+        answers, complete = shared
+        if not complete:
+            _mark_partial()
+        return list(answers)
+
+    def _ask_limited(self, service_name, payload, operator, quorum):
+        limit = self.limits.get(service_name)
+        if limit is None:
+            return self._ask(service_name, payload, operator, quorum)
+        with _slot(limit) as admitted:
+            if not admitted:
+                raise ServiceOverloaded(service_name)
+            return self._ask(service_name, payload, operator, quorum)
+
+    def _ask(self, service_name, payload, operator, quorum):
+        handlers = self.route(service_name, payload, operator)
+        affinity = self.affinities.get(service_name)
+        if affinity is not None:
+            return self._ask_by_affinity(affinity, handlers, payload,
+                                         operator, quorum)
+        deadline = _deadline.get()
+        if (self.executor is not None and len(handlers) > 1 and
+                not getattr(_worker, 'busy', False)):
+            return self._fan_out(handlers, payload, quorum, deadline)
+        answers = []
+        for handler in handlers:
+            if deadline is not None and clock() >= deadline:
+                # Out of time; the handlers left are misses.
+                break
+            try:
+                answer = handler(payload)
+            except HighAndDry:
                 continue
+            if answer.__class__ is ManyAnswers:
+                answers.extend(answer)
+            else:
+                answers.append(answer)
+            if quorum is not None and len(answers) >= quorum:
+                del answers[quorum:]
+                break
+        return answers
+
+    def _ask_by_affinity(self, affinity, handlers, payload, operator, quorum):
+        """Call the handler learned for payload, else scan and learn."""
+        # A handler learned by a full scan is the sole one answering, and
+        # good for any quorum; one learned by a scan cut short at a quorum is
+        # good for that quorum only.
+        keys = [(operator, None, affinity.key(payload))]
+        if quorum is not None:
+            keys.append((operator, quorum, keys[0][2]))
+        try:
+            handler = affinity.get(*keys)
+        except TypeError:
+            # Unhashable payload; scan without learning.
+            return self._scan(handlers, payload, quorum)[0]
+        if handler is not None:
             try:
-                answers.append(handler(payload))
+                answer = handler(payload)
+            except HighAndDry:
+                for key in keys:
+                    affinity.forget(key)
+            else:
+                if answer.__class__ is ManyAnswers:
+                    return list(answer[:quorum])
+                return [answer]
+        generation = affinity.generation
+        (answers, owner, cut), complete = _ask_complete(
+            self._scan, handlers, payload, quorum)
+        # Answers missing some handlers tell nothing of the sole answer.
+        if owner is not None and complete:
+            affinity.learn(keys[-1] if cut else keys[0], owner, generation)
+        return answers
+
+    def _scan(self, handlers, payload, quorum):
+        """Call handlers one at a time, return answers, the handler which
+        answered alone if any, and whether the quorum cut the scan short."""
+        deadline = _deadline.get()
+        answers = []
+        owner = None
+        for i, handler in enumerate(handlers):
+            if _past(deadline):
+                return answers, None, False
+            try:
+                answer = handler(payload)
             except HighAndDry:
                 continue
+            # Learn only a sole answering handler, so that routing to it
+            # gives the same answers as a scan.
+            owner = handler if not answers else None
+            if answer.__class__ is ManyAnswers:
+                answers.extend(answer)
+            else:
+                answers.append(answer)
+            if quorum is not None and len(answers) >= quorum:
+                del answers[quorum:]
+                return answers, owner, i < len(handlers) - 1
+        return answers, owner, False
+
+    def _fan_out(self, handlers, payload, quorum, deadline=None):
+        """Call handlers on the executor, collect answers up to quorum.
+
+        Handlers which have not answered by the deadline, or within their
+        time budget, are misses.
+        """
+        # Carry the deadline, request memo, lane and current span over to
+        # the executor's threads, so that nested asks keep them.
+        futures = [self.executor.submit(copy_context().run, _call_on_worker,
+                                        handler, payload)
+                   for handler in handlers]
+        # Time by which each handler with a time budget must answer.
+        budgets = {}
+        start = clock()
+        for handler, future in zip(handlers, futures):
+            if (isinstance(handler, GuardedHandler) and
+                    handler.timeout is not None):
+                budgets[future] = start + handler.timeout
+        answered = []
+        count = 0
+        pending = set(futures)
+        try:
+            while pending:
+                end = deadline
+                for future in pending.intersection(budgets):
+                    if end is None or budgets[future] < end:
+                        end = budgets[future]
+                timeout = None
+                if end is not None:
+                    timeout = max(end - clock(), 0)
+                done, pending = wait(pending, timeout, FIRST_COMPLETED)
+                if not done:
+                    if _past(deadline):
+                        break
+                    # Handlers past their budget are misses.
+                    now = clock()
+                    for future in pending.intersection(budgets):
+                        if budgets[future] <= now:
+                            future.cancel()
+                            pending.discard(future)
+                            _mark_partial()
+                    continue
+                for future in done:
+                    try:
+                        answer = future.result()
+                    except HighAndDry:
+                        continue
+                    if quorum is None or count < quorum:
+                        # Keep the first to complete, when several complete
+                        # together.
+                        answered.append(future)
+                        if answer.__class__ is ManyAnswers:
+                            count += len(answer)
+                        else:
+                            count += 1
+                if quorum is not None and count >= quorum:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+        order = dict((future, i) for i, future in enumerate(futures))
+        answered.sort(key=order.__getitem__)
+        answers = []
+        for future in answered:
+            answer = future.result()
+            if answer.__class__ is ManyAnswers:
+                answers.extend(answer)
+            else:
+                answers.append(answer)
+        if quorum is not None:
+            del answers[quorum:]
         return answers
+
+    def iter_answers(self, service_name, payload, operator=None):
+        """Ask handlers of a given service name lazily, yield their answers.
+
+        Handlers are called one at a time as the caller consumes answers, so
+        a caller which stops iterating does not pay for remaining handlers.
+        :class:`NoSuchServiceName` is raised right away, not on iteration.
+        Iterating waits for the service's :meth:`limit_asks` limit, if any,
+        which is held until the iterator is exhausted or closed.
+        """
+        handlers = self.route(service_name, payload, operator)
+        limit = self.limits.get(service_name)
+        if limit is None:
+            return self._iter_answers(handlers, payload)
+        return self._iter_limited(service_name, limit, handlers, payload)
+
+    def _iter_limited(self, service_name, limit, handlers, payload):
+        held = _holding.get()
+        answers = self._iter_answers(handlers, payload)
+        if limit in held:
+            for answer in answers:
+                yield answer
+            return
+        if not limit.acquire(_lane.get(), _deadline.get()):
+            self._shed(service_name, ServiceOverloaded(service_name))
+            return
+        try:
+            while True:
+                # Asks nested in handlers go on in the slot; those the
+                # caller makes between answers do not.
+                token = _holding.set(held + (limit,))
+                try:
+                    answer = next(answers)
+                except StopIteration:
+                    return
+                finally:
+                    _holding.reset(token)
+                yield answer
+        finally:
+            answers.close()
+            limit.release()
+
+    def _iter_answers(self, handlers, payload):
+        for handler in handlers:
+            if _past(_deadline.get()):
+                return
+            try:
+                answer = handler(payload)
+            except HighAndDry:
+                continue
+            if answer.__class__ is ManyAnswers:
+                for each in answer:
+                    yield each
+            else:
+                yield answer
+
+    def announce(self, service_name, payload, operator=None):
+        """Tell all handlers of a given service name, without waiting.
+
+        Like :meth:`ask_around`, but handlers are called on the
+        :attr:`announcer`'s thread and their answers are dropped, e.g. for
+        telling other applications to drop their caches after a write.
+        Handlers connected through the optionally given operator are
+        skipped.  Returns False if coalesced into an identical pending
+        announcement.  Raises :class:`NoSuchServiceName` right away.
+        """
+        self.dispatch_table(service_name, operator)
+        return self.announcer.put(service_name, payload, operator)
+
+    def flush(self, timeout=None):
+        """Wait until pending announcements are delivered.
+
+        Returns False if some are still pending after timeout seconds.
+        """
+        return self.announcer.flush(timeout)
+
+    def deliver_announcement(self, service_name, payload, operator=None):
+        """Call the handlers of an announcement, return how many failed.
+
+        Errors do not keep the other handlers from being called.
+        """
+        errors = 0
+        for handler in self.route(service_name, payload, operator):
+            try:
+                handler(payload)
+            except HighAndDry:
+                pass
+            except Exception:
+                errors += 1
+        return errors
+
+    def ask_first(self, service_name, payload, default=None, operator=None):
+        """Return the first answer for a given service name, else default.
+
+        Handlers after the first one to answer are not called, or are
+        cancelled if already submitted to the :attr:`executor`.
+        """
+        answers = self.ask_around(service_name, payload, operator, quorum=1)
+        if answers:
+            return answers[0]
+        return default
+
+    def ask_around_many(self, service_name, payloads, operator=None):
+        """Ask handlers of a given service name about several payloads.
+
+        Returns a list of answer lists lined up with the payloads, each as
+        :meth:`ask_around` would return it.  Handlers with an ``answer_many``
+        method, such as a :class:`BatchHandler`, get all payloads in one
+        call; other handlers are called once per payload.  Cached answers are
+        used for payloads found in the service's cache.  The others are asked
+        together as one ask within the service's :meth:`limit_asks` limit.
+        """
+        payloads = list(payloads)
+        handlers = self.dispatch_table(service_name, operator)
+        results = [None] * len(payloads)
+        cache = self.caches.get(service_name)
+        if cache is not None:
+            generation = cache.generation
+            keys = []
+            for i, payload in enumerate(payloads):
+                try:
+                    key = (operator, None, cache.key(payload))
+                    answers = cache.get(key)
+                except TypeError:
+                    # Unhashable payload; ask and keep it out of the cache.
+                    key = answers = None
+                keys.append(key)
+                if answers is not None:
+                    results[i] = list(answers)
+        missing = [i for i, answers in enumerate(results) if answers is None]
+        if not missing:
+            return results
+        asked = [payloads[i] for i in missing]
+        limit = self.limits.get(service_name)
+        if limit is None:
+            batch, complete = _ask_complete(self._ask_many, service_name,
+                                            handlers, asked, operator)
+        else:
+            with _slot(limit) as admitted:
+                if admitted:
+                    batch, complete = _ask_complete(
+                        self._ask_many, service_name, handlers, asked,
+                        operator)
+                else:
+                    self._shed(service_name, ServiceOverloaded(service_name))
+                    batch, complete = [[] for i in missing], False
+        if not complete:
+            cache = None
+        for i, answers in zip(missing, batch):
+            results[i] = answers
+            if cache is not None and keys[i] is not None:
+                cache.set(keys[i], answers, generation)
+        return results
+
+    def _ask_many(self, service_name, handlers, asked, operator):
+        """Ask handlers about payloads, return answer lists lined up."""
+        batch = [[] for payload in asked]
+        routes = None
+        if service_name in self.key_indexes:
+            routes = [self.route(service_name, payload, operator)
+                      for payload in asked]
+        deadline = _deadline.get()
+        for handler in handlers:
+            if _past(deadline):
+                break
+            mine, lists = asked, batch
+            if routes is not None:
+                # Ask each handler only about payloads of keys it declared.
+                owned = [j for j, route in enumerate(routes)
+                         if handler in route]
+                if not owned:
+                    continue
+                mine = [asked[j] for j in owned]
+                lists = [batch[j] for j in owned]
+            answer_many = getattr(handler, 'answer_many', None)
+            if answer_many is None:
+                items = self._answer_each(handler, mine)
+            else:
+                try:
+                    items = answer_many(mine)
+                except HighAndDry:
+                    continue
+            for answers, answer in zip(lists, items):
+                if answer is HighAndDry or isinstance(answer, HighAndDry):
+                    continue
+                if answer.__class__ is ManyAnswers:
+                    answers.extend(answer)
+                else:
+                    answers.append(answer)
+        return batch
+
+    def _answer_each(self, handler, payloads):
+        """Call handler once per payload, HighAndDry standing for misses."""
+        items = []
+        for payload in payloads:
+            try:
+                items.append(handler(payload))
+            except HighAndDry:
+                items.append(HighAndDry)
+        return items